@@ -1,6 +1,13 @@
 import os
 import unittest
 import logging
+import collections
+import json
+import concurrent.futures
+import contextlib
+import functools
+import threading
+import time
 import vtk, qt, ctk, slicer, math
 import numpy as np
 from slicer.ScriptedLoadableModule import *
@@ -156,6 +163,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.miterBoxSlotWallSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
     self.ui.fibulaScrewHoleCylinderRadiusSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
     self.ui.clearanceFitPrintingToleranceSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
+    self.ui.numberOfWorkerThreadsSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
     self.ui.biggerMiterBoxDistanceToFibulaSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
     self.ui.intersectionDistanceMultiplierSpinBox.valueChanged.connect(self.onFibulaPlanesCreationParametersChanged)
     self.ui.sawBoxSlotWidthSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
@@ -172,6 +180,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.addMandibularCurveButton.connect('clicked(bool)',self.onAddMandibularCurveButton)
     self.ui.addFibulaLineButton.connect('clicked(bool)',self.onAddFibulaLineButton)
     self.ui.makeModelsButton.connect('clicked(bool)',self.onMakeModelsButton)
+    self.ui.cancelMakeModelsButton.connect('clicked(bool)',self.onCancelMakeModelsButton)
     self.ui.createMiterBoxesFromFibulaPlanesButton.connect('clicked(bool)',self.onCreateMiterBoxesFromFibulaPlanesButton)
     self.ui.createFibulaCylindersFiducialListButton.connect('clicked(bool)',self.onCreateFibulaCylindersFiducialListButton)
     self.ui.createCylindersFromFiducialListAndFibulaSurgicalGuideBaseButton.connect('clicked(bool)',self.onCreateCylindersFromFiducialListAndSurgicalGuideBaseButton)
@@ -189,44 +198,55 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.makeAllMandiblePlanesRotateTogetherCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
     self.ui.useMoreExactVersionOfPositioningAlgorithmCheckBox.connect('stateChanged(int)', self.onUseMoreExactVersionOfPositioningAlgorithmCheckBox)
     self.ui.useNonDecimatedBoneModelsForPreviewCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.useAutomaticLevelOfDetailCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
     self.ui.mandiblePlanesPositioningForMaximumBoneContactCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
     self.ui.fixCutGoesThroughTheMandibleTwiceCheckBox.connect('stateChanged(int)', self.onFixCutGoesThroughTheMandibleTwiceCheckBox)
     self.ui.checkSecurityMarginOnMiterBoxCreationCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.useVectorizedBetweenSpaceComputationCheckBox.connect('stateChanged(int)', self.onFibulaPlanesCreationParametersChanged)
+    self.ui.fitFibulaAxisToCenterFibulaLineCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.useSceneBatchUpdateCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.useSinglePassFibulaSlicingCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.useBatchedBooleanOperationsCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.useVoxelBooleanOperationsCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.booleanOperationsVoxelSizeSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
+    self.ui.useBoneModelsCacheCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.boneModelsCacheSizeSpinBox.valueChanged.connect(self.updateParameterNodeFromGUI)
+    self.ui.boneModelsTriangleBudgetsLineEdit.connect('editingFinished()', self.updateParameterNodeFromGUI)
+    self.ui.useBackgroundPlanningCheckBox.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
+    self.ui.clearTimingSpansButton.connect('clicked(bool)', self.onClearTimingSpansButton)
+    self.ui.exportTimingTraceButton.connect('clicked(bool)', self.onExportTimingTraceButton)
+
+    #Latency breakdown is refreshed periodically while the module is shown
+    self.numberOfDisplayedTimingSpans = None
+    self.latencyBreakdownTimer = qt.QTimer()
+    self.latencyBreakdownTimer.setInterval(1000)
+    self.latencyBreakdownTimer.connect('timeout()', self.updateLatencyBreakdown)
     
     # Make sure parameter node is initialized (needed for module reload)
     self.initializeParameterNode()
 
   def getParentFolderItemID(self):
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    sceneItemID = shNode.GetSceneItemID()
-    folderSubjectHierarchyID = shNode.GetItemByName("BoneReconstructionPlanner")
-    if folderSubjectHierarchyID:
-      return folderSubjectHierarchyID
-    else:
-      return shNode.CreateFolderItem(sceneItemID,"BoneReconstructionPlanner")
+    return self.logic.getParentFolderItemID()
 
   def cleanup(self):
     """
     Called when the application closes and the module widget is destroyed.
     """
+    self.logic.cancelMakeModels()
+    self.logic.planningWorker.shutdown()
+    self.logic.folderRegistry.cleanup()
+    self.latencyBreakdownTimer.stop()
     self.removeObservers()
 
   @vtk.calldata_type(vtk.VTK_OBJECT)
   def onNodeAboutToBeRemovedEvent(self, caller, event, callData):
     if callData.GetClassName() == 'vtkMRMLMarkupsPlaneNode':
       if callData.GetAttribute("isMandibularPlane") == 'True':
-        if len(self.logic.mandiblePlaneObserversAndNodeIDList) > 0:
-          for i in range(len(self.logic.mandiblePlaneObserversAndNodeIDList)):
-            if self.logic.mandiblePlaneObserversAndNodeIDList[i][1] == callData.GetID():
-              observerIndex = i
-          callData.RemoveObserver(self.logic.mandiblePlaneObserversAndNodeIDList.pop(observerIndex)[0])
+        self.logic.mandiblePlaneObservers.removeObservers(callData.GetID())
         self.logic.onPlaneModifiedTimer(None,None)
       if callData.GetAttribute("isSawBoxPlane") == 'True':
-        if len(self.logic.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList) > 0:
-          for i in range(len(self.logic.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList)):
-            if self.logic.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList[i][1] == callData.GetID():
-              observerIndex = i
-          callData.RemoveObserver(self.logic.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList.pop(observerIndex)[0])
+        self.logic.sawBoxPlaneObservers.removeObservers(callData.GetID())
+        self.logic.sawBoxPlanesTransformsIDs.pop(callData.GetID(), None)
 
   def enter(self):
     """
@@ -236,11 +256,11 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.initializeParameterNode()
 
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    segmentationModelsFolder = shNode.GetItemByName("Segmentation Models")
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-    cutBonesFolder = shNode.GetItemByName("Cut Bones")
-    fibulaCylindersFiducialsListsFolder = shNode.GetItemByName("Fibula Cylinders Fiducials Lists")
-    mandibleCylindersFiducialsListsFolder = shNode.GetItemByName("Mandible Cylinders Fiducials Lists")
+    segmentationModelsFolder = self.logic.getFolderItemID("Segmentation Models")
+    fibulaPlanesFolder = self.logic.getFolderItemID("Fibula planes")
+    cutBonesFolder = self.logic.getFolderItemID("Cut Bones")
+    fibulaCylindersFiducialsListsFolder = self.logic.getFolderItemID("Fibula Cylinders Fiducials Lists")
+    mandibleCylindersFiducialsListsFolder = self.logic.getFolderItemID("Mandible Cylinders Fiducials Lists")
 
     if segmentationModelsFolder:
       self.ui.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandibleButton.enabled = True
@@ -250,36 +270,38 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       self.ui.createCylindersFromFiducialListAndMandibleSurgicalGuideBaseButton.enabled = True
 
 
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
+    mandibularPlanesFolder = self.logic.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.logic.getFolderChildrenDataNodes(mandibularPlanesFolder)
 
     for i in range(len(mandibularPlanesList)):
       mandibularPlanesList[i].SetLocked(0)
       displayNode = mandibularPlanesList[i].GetDisplayNode()
       displayNode.HandlesInteractiveOn()
-      observer = mandibularPlanesList[i].AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent,self.logic.onPlaneModifiedTimer)
-      self.logic.mandiblePlaneObserversAndNodeIDList.append([observer,mandibularPlanesList[i].GetID()])
+      self.logic.addMandiblePlaneObserver(mandibularPlanesList[i])
 
     if self.ui.scalarVolumeSelector.nodeCount() != 0 and self.ui.scalarVolumeSelector.currentNode() == None:
       self.ui.scalarVolumeSelector.setCurrentNodeIndex(0)#0 == first scalarVolume
 
+    self.updateLatencyBreakdown()
+    self.latencyBreakdownTimer.start()
+
   def exit(self):
     """
     Called each time the user opens a different module.
     """
+    self.latencyBreakdownTimer.stop()
     # Do not react to parameter node changes (GUI wlil be updated when the user enters into the module)
     self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
 
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
+    mandibularPlanesFolder = self.logic.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.logic.getFolderChildrenDataNodes(mandibularPlanesFolder)
 
     for i in range(len(mandibularPlanesList)):
       mandibularPlanesList[i].SetLocked(1)
       displayNode = mandibularPlanesList[i].GetDisplayNode()
       displayNode.HandlesInteractiveOff()
-      mandibularPlanesList[i].RemoveObserver(self.logic.mandiblePlaneObserversAndNodeIDList[i][0])
-    self.logic.mandiblePlaneObserversAndNodeIDList = []
+    self.logic.mandiblePlaneObservers.removeAllObservers()
 
   def onSceneStartClose(self, caller, event):
     """
@@ -287,6 +309,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     """
     # Parameter node will be reset, do not use it anymore
     self.setParameterNode(None)
+    self.logic.cancelMakeModels()
 
   def onSceneEndClose(self, caller, event):
     """
@@ -371,6 +394,8 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       self.ui.fibulaScrewHoleCylinderRadiusSpinBox.setValue(float(self._parameterNode.GetParameter("fibulaScrewHoleCylinderRadius")))
     if self._parameterNode.GetParameter("clearanceFitPrintingTolerance") != '':
       self.ui.clearanceFitPrintingToleranceSpinBox.setValue(float(self._parameterNode.GetParameter("clearanceFitPrintingTolerance")))
+    if self._parameterNode.GetParameter("numberOfWorkerThreads") != '':
+      self.ui.numberOfWorkerThreadsSpinBox.setValue(float(self._parameterNode.GetParameter("numberOfWorkerThreads")))
     if self._parameterNode.GetParameter("biggerMiterBoxDistanceToFibula") != '':
       self.ui.biggerMiterBoxDistanceToFibulaSpinBox.setValue(float(self._parameterNode.GetParameter("biggerMiterBoxDistanceToFibula")))
     if self._parameterNode.GetParameter("intersectionDistanceMultiplier") != '':
@@ -392,6 +417,20 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.makeAllMandiblePlanesRotateTogetherCheckBox.checked = self._parameterNode.GetParameter("makeAllMandiblePlanesRotateTogether") == "True"
     self.ui.useMoreExactVersionOfPositioningAlgorithmCheckBox.checked = self._parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithm") == "True"
     self.ui.useNonDecimatedBoneModelsForPreviewCheckBox.checked = self._parameterNode.GetParameter("useNonDecimatedBoneModelsForPreview") == "True"
+    self.ui.useAutomaticLevelOfDetailCheckBox.checked = self._parameterNode.GetParameter("useAutomaticLevelOfDetail") == "True"
+    self.ui.useVectorizedBetweenSpaceComputationCheckBox.checked = self._parameterNode.GetParameter("useVectorizedBetweenSpaceComputation") == "True"
+    self.ui.fitFibulaAxisToCenterFibulaLineCheckBox.checked = self._parameterNode.GetParameter("fitFibulaAxisToCenterFibulaLine") == "True"
+    self.ui.useSceneBatchUpdateCheckBox.checked = self._parameterNode.GetParameter("useSceneBatchUpdate") == "True"
+    self.ui.useSinglePassFibulaSlicingCheckBox.checked = self._parameterNode.GetParameter("useSinglePassFibulaSlicing") == "True"
+    self.ui.useBatchedBooleanOperationsCheckBox.checked = self._parameterNode.GetParameter("useBatchedBooleanOperations") == "True"
+    self.ui.useVoxelBooleanOperationsCheckBox.checked = self._parameterNode.GetParameter("useVoxelBooleanOperations") == "True"
+    if self._parameterNode.GetParameter("booleanOperationsVoxelSize") != '':
+      self.ui.booleanOperationsVoxelSizeSpinBox.setValue(float(self._parameterNode.GetParameter("booleanOperationsVoxelSize")))
+    self.ui.useBoneModelsCacheCheckBox.checked = self._parameterNode.GetParameter("useBoneModelsCache") == "True"
+    if self._parameterNode.GetParameter("boneModelsCacheSize") != '':
+      self.ui.boneModelsCacheSizeSpinBox.setValue(float(self._parameterNode.GetParameter("boneModelsCacheSize")))
+    self.ui.boneModelsTriangleBudgetsLineEdit.text = self._parameterNode.GetParameter("boneModelsTriangleBudgets")
+    self.ui.useBackgroundPlanningCheckBox.checked = self._parameterNode.GetParameter("useBackgroundPlanning") == "True"
     self.ui.mandiblePlanesPositioningForMaximumBoneContactCheckBox.checked = self._parameterNode.GetParameter("mandiblePlanesPositioningForMaximumBoneContact") == "True"
     self.ui.checkSecurityMarginOnMiterBoxCreationCheckBox.checked = self._parameterNode.GetParameter("checkSecurityMarginOnMiterBoxCreation") != "False"
     if self._parameterNode.GetParameter("updateOnMandiblePlanesMovement") == "True":
@@ -430,6 +469,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self._parameterNode.SetParameter("miterBoxSlotWall", str(self.ui.miterBoxSlotWallSpinBox.value))
     self._parameterNode.SetParameter("fibulaScrewHoleCylinderRadius", str(self.ui.fibulaScrewHoleCylinderRadiusSpinBox.value))
     self._parameterNode.SetParameter("clearanceFitPrintingTolerance", str(self.ui.clearanceFitPrintingToleranceSpinBox.value))
+    self._parameterNode.SetParameter("numberOfWorkerThreads", str(int(self.ui.numberOfWorkerThreadsSpinBox.value)))
     self._parameterNode.SetParameter("biggerMiterBoxDistanceToFibula", str(self.ui.biggerMiterBoxDistanceToFibulaSpinBox.value))
     self._parameterNode.SetParameter("sawBoxSlotWidth", str(self.ui.sawBoxSlotWidthSpinBox.value))
     self._parameterNode.SetParameter("sawBoxSlotLength", str(self.ui.sawBoxSlotLengthSpinBox.value))
@@ -459,10 +499,45 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       self._parameterNode.SetParameter("useNonDecimatedBoneModelsForPreview","True")
     else:
       self._parameterNode.SetParameter("useNonDecimatedBoneModelsForPreview","False")
+    if self.ui.useAutomaticLevelOfDetailCheckBox.checked:
+      self._parameterNode.SetParameter("useAutomaticLevelOfDetail","True")
+    else:
+      self._parameterNode.SetParameter("useAutomaticLevelOfDetail","False")
     if self.ui.checkSecurityMarginOnMiterBoxCreationCheckBox.checked:
       self._parameterNode.SetParameter("checkSecurityMarginOnMiterBoxCreation","True")
     else:
       self._parameterNode.SetParameter("checkSecurityMarginOnMiterBoxCreation","False")
+    if self.ui.fitFibulaAxisToCenterFibulaLineCheckBox.checked:
+      self._parameterNode.SetParameter("fitFibulaAxisToCenterFibulaLine","True")
+    else:
+      self._parameterNode.SetParameter("fitFibulaAxisToCenterFibulaLine","False")
+    if self.ui.useSceneBatchUpdateCheckBox.checked:
+      self._parameterNode.SetParameter("useSceneBatchUpdate","True")
+    else:
+      self._parameterNode.SetParameter("useSceneBatchUpdate","False")
+    if self.ui.useSinglePassFibulaSlicingCheckBox.checked:
+      self._parameterNode.SetParameter("useSinglePassFibulaSlicing","True")
+    else:
+      self._parameterNode.SetParameter("useSinglePassFibulaSlicing","False")
+    if self.ui.useBatchedBooleanOperationsCheckBox.checked:
+      self._parameterNode.SetParameter("useBatchedBooleanOperations","True")
+    else:
+      self._parameterNode.SetParameter("useBatchedBooleanOperations","False")
+    if self.ui.useVoxelBooleanOperationsCheckBox.checked:
+      self._parameterNode.SetParameter("useVoxelBooleanOperations","True")
+    else:
+      self._parameterNode.SetParameter("useVoxelBooleanOperations","False")
+    self._parameterNode.SetParameter("booleanOperationsVoxelSize", str(self.ui.booleanOperationsVoxelSizeSpinBox.value))
+    if self.ui.useBoneModelsCacheCheckBox.checked:
+      self._parameterNode.SetParameter("useBoneModelsCache","True")
+    else:
+      self._parameterNode.SetParameter("useBoneModelsCache","False")
+    self._parameterNode.SetParameter("boneModelsCacheSize", str(int(self.ui.boneModelsCacheSizeSpinBox.value)))
+    self._parameterNode.SetParameter("boneModelsTriangleBudgets", self.ui.boneModelsTriangleBudgetsLineEdit.text)
+    if self.ui.useBackgroundPlanningCheckBox.checked:
+      self._parameterNode.SetParameter("useBackgroundPlanning","True")
+    else:
+      self._parameterNode.SetParameter("useBackgroundPlanning","False")
     if self.ui.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandibleButton.checkState == qt.Qt.Checked:
       self._parameterNode.SetParameter("updateOnMandiblePlanesMovement","True")
     else:
@@ -480,6 +555,10 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self._parameterNode.SetParameter("intersectionPlaceOfFibulaPlanes", str(self.ui.intersectionSpinBox.value))
     self._parameterNode.SetParameter("additionalBetweenSpaceOfFibulaPlanes", str(self.ui.betweenSpinBox.value))
     self._parameterNode.SetParameter("intersectionDistanceMultiplier", str(self.ui.intersectionDistanceMultiplierSpinBox.value))
+    if self.ui.useVectorizedBetweenSpaceComputationCheckBox.checked:
+      self._parameterNode.SetParameter("useVectorizedBetweenSpaceComputation","True")
+    else:
+      self._parameterNode.SetParameter("useVectorizedBetweenSpaceComputation","False")
     self._parameterNode.SetNodeReferenceID("fibulaLine", self.ui.fibulaLineSelector.currentNodeID)
     self._parameterNode.EndModify(wasModified)
 
@@ -548,16 +627,16 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
         centerOfScalarVolume = np.array([(bounds[0]+bounds[1])/2,(bounds[2]+bounds[3])/2,(bounds[4]+bounds[5])/2])
       
         shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-        mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-        fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-        biggerMiterBoxesFolder = shNode.GetItemByName("biggerMiterBoxes Models")
-        cutBonesFolder = shNode.GetItemByName("Cut Bones")
-        transformedFibulaPiecesFolder = shNode.GetItemByName("Transformed Fibula Pieces")
-        mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
-        fibulaPlanesList = createListFromFolderID(fibulaPlanesFolder)
-        biggerMiterBoxesList = createListFromFolderID(biggerMiterBoxesFolder)
-        cutBonesList = createListFromFolderID(cutBonesFolder)
-        transformedFibulaPiecesList = createListFromFolderID(transformedFibulaPiecesFolder)
+        mandibularPlanesFolder = self.logic.getFolderItemID("Mandibular planes")
+        fibulaPlanesFolder = self.logic.getFolderItemID("Fibula planes")
+        biggerMiterBoxesFolder = self.logic.getFolderItemID("biggerMiterBoxes Models")
+        cutBonesFolder = self.logic.getFolderItemID("Cut Bones")
+        transformedFibulaPiecesFolder = self.logic.getFolderItemID("Transformed Fibula Pieces")
+        mandibularPlanesList = self.logic.getFolderChildrenDataNodes(mandibularPlanesFolder)
+        fibulaPlanesList = self.logic.getFolderChildrenDataNodes(fibulaPlanesFolder)
+        biggerMiterBoxesList = self.logic.getFolderChildrenDataNodes(biggerMiterBoxesFolder)
+        cutBonesList = self.logic.getFolderChildrenDataNodes(cutBonesFolder)
+        transformedFibulaPiecesList = self.logic.getFolderChildrenDataNodes(transformedFibulaPiecesFolder)
         redSliceNode = slicer.mrmlScene.GetSingletonNode("Red", "vtkMRMLSliceNode")
 
         fibulaDisplayNodesWereUpdatedFlag = self._parameterNode.GetParameter("fibulaDisplayNodesWereUpdatedFlag")
@@ -597,8 +676,55 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.logic.addCutPlane()
 
   def onMakeModelsButton(self):
-    self.logic.makeModels()
-    self.ui.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandibleButton.enabled = True
+    self.ui.makeModelsButton.enabled = False
+    self.ui.makeModelsProgressBar.value = 0
+    self.ui.makeModelsProgressBar.visible = True
+    self.ui.cancelMakeModelsButton.visible = True
+    self.logic.makeModels(onCompleted=self.onMakeModelsCompleted, onProgress=self.onMakeModelsProgress)
+
+  def onMakeModelsProgress(self, progress):
+    self.ui.makeModelsProgressBar.value = progress
+
+  def onMakeModelsCompleted(self, success):
+    self.ui.makeModelsButton.enabled = True
+    self.ui.makeModelsProgressBar.visible = False
+    self.ui.cancelMakeModelsButton.visible = False
+    if success:
+      self.ui.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandibleButton.enabled = True
+
+  def onCancelMakeModelsButton(self):
+    self.logic.cancelMakeModels()
+
+  def updateLatencyBreakdown(self, maximumNumberOfStages=10):
+    if self.numberOfDisplayedTimingSpans == self.logic.timingSpans.numberOfAddedSpans:
+      return
+    self.numberOfDisplayedTimingSpans = self.logic.timingSpans.numberOfAddedSpans
+    latencyBreakdown = self.logic.timingSpans.getLatencyBreakdown()
+    if not latencyBreakdown:
+      self.ui.latencyBreakdownLabel.text = "No stages timed yet"
+      return
+    self.ui.latencyBreakdownLabel.text = "\n".join("{0} ({1}): {2:.1f} / {3:.1f} ms ({4})".format(row["name"], row["category"], row["last"]*1000, row["mean"]*1000, row["count"])
+      for row in latencyBreakdown[:maximumNumberOfStages])
+
+  def updateUsedVoxelSizeLabel(self):
+    statistics = self.logic.lastVoxelBooleanOperationsStatistics
+    if not statistics:
+      return
+    text = "{0:.3f} mm ({1} voxels)".format(statistics["usedVoxelSize"], "x".join(str(dimension) for dimension in statistics["dimensions"]))
+    if statistics["usedVoxelSize"] > statistics["requestedVoxelSize"]:
+      text += ", increased from {0} mm to limit the volume size".format(statistics["requestedVoxelSize"])
+    self.ui.usedBooleanOperationsVoxelSizeLabel.text = text
+
+  def onClearTimingSpansButton(self):
+    self.logic.timingSpans.clear()
+    self.updateLatencyBreakdown()
+
+  def onExportTimingTraceButton(self):
+    fileName = qt.QFileDialog.getSaveFileName(slicer.util.mainWindow(), "Export timing trace", "BoneReconstructionPlannerTrace.json", "Chrome trace (*.json)")
+    if not fileName:
+      return
+    self.logic.timingSpans.exportChromeTrace(fileName)
+    logging.info('Timing trace exported to {0}'.format(fileName))
 
   def onCreateMiterBoxesFromFibulaPlanesButton(self):
     self.logic.createMiterBoxesFromFibulaPlanes()
@@ -612,6 +738,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
 
   def onMakeBooleanOperationsToFibulaSurgicalGuideBaseButton(self):
     self.logic.makeBooleanOperationsToFibulaSurgicalGuideBase()
+    self.updateUsedVoxelSizeLabel()
 
   def onCreateMandibleCylindersFiducialListButton(self):
     self.ui.createCylindersFromFiducialListAndMandibleSurgicalGuideBaseButton.enabled = True
@@ -622,6 +749,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
 
   def onMakeBooleanOperationsToMandibleSurgicalGuideBaseButton(self):
     self.logic.makeBooleanOperationsToMandibleSurgicalGuideBase()
+    self.updateUsedVoxelSizeLabel()
 
   def onCreateCylindersFromFiducialListAndMandibleSurgicalGuideBaseButton(self):
     self.logic.createCylindersFromFiducialListAndMandibleSurgicalGuideBase()
@@ -634,8 +762,8 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
   
   def onShowHideBiggerSawBoxesInteractionHandlesButton(self):
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    sawBoxesPlanesFolder = shNode.GetItemByName("sawBoxes Planes")
-    sawBoxesPlanesList = createListFromFolderID(sawBoxesPlanesFolder)
+    sawBoxesPlanesFolder = self.logic.getFolderItemID("sawBoxes Planes")
+    sawBoxesPlanesList = self.logic.getFolderChildrenDataNodes(sawBoxesPlanesFolder)
 
     for i in range(len(sawBoxesPlanesList)):
       displayNode = sawBoxesPlanesList[i].GetDisplayNode()
@@ -644,8 +772,8 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
 
   def onShowHideMandiblePlanesInteractionHandlesButton(self):
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
+    mandibularPlanesFolder = self.logic.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.logic.getFolderChildrenDataNodes(mandibularPlanesFolder)
 
     for i in range(len(mandibularPlanesList)):
       displayNode = mandibularPlanesList[i].GetDisplayNode()
@@ -654,29 +782,35 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
 
   def onCreate3DModelOfTheReconstructionButton(self):
     self.logic.create3DModelOfTheReconstruction()
+    self.updateUsedVoxelSizeLabel()
 
   def onShowHideOriginalMandibleButton(self):
-    mandibleModelNode = self._parameterNode.GetNodeReference("mandibleModelNode")
-    decimatedMandibleModelNode = self._parameterNode.GetNodeReference("decimatedMandibleModelNode")
-    useNonDecimatedBoneModelsForPreviewChecked = self._parameterNode.GetParameter("useNonDecimatedBoneModelsForPreview") == "True"
-
-    mandibleModelDisplayNode = mandibleModelNode.GetDisplayNode()
-    decimatedMandibleModelDisplayNode = decimatedMandibleModelNode.GetDisplayNode()
-
-    if mandibleModelDisplayNode.GetVisibility() or decimatedMandibleModelDisplayNode.GetVisibility():
-      mandibleModelDisplayNode.SetVisibility(False)
-      decimatedMandibleModelDisplayNode.SetVisibility(False)
-    else:
-      if useNonDecimatedBoneModelsForPreviewChecked:
-        mandibleModelDisplayNode.SetVisibility(True)
-      else:
-        decimatedMandibleModelDisplayNode.SetVisibility(True)
+    mandibleModelsVisible = any(mandibleModelNode.GetDisplayNode().GetVisibility()
+      for mandibleModelNode in self.logic.getBoneModelLevelsOfDetail("mandible"))
+    self.logic.setPreviewBoneModelVisibility("mandible", not mandibleModelsVisible)
 
     
 #
 # BoneReconstructionPlannerLogic
 #
 
+def runInSceneBatchUpdate(method):
+  """Run a logic method inside BoneReconstructionPlannerLogic.sceneBatchUpdate."""
+  @functools.wraps(method)
+  def methodInSceneBatchUpdate(self, *args, **kwargs):
+    with self.sceneBatchUpdate(method.__name__):
+      return method(self, *args, **kwargs)
+  return methodInSceneBatchUpdate
+
+def runInTimingSpan(method):
+  """Record the duration and the scene churn of a logic method, see BoneReconstructionPlannerLogic.timedOperation."""
+  @functools.wraps(method)
+  def methodInTimingSpan(self, *args, **kwargs):
+    with self.timedOperation(method.__name__):
+      return method(self, *args, **kwargs)
+  return methodInTimingSpan
+
+
 class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
@@ -692,12 +826,36 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
-    self.mandiblePlaneObserversAndNodeIDList = []
-    self.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList = []
-    self.generateFibulaPlanesTimer = qt.QTimer()
-    self.generateFibulaPlanesTimer.setInterval(300)
-    self.generateFibulaPlanesTimer.setSingleShot(True)
-    self.generateFibulaPlanesTimer.connect('timeout()', self.onGenerateFibulaPlanesTimerTimeout)
+    self.mandiblePlaneObservers = NodeObserverManager()
+    self.sawBoxPlaneObservers = NodeObserverManager()
+    self.cliNodeObservers = NodeObserverManager()
+    self.sawBoxPlanesTransformsIDs = {}
+    #Debounce interval and time between updates adapt to the measured update time
+    self.generateFibulaPlanesScheduler = RecomputeScheduler(self.onGenerateFibulaPlanesTimerTimeout)
+    self.planningWorker = PlanningWorker(self.onPlanningResult, self.onPlanningError)
+    self.plan = BoneReconstructionPlan()
+    #Cross-section stacks and segments cutters of the fibula model, of its levels of detail and of their copies
+    #for the background planning, keyed by polydata (see getPolyDataKey)
+    self.fibulaCrossSectionStacks = {}
+    self.fibulaSegmentsCutters = {}
+    self.planningPolyDataCopies = {}
+    self.fibulaSegmentsGapAnalyzer = SurfacesGapAnalyzer()
+    self.lastFibulaSegmentsGapsTable = []
+    #Requested and used voxel sizes and dimensions of the last voxel boolean operations
+    self.lastVoxelBooleanOperationsStatistics = {}
+    self.makeModelsState = None
+    self.boneModelsCache = None
+    self.mandiblePlanesInteractionInProgress = False
+    self.mandibleCurveIndex = None
+    self.folderRegistry = SubjectHierarchyFolderRegistry("BoneReconstructionPlanner")
+    #Scene batch updates, see sceneBatchUpdate
+    self.sceneBatchUpdateDepth = 0
+    self.deferredItemReparenting = None
+    self.lastSceneUpdateStatistics = {}
+    #Durations and scene churn of the planning pipeline stages, see timedOperation
+    self.timingSpans = TimingSpans()
+    self.sceneChurnStatistics = {}
+    self.timedOperationSceneEventCounter = None
 
     customLayout = """
       <layout type="vertical">
@@ -748,19 +906,190 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       parameterNode.SetParameter("Threshold", "100.0")
     if not parameterNode.GetParameter("Invert"):
       parameterNode.SetParameter("Invert", "false")
+    if not parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithm"):
+      parameterNode.SetParameter("useMoreExactVersionOfPositioningAlgorithm", "True")
+    if not parameterNode.GetParameter("useVectorizedBetweenSpaceComputation"):
+      parameterNode.SetParameter("useVectorizedBetweenSpaceComputation", "True")
+    if not parameterNode.GetParameter("fitFibulaAxisToCenterFibulaLine"):
+      parameterNode.SetParameter("fitFibulaAxisToCenterFibulaLine", "False")
+    if not parameterNode.GetParameter("useSceneBatchUpdate"):
+      parameterNode.SetParameter("useSceneBatchUpdate", "True")
+    if not parameterNode.GetParameter("useSinglePassFibulaSlicing"):
+      parameterNode.SetParameter("useSinglePassFibulaSlicing", "True")
+    if not parameterNode.GetParameter("numberOfWorkerThreads"):
+      parameterNode.SetParameter("numberOfWorkerThreads", str(min(os.cpu_count() or 1, 8)))
+    if not parameterNode.GetParameter("useBatchedBooleanOperations"):
+      parameterNode.SetParameter("useBatchedBooleanOperations", "True")
+    if not parameterNode.GetParameter("useVoxelBooleanOperations"):
+      parameterNode.SetParameter("useVoxelBooleanOperations", "False")
+    if not parameterNode.GetParameter("booleanOperationsVoxelSize"):
+      parameterNode.SetParameter("booleanOperationsVoxelSize", "0.2")
+    if not parameterNode.GetParameter("useBoneModelsCache"):
+      parameterNode.SetParameter("useBoneModelsCache", "True")
+    if not parameterNode.GetParameter("boneModelsCacheSize"):
+      parameterNode.SetParameter("boneModelsCacheSize", "2000")
+    if not parameterNode.GetParameter("useBackgroundPlanning"):
+      parameterNode.SetParameter("useBackgroundPlanning", "True")
+    if not parameterNode.GetParameter("useAutomaticLevelOfDetail"):
+      parameterNode.SetParameter("useAutomaticLevelOfDetail", "True")
+    if not parameterNode.GetParameter("boneModelsTriangleBudgets"):
+      parameterNode.SetParameter("boneModelsTriangleBudgets", "100000,20000")
 
   def getParentFolderItemID(self):
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     sceneItemID = shNode.GetSceneItemID()
-    folderSubjectHierarchyID = shNode.GetItemByName("BoneReconstructionPlanner")
+    folderSubjectHierarchyID = self.getFolderItemID("BoneReconstructionPlanner")
     if folderSubjectHierarchyID:
       return folderSubjectHierarchyID
     else:
       return shNode.CreateFolderItem(sceneItemID,"BoneReconstructionPlanner")
 
+  def getFolderItemID(self, folderName):
+    self.applyDeferredItemReparenting()
+    return self.folderRegistry.getFolderItemID(folderName)
+
+  def getFolderChildrenDataNodes(self, folderItemID):
+    self.applyDeferredItemReparenting()
+    return self.folderRegistry.getChildrenDataNodes(folderItemID)
+
+  @contextlib.contextmanager
+  def sceneBatchUpdate(self, operationName):
+    """Scene changes inside this context are made in the scene batch processing state, with rendering
+    paused and subject hierarchy reparenting (setItemParent) deferred until the hierarchy is read
+    again or the context ends. Scene events and wall time of the operation are logged and kept
+    in lastSceneUpdateStatistics. Nested contexts are part of the outermost one.
+    """
+    if self.sceneBatchUpdateDepth > 0:
+      yield
+      return
+    parameterNode = self.getParameterNode()
+    useSceneBatchUpdateChecked = parameterNode.GetParameter("useSceneBatchUpdate") != "False"
+    #Events are counted by the scene event counter of the timed operation if there is one, see timedOperation
+    ownsSceneEventCounter = self.timedOperationSceneEventCounter is None
+    sceneEventCounter = SceneEventCounter() if ownsSceneEventCounter else self.timedOperationSceneEventCounter
+    startSceneEventCounts = dict(sceneEventCounter.counts)
+    startTime = time.time()
+    self.sceneBatchUpdateDepth += 1
+    if useSceneBatchUpdateChecked:
+      self.deferredItemReparenting = []
+      slicer.app.pauseRender()
+      slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      yield
+    finally:
+      if useSceneBatchUpdateChecked:
+        self.applyDeferredItemReparenting()
+        self.deferredItemReparenting = None
+        slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+        slicer.app.resumeRender()
+      self.sceneBatchUpdateDepth -= 1
+      if ownsSceneEventCounter:
+        sceneEventCounter.stop()
+      sceneEventCounts = {countName: count - startSceneEventCounts[countName] for countName, count in sceneEventCounter.counts.items()}
+      self.lastSceneUpdateStatistics = dict(sceneEventCounts, operation=operationName,
+        batchUpdate=useSceneBatchUpdateChecked, wallTime=time.time()-startTime)
+      logging.info('{0}: {1:.2f} seconds, batch update {2}, scene events {3}'.format(
+        operationName, self.lastSceneUpdateStatistics["wallTime"], "on" if useSceneBatchUpdateChecked else "off", sceneEventCounts))
+
+  @contextlib.contextmanager
+  def timedOperation(self, operationName):
+    """The duration of the operation is added to timingSpans, with the scene churn of the operation (see
+    SceneChurnCounter) as span arguments. The scene churn is also added to sceneChurnStatistics and the number
+    of nodes, items and observers at the end of the operation is added as counters to timingSpans.
+    Churn of nested operations is part of the churn of the outer ones. Nested operations share the scene
+    event observers of the outermost one so timing does not add observers churn of its own.
+    """
+    ownsSceneEventCounter = self.timedOperationSceneEventCounter is None
+    if ownsSceneEventCounter:
+      self.timedOperationSceneEventCounter = SceneEventCounter()
+    sceneChurnCounter = SceneChurnCounter(self.timedOperationSceneEventCounter,
+      [self.mandiblePlaneObservers, self.sawBoxPlaneObservers, self.cliNodeObservers, self.folderRegistry])
+    startTime = time.perf_counter()
+    try:
+      yield
+    finally:
+      sceneChurn = sceneChurnCounter.stop()
+      if ownsSceneEventCounter:
+        self.timedOperationSceneEventCounter.stop()
+        self.timedOperationSceneEventCounter = None
+      self.timingSpans.addSpan(operationName, startTime, args=sceneChurn)
+      self.timingSpans.addCounters("scene", {countName: sceneChurn[countName] for countName in ["numberOfNodes", "numberOfItems", "numberOfObservers"]})
+      self.addSceneChurnStatistics(operationName, sceneChurn)
+
+  def addSceneChurnStatistics(self, operationName, sceneChurn):
+    statistics = self.sceneChurnStatistics.setdefault(operationName, {"count": 0, "total": collections.Counter(), "totalFilterRuns": collections.Counter()})
+    statistics["count"] += 1
+    statistics["last"] = sceneChurn
+    statistics["total"].update({countName: count for countName, count in sceneChurn.items()
+      if countName not in ["filterRuns", "numberOfNodes", "numberOfItems", "numberOfObservers"]})
+    statistics["totalFilterRuns"].update(sceneChurn["filterRuns"])
+
+  def getSceneChurnStatistics(self, operationName=None):
+    """Scene churn of the timed logic operations (see timedOperation): number of calls, churn of the last call
+    and churn added up over all calls, of all operations or of operationName.
+    """
+    if operationName is not None:
+      statistics = self.sceneChurnStatistics.get(operationName)
+      if statistics is None:
+        return None
+      return {"count": statistics["count"], "last": dict(statistics["last"]), "total": dict(statistics["total"]),
+        "totalFilterRuns": dict(statistics["totalFilterRuns"])}
+    return {operationName: self.getSceneChurnStatistics(operationName) for operationName in self.sceneChurnStatistics}
+
+  def resetSceneChurnStatistics(self):
+    self.sceneChurnStatistics = {}
+
+  def setItemParent(self, itemID, parentItemID):
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    if self.deferredItemReparenting is None:
+      shNode.SetItemParent(itemID, parentItemID)
+    else:
+      #Data nodes are kept to skip the items of nodes removed before reparenting
+      self.deferredItemReparenting.append((itemID, shNode.GetItemDataNode(itemID), parentItemID))
+
+  def applyDeferredItemReparenting(self):
+    if not self.deferredItemReparenting:
+      return
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    deferredItemReparenting = self.deferredItemReparenting
+    self.deferredItemReparenting = []
+    for itemID, dataNode, parentItemID in deferredItemReparenting:
+      if dataNode is not None:
+        if dataNode.GetScene() is None:
+          continue
+        itemID = shNode.GetItemByDataNode(dataNode)
+      shNode.SetItemParent(itemID, parentItemID)
+
+  def removeItem(self, itemID):
+    #Items deferred to be moved into the removed folder are removed with it
+    self.applyDeferredItemReparenting()
+    slicer.mrmlScene.GetSubjectHierarchyNode().RemoveItem(itemID)
+
+  def getPooledFolderNodes(self, folderName, className, names):
+    """Nodes of the folder are reused across recomputes so only their content needs to be updated.
+    Missing nodes are created, extra nodes are removed and all of them are renamed to names.
+    """
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    folderItemID = self.getFolderItemID(folderName)
+    if not folderItemID:
+      folderItemID = shNode.CreateFolderItem(self.getParentFolderItemID(),folderName)
+    nodes = []
+    for node in self.getFolderChildrenDataNodes(folderItemID):
+      if node.IsA(className) and len(nodes) < len(names):
+        nodes.append(node)
+      else:
+        self.removeItem(shNode.GetItemByDataNode(node))
+    while len(nodes) < len(names):
+      node = slicer.mrmlScene.AddNewNodeByClass(className)
+      self.setItemParent(shNode.GetItemByDataNode(node), folderItemID)
+      nodes.append(node)
+    for node, name in zip(nodes, names):
+      node.SetName(name)
+    return nodes
+
   def getMandiblePlanesFolderItemID(self):
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    folderSubjectHierarchyID = shNode.GetItemByName("Mandibular planes")
+    folderSubjectHierarchyID = self.getFolderItemID("Mandibular planes")
     if folderSubjectHierarchyID:
       return folderSubjectHierarchyID
     else:
@@ -773,7 +1102,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     slicer.modules.markups.logic().AddNewDisplayNodeForMarkupsNode(curveNode)
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     curveNodeItemID = shNode.GetItemByDataNode(curveNode)
-    shNode.SetItemParent(curveNodeItemID, self.getParentFolderItemID())
+    self.setItemParent(curveNodeItemID, self.getParentFolderItemID())
     curveNode.SetName(slicer.mrmlScene.GetUniqueNameByString("mandibularCurve"))
 
     displayNode = curveNode.GetDisplayNode()
@@ -810,7 +1139,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     slicer.modules.markups.logic().AddNewDisplayNodeForMarkupsNode(lineNode)
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     lineNodeItemID = shNode.GetItemByDataNode(lineNode)
-    shNode.SetItemParent(lineNodeItemID, self.getParentFolderItemID())
+    self.setItemParent(lineNodeItemID, self.getParentFolderItemID())
     lineNode.SetName(slicer.mrmlScene.GetUniqueNameByString("fibulaLine"))
 
     displayNode = lineNode.GetDisplayNode()
@@ -844,7 +1173,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     mandibularFolderID = self.getMandiblePlanesFolderItemID()
     planeNodeItemID = shNode.GetItemByDataNode(planeNode)
-    shNode.SetItemParent(planeNodeItemID, mandibularFolderID)
+    self.setItemParent(planeNodeItemID, mandibularFolderID)
     planeNode.SetName(slicer.mrmlScene.GetUniqueNameByString("mandibularPlane"))
     planeNode.SetAttribute("isMandibularPlane","True")
 
@@ -875,8 +1204,8 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     mandibleCurve = parameterNode.GetNodeReference("mandibleCurve")
 
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
+    mandibularPlanesFolder = self.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.getFolderChildrenDataNodes(mandibularPlanesFolder)
 
     temporalOrigin = [0,0,0]
     sourceNode.GetNthControlPointPosition(0,temporalOrigin)
@@ -887,16 +1216,15 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     displayNode.HandlesInteractiveOn()
     for i in range(3):
       sourceNode.SetNthControlPointVisibility(i,False)
-    observer = sourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent,self.onPlaneModifiedTimer)
-    self.mandiblePlaneObserversAndNodeIDList.append([observer,sourceNode.GetID()])
+    self.addMandiblePlaneObserver(sourceNode)
 
+    origins = np.zeros((len(mandibularPlanesList),3))
+    for i in range(len(mandibularPlanesList)):
+      mandibularPlanesList[i].GetNthControlPointPosition(0,origins[i])
+    closestCurvePointsArcLengths = self.getMandibleCurveIndex(mandibleCurve).getClosestPointsAlongCurve(origins)[2]
     mandiblePlaneAndCurvePointIndexList = []
     for i in range(len(mandibularPlanesList)):
-      origin = [0,0,0]
-      mandibularPlanesList[i].GetNthControlPointPosition(0,origin)
-      closestCurvePoint = [0,0,0]
-      closestCurvePointIndex = mandibleCurve.GetClosestPointPositionAlongCurveWorld(origin,closestCurvePoint)
-      mandiblePlaneAndCurvePointIndexList.append([mandibularPlanesList[i],closestCurvePointIndex])
+      mandiblePlaneAndCurvePointIndexList.append([mandibularPlanesList[i],closestCurvePointsArcLengths[i]])
     
     mandiblePlaneAndCurvePointIndexList.sort(key = lambda item : item[1])
 
@@ -905,9 +1233,9 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     for i in range(len(mandiblePlaneAndCurvePointIndexList)):
       mandiblePlane = mandiblePlaneAndCurvePointIndexList[i][0]
       mandiblePlaneItemID = shNode.GetItemByDataNode(mandiblePlane)
-      shNode.SetItemParent(mandiblePlaneItemID, mandibularPlanesFolder2)
+      self.setItemParent(mandiblePlaneItemID, mandibularPlanesFolder2)
 
-    shNode.RemoveItem(mandibularPlanesFolder)
+    self.removeItem(mandibularPlanesFolder)
     shNode.SetItemName(mandibularPlanesFolder2,"Mandibular planes")
   
   def onPlaneModifiedTimer(self,sourceNode,event):
@@ -919,16 +1247,30 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       parameterNode.SetNodeReferenceID("mandiblePlaneOfRotation", sourceNode.GetID())
 
     if updateOnMandiblePlanesMovementChecked:
-      self.generateFibulaPlanesTimer.start()
+      self.generateFibulaPlanesScheduler.request()
+
+  def onPlaneStartInteraction(self,sourceNode,event):
+    #Updates while the plane is dragged are computed from the coarsest bone models
+    self.mandiblePlanesInteractionInProgress = True
+
+  def onPlaneEndInteraction(self,sourceNode,event):
+    self.mandiblePlanesInteractionInProgress = False
+    parameterNode = self.getParameterNode()
+    updateOnMandiblePlanesMovementChecked = parameterNode.GetParameter("updateOnMandiblePlanesMovement") == "True"
+    useAutomaticLevelOfDetailChecked = parameterNode.GetParameter("useAutomaticLevelOfDetail") == "True"
+    if updateOnMandiblePlanesMovementChecked and useAutomaticLevelOfDetailChecked:
+      #Compute the result again at full resolution
+      self.generateFibulaPlanesScheduler.request()
 
+  @runInTimingSpan
+  @runInSceneBatchUpdate
   def onGenerateFibulaPlanesTimerTimeout(self):
-    import time
     startTime = time.time()
     logging.info('Processing started')
 
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
+    mandibularPlanesFolder = self.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.getFolderChildrenDataNodes(mandibularPlanesFolder)
 
     parameterNode = self.getParameterNode()
     mandiblePlanesPositioningForMaximumBoneContactChecked = parameterNode.GetParameter("mandiblePlanesPositioningForMaximumBoneContact") == "True"
@@ -936,29 +1278,32 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     mandiblePlaneOfRotation = parameterNode.GetNodeReference("mandiblePlaneOfRotation")
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
 
+    #Mandible planes moved here must not start another update
     if len(mandibularPlanesList):
-      if makeAllMandiblePlanesRotateTogetherChecked and mandiblePlanesPositioningForMaximumBoneContactChecked:
-        self.removeMandiblePlanesObservers()
-        self.mandiblePlanesPositioningForMaximumBoneContact()
-        self.transformMandiblePlanesZRotationToBeTheSameAsInputPlane(mandiblePlaneOfRotation)
-        self.addMandiblePlaneObservers()
-      else:
+      with self.mandiblePlaneObservers.suspended():
         if mandiblePlanesPositioningForMaximumBoneContactChecked:
-          self.removeMandiblePlanesObservers()
           self.mandiblePlanesPositioningForMaximumBoneContact()
-          self.addMandiblePlaneObservers()
-        else:
-          if makeAllMandiblePlanesRotateTogetherChecked:
-            self.removeMandiblePlanesObservers()
-            self.transformMandiblePlanesZRotationToBeTheSameAsInputPlane(mandiblePlaneOfRotation)
-            self.addMandiblePlaneObservers()
+        if makeAllMandiblePlanesRotateTogetherChecked:
+          self.transformMandiblePlanesZRotationToBeTheSameAsInputPlane(mandiblePlaneOfRotation)
 
     if fibulaLine != None:
+      useBackgroundPlanningChecked = parameterNode.GetParameter("useBackgroundPlanning") == "True"
+      snapshot = self.getPlanningSnapshot() if useBackgroundPlanningChecked else None
+      if snapshot is not None:
+        #Only plane positions changed, the results are computed on the worker and applied by applyPlanningResult
+        self.planningWorker.submit(computeReconstructionFromPlanningSnapshot, snapshot)
+        logging.info('Processing submitted to the background worker in {0:.2f} seconds'.format(time.time()-startTime))
+        return True
+
+      #Results of an older snapshot must not overwrite the ones computed here
+      self.cancelBackgroundPlanning()
       try:
         # Compute output
         self.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandible()
 
       except Exception as e:
+        #The models may not match the plan anymore so update everything next time
+        self.plan = BoneReconstructionPlan()
         slicer.util.errorDisplay("Failed to compute results: "+str(e))
         import traceback
         traceback.print_exc()  
@@ -966,11 +1311,162 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     stopTime = time.time()
     logging.info('Processing completed in {0:.2f} seconds\n'.format(stopTime-startTime))
 
+  @runInTimingSpan
+  def getPlanningSnapshot(self):
+    """Copy of everything computeReconstructionFromPlanningSnapshot needs to update the reconstruction after the mandible
+    planes moved, or None if the nodes of the reconstruction must be created again (then it is computed on the main thread).
+    Polydata are copies (see getPlanningPolyDataCopy) so the worker does not share them with the scene.
+    """
+    parameterNode = self.getParameterNode()
+    for changedParameterName in ["useMoreExactVersionOfPositioningAlgorithmCheckBoxChanged", "fibulaPlanesCreationParametersChanged",
+        "fixCutGoesThroughTheMandibleTwiceCheckBoxChanged"]:
+      if parameterNode.GetParameter(changedParameterName) == "True":
+        return None
+    if parameterNode.GetParameter("useSinglePassFibulaSlicing") != "True":
+      return None
+
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
+    numberOfSegments = len(planeList)-1
+    if numberOfSegments < 1 or self.plan.getNumberOfSegments() != numberOfSegments:
+      return None
+    fibulaPlanesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Fibula planes"))
+    planeCutsList = self.getFolderChildrenDataNodes(self.getFolderItemID("Plane Cuts"))
+    cutBonesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Cut Bones"))
+    bonePiecesTransformsList = self.getFolderChildrenDataNodes(self.getFolderItemID("Bone Pieces Transforms"))
+    transformedFibulaPiecesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Transformed Fibula Pieces"))
+    if (len(fibulaPlanesList) != 2*numberOfSegments or len(planeCutsList) != numberOfSegments+1 or len(cutBonesList) != numberOfSegments+1
+        or len(bonePiecesTransformsList) != numberOfSegments or len(transformedFibulaPiecesList) != numberOfSegments):
+      return None
+    lastMandiblePlanesPositionCurve = parameterNode.GetNodeReference("lastMandiblePlanesPositionCurve")
+    lastFibulaPlanesPositionA = parameterNode.GetNodeReference("lastFibulaPlanesPositionA")
+    lastFibulaPlanesPositionB = parameterNode.GetNodeReference("lastFibulaPlanesPositionB")
+    if lastMandiblePlanesPositionCurve is None or lastFibulaPlanesPositionA is None or lastFibulaPlanesPositionB is None:
+      return None
+    if lastFibulaPlanesPositionA.GetNumberOfControlPoints() + lastFibulaPlanesPositionB.GetNumberOfControlPoints() != 2*numberOfSegments:
+      return None
+
+    plan = BoneReconstructionPlan()
+    plan.readMandiblePlanesFromNodes(planeList)
+    plan.readFibulaLineFromNode(parameterNode.GetNodeReference("fibulaLine"), parameterNode.GetParameter("notLeftFibula") == "True")
+    fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
+    previewFibulaModelNode = self.getPreviewBoneModelNode("fibula")
+    previewMandibleModelNode = self.getPreviewBoneModelNode("mandible")
+    inputModelsChanged = (any(planeCutsList[i].GetNodeReferenceID("PlaneCut.InputModel") != previewFibulaModelNode.GetID() for i in range(numberOfSegments))
+      or planeCutsList[-1].GetNodeReferenceID("PlaneCut.InputModel") != previewMandibleModelNode.GetID())
+    fibulaPolyData = self.getPlanningPolyDataCopy(fibulaModelNode.GetPolyData())
+    previewFibulaPolyData = self.getPlanningPolyDataCopy(previewFibulaModelNode.GetPolyData())
+    return {
+      "plan": plan,
+      "previousPlan": self.plan.copy(),
+      "recomputeFibulaPlanesPositions": not plan.mandiblePlanesOriginsAreEqualTo(slicer.util.arrayFromMarkupsControlPoints(lastMandiblePlanesPositionCurve)),
+      "lastFibulaPlanesPositionA": slicer.util.arrayFromMarkupsControlPoints(lastFibulaPlanesPositionA),
+      "lastFibulaPlanesPositionB": slicer.util.arrayFromMarkupsControlPoints(lastFibulaPlanesPositionB),
+      "fibulaPolyData": fibulaPolyData,
+      "fibulaCrossSectionStack": self.fibulaCrossSectionStacks.get(getPolyDataKey(fibulaPolyData)),
+      "previewFibulaPolyData": previewFibulaPolyData,
+      "fibulaSegmentsCutter": self.fibulaSegmentsCutters.get(getPolyDataKey(previewFibulaPolyData)),
+      "inputModelsChanged": inputModelsChanged,
+      "initialSpace": float(parameterNode.GetParameter("initialSpace")),
+      "intersectionPlaceOfFibulaPlanes": float(parameterNode.GetParameter("intersectionPlaceOfFibulaPlanes")),
+      "intersectionDistanceMultiplier": float(parameterNode.GetParameter("intersectionDistanceMultiplier")),
+      "additionalBetweenSpaceOfFibulaPlanes": float(parameterNode.GetParameter("additionalBetweenSpaceOfFibulaPlanes")),
+      "useMoreExactVersionOfPositioningAlgorithm": parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithm") == "True",
+      "useVectorizedBetweenSpaceComputation": parameterNode.GetParameter("useVectorizedBetweenSpaceComputation") == "True",
+      "numberOfWorkerThreads": int(parameterNode.GetParameter("numberOfWorkerThreads") or 1),
+      "timingSpans": self.timingSpans,
+      "startTime": time.time(),
+    }
+
+  @runInTimingSpan
+  @runInSceneBatchUpdate
+  def applyPlanningResult(self, result):
+    """Swap the results computed by the worker into the nodes, all in one scene batch update."""
+    parameterNode = self.getParameterNode()
+    plan = result["plan"]
+    numberOfSegments = plan.getNumberOfSegments()
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
+    fibulaPlanesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Fibula planes"))
+    planeCutsList = self.getFolderChildrenDataNodes(self.getFolderItemID("Plane Cuts"))
+    cutBonesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Cut Bones"))
+    bonePiecesTransformsList = self.getFolderChildrenDataNodes(self.getFolderItemID("Bone Pieces Transforms"))
+    transformedFibulaPiecesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Transformed Fibula Pieces"))
+    if (len(planeList) != numberOfSegments+1 or len(fibulaPlanesList) != 2*numberOfSegments or len(cutBonesList) != numberOfSegments+1
+        or len(bonePiecesTransformsList) != numberOfSegments or len(transformedFibulaPiecesList) != numberOfSegments):
+      #The reconstruction changed while the worker was computing, compute it again from the current nodes
+      self.generateFibulaPlanesScheduler.request()
+      return
+
+    self.plan = plan
+    if result["fibulaCrossSectionStack"] is not None:
+      self.addToPolyDataCache(self.fibulaCrossSectionStacks, result["fibulaPolyData"], result["fibulaCrossSectionStack"])
+    self.addToPolyDataCache(self.fibulaSegmentsCutters, result["previewFibulaPolyData"], result["fibulaSegmentsCutter"])
+
+    if result["recomputeFibulaPlanesPositions"]:
+      slicer.util.updateMarkupsControlPointsFromArray(parameterNode.GetNodeReference("lastMandiblePlanesPositionCurve"), plan.mandiblePlanesOrigins)
+      slicer.util.updateMarkupsControlPointsFromArray(parameterNode.GetNodeReference("lastFibulaPlanesPositionA"), plan.fibulaPlanesPositionA)
+      slicer.util.updateMarkupsControlPointsFromArray(parameterNode.GetNodeReference("lastFibulaPlanesPositionB"), plan.fibulaPlanesPositionB)
+    plan.writeFibulaPlanesToNodes(fibulaPlanesList)
+    if result["inputModelsChanged"]:
+      self.createAndUpdateDynamicModelerNodes()
+
+    for i, segmentPolyData in result["cutBonesPolyData"].items():
+      cutBonesList[i].SetAndObservePolyData(segmentPolyData)
+    fibulaPieceToMandibleAxisTransforms = plan.getFibulaPiecesToMandibleTransforms()
+    for i in range(numberOfSegments):
+      slicer.util.updateTransformMatrixFromArray(bonePiecesTransformsList[i], fibulaPieceToMandibleAxisTransforms[i])
+    for i, transformedFibulaPiecePolyData in result["transformedFibulaPiecesPolyData"].items():
+      transformedFibulaPiecesList[i].SetAndObservePolyData(transformedFibulaPiecePolyData)
+
+    #Dynamic modeler tools can only run on the main thread
+    if result["updateResectedMandible"]:
+      with self.timingSpans.span("RunDynamicModelerTool", args={"tool": planeCutsList[-1].GetName()}):
+        slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(planeCutsList[-1])
+        filterRunCounter.countRun("DynamicModeler")
+
+    self.setRedSliceForDisplayNodes()
+
+    logging.info('Segments cut again: {0}'.format(result["segmentsToUpdate"]))
+    logging.info('Processing completed in {0:.2f} seconds (background)\n'.format(time.time()-result["startTime"]))
+    self.generateFibulaPlanesScheduler.finishAsynchronousRecompute(time.time()-result["startTime"])
+
+  def onPlanningResult(self, result):
+    try:
+      self.applyPlanningResult(result)
+    except Exception as e:
+      logging.exception('Failed to apply the background planning result')
+      self.onPlanningError(e)
+
+  def onPlanningError(self, e):
+    #The models may not match the plan anymore so update everything next time
+    self.plan = BoneReconstructionPlan()
+    self.generateFibulaPlanesScheduler.finishAsynchronousRecompute()
+    slicer.util.errorDisplay("Failed to compute results: "+str(e))
+
+  def cancelBackgroundPlanning(self):
+    if self.planningWorker.isBusy():
+      self.planningWorker.cancel()
+      self.generateFibulaPlanesScheduler.finishAsynchronousRecompute()
+
+  def getPlanningPolyDataCopy(self, polyData):
+    """Copy of polyData for the background planning, which must not read the polydata of the scene while it is
+    rendered or modified. The same copy is returned while polyData is not modified so the fibula cross-section
+    stack and the fibula segments cutter built from it stay valid.
+    """
+    polyDataKey = getPolyDataKey(polyData)
+    polyDataCopy = self.planningPolyDataCopies.pop(polyDataKey, None)
+    if polyDataCopy is None:
+      polyDataCopy = vtk.vtkPolyData()
+      polyDataCopy.DeepCopy(polyData)
+    self.planningPolyDataCopies[polyDataKey] = polyDataCopy
+    #Copies of the fibula model and of its levels of detail are kept
+    while len(self.planningPolyDataCopies) > 4:
+      del self.planningPolyDataCopies[next(iter(self.planningPolyDataCopies))]
+    return polyDataCopy
+
+  @runInTimingSpan
   def transformMandiblePlanesZRotationToBeTheSameAsInputPlane(self,mandiblePlaneOfRotation):
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
-    mandiblePlanesTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),'Mandible Planes Transforms')
+    mandibularPlanesFolder = self.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.getFolderChildrenDataNodes(mandibularPlanesFolder)
 
     if mandiblePlaneOfRotation == None:
       mandiblePlaneOfRotation = mandibularPlanesList[0]
@@ -1016,47 +1512,35 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
         mandiblePlaneToRotatedMandiblePlaneRotationMatrix = self.getAxes1ToAxes2RotationMatrix(mandiblePlaneToWorldRotationMatrix, rotatedMandiblePlaneToWorldRotationMatrix)
 
-        transformNode = slicer.vtkMRMLLinearTransformNode()
-        transformNode.SetName("temp%d" % i)
-        slicer.mrmlScene.AddNode(transformNode)
-
         finalTransform = vtk.vtkTransform()
         finalTransform.PostMultiply()
         finalTransform.Translate(-mandiblePlaneOrigin)
         finalTransform.Concatenate(mandiblePlaneToRotatedMandiblePlaneRotationMatrix)
         finalTransform.Translate(mandiblePlaneOrigin)
-        transformNode.SetMatrixTransformToParent(finalTransform.GetMatrix())
 
-        transformNode.UpdateScene(slicer.mrmlScene)
-
-        mandibularPlanesList[i].SetAndObserveTransformNodeID(transformNode.GetID())
-        mandibularPlanesList[i].HardenTransform()
-        
-        transformNodeItemID = shNode.GetItemByDataNode(transformNode)
-        shNode.SetItemParent(transformNodeItemID, mandiblePlanesTransformsFolder)
-      
-    shNode.RemoveItem(mandiblePlanesTransformsFolder)
+        #The transform is hardened right away so there is no need of a transform node
+        mandibularPlanesList[i].ApplyTransform(finalTransform)
 
   def addMandiblePlaneObservers(self):
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
+    mandibularPlanesFolder = self.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.getFolderChildrenDataNodes(mandibularPlanesFolder)
 
     for i in range(len(mandibularPlanesList)):
-      observer = mandibularPlanesList[i].AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent,self.onPlaneModifiedTimer)
-      self.mandiblePlaneObserversAndNodeIDList.append([observer,mandibularPlanesList[i].GetID()])
+      self.addMandiblePlaneObserver(mandibularPlanesList[i])
 
-  def removeMandiblePlanesObservers(self):
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
+  def addMandiblePlaneObserver(self, planeNode):
+    self.mandiblePlaneObservers.addObserver(planeNode, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onPlaneModifiedTimer, coalesce=True)
+    self.mandiblePlaneObservers.addObserver(planeNode, slicer.vtkMRMLMarkupsNode.PointStartInteractionEvent, self.onPlaneStartInteraction)
+    self.mandiblePlaneObservers.addObserver(planeNode, slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, self.onPlaneEndInteraction)
 
-    for i in range(len(mandibularPlanesList)):
-      mandiblePlane = slicer.mrmlScene.GetNodeByID(self.mandiblePlaneObserversAndNodeIDList[i][1])
-      mandiblePlane.RemoveObserver(self.mandiblePlaneObserversAndNodeIDList[i][0])
-    self.mandiblePlaneObserversAndNodeIDList = []
+  def removeMandiblePlanesObservers(self):
+    self.mandiblePlaneObservers.removeAllObservers()
+    self.cancelBackgroundPlanning()
+    self.mandiblePlanesInteractionInProgress = False
 
-  def transformFibulaPlanes(self):
+  @runInTimingSpan
+  def transformFibulaPlanes(self, previousPlan=None):
     parameterNode = self.getParameterNode()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
     lastMandiblePlanesPositionCurve = parameterNode.GetNodeReference("lastMandiblePlanesPositionCurve")
@@ -1069,36 +1553,30 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     notLeftFibulaChecked = parameterNode.GetParameter("notLeftFibula") == "True"
     useMoreExactVersionOfPositioningAlgorithmChecked = parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithm") == "True"
     useMoreExactVersionOfPositioningAlgorithmCheckBoxChanged = parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithmCheckBoxChanged") == "True"
+    useVectorizedBetweenSpaceComputationChecked = parameterNode.GetParameter("useVectorizedBetweenSpaceComputation") == "True"
     fibulaPlanesCreationParametersChanged = parameterNode.GetParameter("fibulaPlanesCreationParametersChanged") == "True"
     fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
-    planeList = createListFromFolderID(self.getMandiblePlanesFolderItemID())
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
     
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-    fibulaPlanesList = createListFromFolderID(fibulaPlanesFolder)
+    fibulaPlanesFolder = self.getFolderItemID("Fibula planes")
+    fibulaPlanesList = self.getFolderChildrenDataNodes(fibulaPlanesFolder)
     
-    #Delete old fibulaPlanesTransforms
-    mandible2FibulaTransformsFolder = shNode.GetItemByName("Mandible2Fibula transforms")
-    shNode.RemoveItem(mandible2FibulaTransformsFolder)
-    mandible2FibulaTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Mandible2Fibula transforms")
+    #Fibula planes are not moved with transform nodes anymore, delete the folder left by older scenes
+    mandible2FibulaTransformsFolder = self.getFolderItemID("Mandible2Fibula transforms")
+    if mandible2FibulaTransformsFolder:
+      self.removeItem(mandible2FibulaTransformsFolder)
+
+    self.plan.readMandiblePlanesFromNodes(planeList)
+    self.plan.readFibulaLineFromNode(fibulaLine, notLeftFibulaChecked)
     
     if lastMandiblePlanesPositionCurve == None:
       lastMandiblePlanesPositionCurve = self.createLastMandiblePlanesPositionCurve()
       parameterNode.SetNodeReferenceID("lastMandiblePlanesPositionCurve", lastMandiblePlanesPositionCurve.GetID())
       mandiblePlanesOriginsAreTheSame = False
-    
     else:
-      mandiblePlanesOriginsAreTheSame = True
-      if len(planeList) != lastMandiblePlanesPositionCurve.GetNumberOfControlPoints():
-        mandiblePlanesOriginsAreTheSame = False
-      else:
-        for mandiblePlaneIndex in range(len(planeList)):
-          lastMandiblePlanePosition = np.array([0,0,0])
-          mandiblePlanePosition = np.array([0,0,0])
-          lastMandiblePlanesPositionCurve.GetNthControlPointPosition(mandiblePlaneIndex,lastMandiblePlanePosition)
-          planeList[mandiblePlaneIndex].GetOrigin(mandiblePlanePosition)
-          if np.linalg.norm(lastMandiblePlanePosition-mandiblePlanePosition) > 1e-5:
-            mandiblePlanesOriginsAreTheSame = False
+      lastMandiblePlanesPositions = slicer.util.arrayFromMarkupsControlPoints(lastMandiblePlanesPositionCurve)
+      mandiblePlanesOriginsAreTheSame = self.plan.mandiblePlanesOriginsAreEqualTo(lastMandiblePlanesPositions)
     
     lastFibulaPlanesPositionsExist = lastFibulaPlanesPositionA != None and lastFibulaPlanesPositionB != None
     if lastFibulaPlanesPositionsExist:
@@ -1108,248 +1586,14 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     
     #This line avoids recalculating the fibulaPlanesPosition when mandiblePlanes just rotate
     if not mandiblePlanesOriginsAreTheSame or not lastFibulaPlanesPositionsExistAndIsValid or useMoreExactVersionOfPositioningAlgorithmCheckBoxChanged or fibulaPlanesCreationParametersChanged:
-      #Create fibula axis:
-      fibulaX, fibulaY, fibulaZ, fibulaOrigin = self.createFibulaAxisFromFibulaLineAndNotLeftChecked(fibulaLine,notLeftFibulaChecked) 
-      
-      fibulaZLineNorm = self.getLineNorm(fibulaLine)
-
-      #NewPlanes position and distance
-      self.fibulaPlanesPositionA = []
-      self.fibulaPlanesPositionB = []
-      boneSegmentsDistance = []
-
-      #Set up transform for intersections to measure betweenSpace
-      intersectionsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Intersections")
-
-      fibulaToRASRotationMatrix = self.getAxes1ToWorldRotationMatrix(fibulaX,fibulaY,fibulaZ)
-
-      intersectionsTransformNode = slicer.vtkMRMLLinearTransformNode()
-      intersectionsTransformNode.SetName("intersectionsTransform")
-      slicer.mrmlScene.AddNode(intersectionsTransformNode)
-
-      intersectionsTransform = vtk.vtkTransform()
-      intersectionsTransform.PostMultiply()
-      intersectionsTransform.Translate(-fibulaOrigin)
-      intersectionsTransform.Concatenate(fibulaToRASRotationMatrix)
-      intersectionsTransform.Translate(fibulaOrigin)
-
-      intersectionsTransformNode.SetMatrixTransformToParent(intersectionsTransform.GetMatrix())
-      intersectionsTransformNode.UpdateScene(slicer.mrmlScene)
-
-      intersectionsTransformNodeItemID = shNode.GetItemByDataNode(intersectionsTransformNode)
-      shNode.SetItemParent(intersectionsTransformNodeItemID, intersectionsFolder)
-
-      intersectionsList = []
-      betweenSpace = []
-      j=0
-
-      self.mandibleAxisToFibulaRotationMatrixesList = []
-      #Transform fibula planes to their final position-orientation
-      for i in range(len(planeList)-1):
-        mandiblePlane0 = planeList[i]
-        mandiblePlane1 = planeList[i+1]
-        mandiblePlane0X = [0,0,0]
-        mandiblePlane0Y = [0,0,0]
-        mandiblePlane0Z = [0,0,0]
-        mandiblePlane0.GetAxes(mandiblePlane0X,mandiblePlane0Y,mandiblePlane0Z)
-        mandiblePlane1X = [0,0,0]
-        mandiblePlane1Y = [0,0,0]
-        mandiblePlane1Z = [0,0,0]
-        mandiblePlane1.GetAxes(mandiblePlane1X,mandiblePlane1Y,mandiblePlane1Z)
-        mandiblePlane0Origin = [0,0,0]
-        mandiblePlane0.GetOrigin(mandiblePlane0Origin)
-        mandiblePlane1Origin = [0,0,0]
-        mandiblePlane1.GetOrigin(mandiblePlane1Origin)
-        fibulaPlaneA = fibulaPlanesList[2*i]
-        fibulaPlaneB = fibulaPlanesList[2*i+1]
-        fibulaPlaneA.SetAxes(mandiblePlane0X,mandiblePlane0Y,mandiblePlane0Z)
-        fibulaPlaneA.SetOrigin(mandiblePlane0Origin)
-        fibulaPlaneB.SetAxes(mandiblePlane1X,mandiblePlane1Y,mandiblePlane1Z)
-        fibulaPlaneB.SetOrigin(mandiblePlane1Origin)
-
-        #Create origin1-origin2 vector
-        or0 = np.zeros(3)
-        or1 = np.zeros(3)
-        mandiblePlane0.GetOrigin(or0)
-        mandiblePlane1.GetOrigin(or1)
-        boneSegmentsDistance.append(np.linalg.norm(or1-or0))
-        mandibleAxisZ = (or1-or0)/np.linalg.norm(or1-or0)
-        
-        #Get Y component of mandiblePlane0
-        mandiblePlane0matrix = vtk.vtkMatrix4x4()
-        mandiblePlane0.GetPlaneToWorldMatrix(mandiblePlane0matrix)
-        mandiblePlane0Y = np.array([mandiblePlane0matrix.GetElement(0,1),mandiblePlane0matrix.GetElement(1,1),mandiblePlane0matrix.GetElement(2,1)])
-        
-        mandibleAxisX = [0,0,0]
-        vtk.vtkMath.Cross(mandiblePlane0Y, mandibleAxisZ, mandibleAxisX)
-        mandibleAxisX = mandibleAxisX/np.linalg.norm(mandibleAxisX)
-        mandibleAxisY = [0,0,0]
-        vtk.vtkMath.Cross(mandibleAxisZ, mandibleAxisX, mandibleAxisY)
-        mandibleAxisY = mandibleAxisY/np.linalg.norm(mandibleAxisY)
-
-        mandibleAxisToWorldRotationMatrix = self.getAxes1ToWorldRotationMatrix(mandibleAxisX, mandibleAxisY, mandibleAxisZ)
-        #Create fibula axis:
-        fibulaX, fibulaY, fibulaZ, fibulaOrigin = self.createFibulaAxisFromFibulaLineAndNotLeftChecked(fibulaLine,notLeftFibulaChecked) 
-        fibulaToWorldRotationMatrix = self.getAxes1ToWorldRotationMatrix(fibulaX, fibulaY, fibulaZ)
-
-        mandibleAxisToFibulaRotationMatrix = self.getAxes1ToAxes2RotationMatrix(mandibleAxisToWorldRotationMatrix, fibulaToWorldRotationMatrix)
-
-        mandiblePlane0ToIntersectionAxisTransform = vtk.vtkTransform()
-        mandiblePlane0ToIntersectionAxisTransform.PostMultiply()
-        mandiblePlane0ToIntersectionAxisTransform.Translate(-mandiblePlane0Origin[0], -mandiblePlane0Origin[1], -mandiblePlane0Origin[2])
-        mandiblePlane0ToIntersectionAxisTransform.Concatenate(mandibleAxisToFibulaRotationMatrix)
-        mandiblePlane0ToIntersectionAxisTransform.Translate(fibulaOrigin + fibulaZ*fibulaZLineNorm*intersectionPlaceOfFibulaPlanes)
-        mandiblePlane1ToIntersectionAxisTransform = vtk.vtkTransform()
-        mandiblePlane1ToIntersectionAxisTransform.PostMultiply()
-        mandiblePlane1ToIntersectionAxisTransform.Translate(-mandiblePlane1Origin[0], -mandiblePlane1Origin[1], -mandiblePlane1Origin[2])
-        mandiblePlane1ToIntersectionAxisTransform.Concatenate(mandibleAxisToFibulaRotationMatrix)
-        mandiblePlane1ToIntersectionAxisTransform.Translate(fibulaOrigin + fibulaZ*fibulaZLineNorm*intersectionPlaceOfFibulaPlanes)
-        
-        if i==0:
-          self.fibulaPlanesPositionA.append(fibulaOrigin + fibulaZ*initialSpace)
-          intersectionModelB = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d_B' % i)
-          intersectionModelB.CreateDefaultDisplayNodes()
-          self.getIntersectionBetweenModelAnd1TransformedPlane(fibulaModelNode, mandiblePlane1ToIntersectionAxisTransform, fibulaPlaneB, intersectionModelB)
-          intersectionsList.append(intersectionModelB)
-          intersectionsList[j].SetAndObserveTransformNodeID(intersectionsTransformNode.GetID())
-          
-          intersectionModelBItemID = shNode.GetItemByDataNode(intersectionModelB)
-          shNode.SetItemParent(intersectionModelBItemID, intersectionsFolder)
-
-        else:
-          bounds0 = [0,0,0,0,0,0]
-          bounds1 = [0,0,0,0,0,0]
-          if i!=(len(planeList)-2):
-            intersectionModelA = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d_A' % i)
-            intersectionModelA.CreateDefaultDisplayNodes()
-            self.getIntersectionBetweenModelAnd1TransformedPlane(fibulaModelNode, mandiblePlane0ToIntersectionAxisTransform, fibulaPlaneA, intersectionModelA)
-            intersectionsList.append(intersectionModelA)
-            intersectionModelAItemID = shNode.GetItemByDataNode(intersectionModelA)
-            shNode.SetItemParent(intersectionModelAItemID, intersectionsFolder)
-            j=j+1
-            intersectionModelB = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d_B' % i)
-            intersectionModelB.CreateDefaultDisplayNodes()
-            self.getIntersectionBetweenModelAnd1TransformedPlane(fibulaModelNode, mandiblePlane1ToIntersectionAxisTransform, fibulaPlaneB, intersectionModelB)
-            intersectionsList.append(intersectionModelB)
-            intersectionModelBItemID = shNode.GetItemByDataNode(intersectionModelB)
-            shNode.SetItemParent(intersectionModelBItemID, intersectionsFolder)
-            j=j+1
-            intersectionsList[j-1].SetAndObserveTransformNodeID(intersectionsTransformNode.GetID())
-            intersectionsList[j].SetAndObserveTransformNodeID(intersectionsTransformNode.GetID())
-            intersectionsList[j-2].GetRASBounds(bounds0)
-            intersectionsList[(j-2)+1].GetRASBounds(bounds1)
-          else:
-            intersectionModelA = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d_A' % i)
-            intersectionModelA.CreateDefaultDisplayNodes()
-            self.getIntersectionBetweenModelAnd1TransformedPlane(fibulaModelNode, mandiblePlane0ToIntersectionAxisTransform, fibulaPlaneA, intersectionModelA)
-            intersectionsList.append(intersectionModelA)
-            intersectionModelAItemID = shNode.GetItemByDataNode(intersectionModelA)
-            shNode.SetItemParent(intersectionModelAItemID, intersectionsFolder)
-            j=j+1
-            intersectionsList[j].SetAndObserveTransformNodeID(intersectionsTransformNode.GetID())
-            intersectionsList[j-1].GetRASBounds(bounds0)
-            intersectionsList[j].GetRASBounds(bounds1)
-
-          #calculate how much each FibulaPlaneA should be translated so that it doesn't intersect with fibulaPlaneB
-          z0Sup = bounds0[5]
-          z0Inf = bounds0[4]
-          z1Sup = bounds1[5]
-          z1Inf = bounds1[4]
-          deltaZ = (z0Sup - z0Inf)/2 + (z1Sup - z1Inf)/2
-
-          betweenSpace.append(deltaZ)
-
-          self.fibulaPlanesPositionA.append(self.fibulaPlanesPositionB[i-1] + fibulaZ*(intersectionDistanceMultiplier*betweenSpace[i-1]+additionalBetweenSpaceOfFibulaPlanes))
-
-        self.fibulaPlanesPositionB.append(self.fibulaPlanesPositionA[i] + boneSegmentsDistance[i]*fibulaZ)
-
-        if not useMoreExactVersionOfPositioningAlgorithmChecked:
-          self.mandibleAxisToFibulaRotationMatrixesList.append(mandibleAxisToFibulaRotationMatrix)
-        else:
-          intersectionsForCentroidCalculationFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Intersections For Centroid Calculation")
-
-          lineStartPos = self.fibulaPlanesPositionA.pop()
-          lineEndPos = self.fibulaPlanesPositionB.pop()
-
-          numberOfRepetitionsOfPositioningAlgorithm = 5
-          for k in range(numberOfRepetitionsOfPositioningAlgorithm):
-            oldLineStartPos = lineStartPos
-            oldLineEndPos = lineEndPos
-
-            fibulaLineNorm = np.linalg.norm(lineEndPos-lineStartPos)
-            fibulaLineDirection = (lineEndPos-lineStartPos)/fibulaLineNorm
-
-            intersectionA = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection A %d' % i)
-            intersectionB = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection B %d' % i)
-            intersectionA.CreateDefaultDisplayNodes()
-            intersectionB.CreateDefaultDisplayNodes()
-            
-            intersectionAModelItemID = shNode.GetItemByDataNode(intersectionA)
-            shNode.SetItemParent(intersectionAModelItemID, intersectionsForCentroidCalculationFolder)
-            intersectionBModelItemID = shNode.GetItemByDataNode(intersectionB)
-            shNode.SetItemParent(intersectionBModelItemID, intersectionsForCentroidCalculationFolder)
-            
-            self.getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin_2(fibulaModelNode,fibulaLineDirection,lineStartPos,intersectionA)
-            self.getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin_2(fibulaModelNode,fibulaLineDirection,lineEndPos,intersectionB)
-            lineStartPos = self.getCentroid(intersectionA)
-            lineEndPos = self.getCentroid(intersectionB)
-
-            #Create fibula axis:
-            fibulaX, fibulaY, fibulaZ, fibulaOrigin = self.createFibulaAxisFromFibulaLineAndNotLeftChecked_2(lineStartPos,lineEndPos,notLeftFibulaChecked)
-            
-            lineEndPos = lineStartPos + boneSegmentsDistance[i]*fibulaZ
-
-            error = np.linalg.norm(lineStartPos-oldLineStartPos) + np.linalg.norm(lineEndPos-oldLineEndPos)
-            if error < 0.01:# Unavoidable errors because of fibula bone shape are about 0.6-0.8mm
-              break
-          
-          fibulaToWorldRotationMatrix = self.getAxes1ToWorldRotationMatrix(fibulaX, fibulaY, fibulaZ)
-          mandibleAxisToFibulaRotationMatrix = self.getAxes1ToAxes2RotationMatrix(mandibleAxisToWorldRotationMatrix, fibulaToWorldRotationMatrix)
-          self.mandibleAxisToFibulaRotationMatrixesList.append(mandibleAxisToFibulaRotationMatrix)
-
-          self.fibulaPlanesPositionA.append(lineStartPos)
-          self.fibulaPlanesPositionB.append(lineEndPos)
-
-          shNode.RemoveItem(intersectionsForCentroidCalculationFolder)
-
-        mandiblePlane0ToFibulaPlaneATransformNode = slicer.vtkMRMLLinearTransformNode()
-        mandiblePlane0ToFibulaPlaneATransformNode.SetName("Mandible2Fibula Transform%d_A" % i)
-        slicer.mrmlScene.AddNode(mandiblePlane0ToFibulaPlaneATransformNode)
-        mandiblePlane1ToFibulaPlaneBTransformNode = slicer.vtkMRMLLinearTransformNode()
-        mandiblePlane1ToFibulaPlaneBTransformNode.SetName("Mandible2Fibula Transform%d_B" % i)
-        slicer.mrmlScene.AddNode(mandiblePlane1ToFibulaPlaneBTransformNode)
-
-        mandiblePlane0ToFibulaPlaneATransform = vtk.vtkTransform()
-        mandiblePlane0ToFibulaPlaneATransform.PostMultiply()
-        mandiblePlane0ToFibulaPlaneATransform.Translate(-mandiblePlane0Origin[0], -mandiblePlane0Origin[1], -mandiblePlane0Origin[2])
-        mandiblePlane0ToFibulaPlaneATransform.Concatenate(mandibleAxisToFibulaRotationMatrix)
-        mandiblePlane0ToFibulaPlaneATransform.Translate(self.fibulaPlanesPositionA[i])
-
-        mandiblePlane0ToFibulaPlaneATransformNode.SetMatrixTransformToParent(mandiblePlane0ToFibulaPlaneATransform.GetMatrix())
-        mandiblePlane0ToFibulaPlaneATransformNode.UpdateScene(slicer.mrmlScene)
-
-
-        mandiblePlane1ToFibulaPlaneBTransform = vtk.vtkTransform()
-        mandiblePlane1ToFibulaPlaneBTransform.PostMultiply()
-        mandiblePlane1ToFibulaPlaneBTransform.Translate(-mandiblePlane1Origin[0], -mandiblePlane1Origin[1], -mandiblePlane1Origin[2])
-        mandiblePlane1ToFibulaPlaneBTransform.Concatenate(mandibleAxisToFibulaRotationMatrix)
-        mandiblePlane1ToFibulaPlaneBTransform.Translate(self.fibulaPlanesPositionB[i])
-
-        mandiblePlane1ToFibulaPlaneBTransformNode.SetMatrixTransformToParent(mandiblePlane1ToFibulaPlaneBTransform.GetMatrix())
-
-        mandiblePlane1ToFibulaPlaneBTransformNode.UpdateScene(slicer.mrmlScene)
-
-        fibulaPlaneA.SetAndObserveTransformNodeID(mandiblePlane0ToFibulaPlaneATransformNode.GetID())
-        fibulaPlaneB.SetAndObserveTransformNodeID(mandiblePlane1ToFibulaPlaneBTransformNode.GetID())
-        fibulaPlaneA.HardenTransform()
-        fibulaPlaneB.HardenTransform()
-
-        mandiblePlane0ToFibulaPlaneATransformNodeItemID = shNode.GetItemByDataNode(mandiblePlane0ToFibulaPlaneATransformNode)
-        shNode.SetItemParent(mandiblePlane0ToFibulaPlaneATransformNodeItemID, mandible2FibulaTransformsFolder)
-        mandiblePlane1ToFibulaPlaneBTransformNodeItemID = shNode.GetItemByDataNode(mandiblePlane1ToFibulaPlaneBTransformNode)
-        shNode.SetItemParent(mandiblePlane1ToFibulaPlaneBTransformNodeItemID, mandible2FibulaTransformsFolder)
-
-      shNode.RemoveItem(intersectionsFolder)
+      self.plan.computeFibulaPlanesPositions(
+        fibulaModelNode.GetPolyData(), initialSpace, intersectionPlaceOfFibulaPlanes, intersectionDistanceMultiplier,
+        additionalBetweenSpaceOfFibulaPlanes, useMoreExactVersionOfPositioningAlgorithmChecked, previousPlan,
+        self.getFibulaCrossSectionStack(fibulaModelNode.GetPolyData()), useVectorizedBetweenSpaceComputationChecked
+      )
+      if useMoreExactVersionOfPositioningAlgorithmChecked:
+        logging.info('Positioning algorithm iterations: {0}, residuals (mm): {1}'.format(
+          self.plan.positioningIterations.tolist(), np.round(self.plan.positioningResiduals, 4).tolist()))
 
       if useMoreExactVersionOfPositioningAlgorithmCheckBoxChanged:
         parameterNode.SetParameter("useMoreExactVersionOfPositioningAlgorithmCheckBoxChanged","False")
@@ -1358,149 +1602,61 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         parameterNode.SetParameter("fibulaPlanesCreationParametersChanged","False")
 
       if not mandiblePlanesOriginsAreTheSame:
-        curvePointsList = []
-        for mandiblePlaneIndex in range(len(planeList)):
-          mandiblePlaneOrigin = [0,0,0]
-          planeList[mandiblePlaneIndex].GetOrigin(mandiblePlaneOrigin)
-          curvePointsList.append(mandiblePlaneOrigin)
-        
-        points = vtk.vtkPoints()
-        curvePointsArray = np.array(curvePointsList)
-        vtkPointsData = vtk.util.numpy_support.numpy_to_vtk(curvePointsArray, deep=1)
-        points.SetNumberOfPoints(len(curvePointsArray))
-        points.SetData(vtkPointsData)
-        lastMandiblePlanesPositionCurve.SetControlPointPositionsWorld(points)
+        slicer.util.updateMarkupsControlPointsFromArray(lastMandiblePlanesPositionCurve, self.plan.mandiblePlanesOrigins)
 
       if not lastFibulaPlanesPositionsExistAndIsValid:
         #delete curve that is alone
         slicer.mrmlScene.RemoveNode(lastFibulaPlanesPositionA)
         slicer.mrmlScene.RemoveNode(lastFibulaPlanesPositionB)
-        lastFibulaPlanesPositionA = self.createCurveNodeFromListOfPointsAndName(self.fibulaPlanesPositionA,"lastFibulaPlanesPositionA")
-        lastFibulaPlanesPositionB = self.createCurveNodeFromListOfPointsAndName(self.fibulaPlanesPositionB,"lastFibulaPlanesPositionB")
+        lastFibulaPlanesPositionA = self.createCurveNodeFromListOfPointsAndName(self.plan.fibulaPlanesPositionA,"lastFibulaPlanesPositionA")
+        lastFibulaPlanesPositionB = self.createCurveNodeFromListOfPointsAndName(self.plan.fibulaPlanesPositionB,"lastFibulaPlanesPositionB")
         parameterNode.SetNodeReferenceID("lastFibulaPlanesPositionA",lastFibulaPlanesPositionA.GetID())
         parameterNode.SetNodeReferenceID("lastFibulaPlanesPositionB",lastFibulaPlanesPositionB.GetID())
       else:
-        curveNodes = [lastFibulaPlanesPositionA,lastFibulaPlanesPositionB]
-        pointLists = [self.fibulaPlanesPositionA,self.fibulaPlanesPositionB]
-        for i in range (len(curveNodes)):
-          points = vtk.vtkPoints()
-          curvePointsArray = np.array(pointLists[i])
-          vtkPointsData = vtk.util.numpy_support.numpy_to_vtk(curvePointsArray, deep=1)
-          points.SetNumberOfPoints(len(curvePointsArray))
-          points.SetData(vtkPointsData)
-          curveNodes[i].SetControlPointPositionsWorld(points)
+        slicer.util.updateMarkupsControlPointsFromArray(lastFibulaPlanesPositionA, self.plan.fibulaPlanesPositionA)
+        slicer.util.updateMarkupsControlPointsFromArray(lastFibulaPlanesPositionB, self.plan.fibulaPlanesPositionB)
     else:
-      #Create fibula axis:
-      fibulaX, fibulaY, fibulaZ, fibulaOrigin = self.createFibulaAxisFromFibulaLineAndNotLeftChecked(fibulaLine,notLeftFibulaChecked) 
-      
-      fibulaZLineNorm = self.getLineNorm(fibulaLine)
-
-      self.fibulaPlanesPositionA = []
-      self.fibulaPlanesPositionB = []
-
-      self.mandibleAxisToFibulaRotationMatrixesList = []
-      #Transform fibula planes to their final position-orientation
-      for i in range(len(planeList)-1):
-        mandiblePlane0 = planeList[i]
-        mandiblePlane1 = planeList[i+1]
-        mandiblePlane0X = [0,0,0]
-        mandiblePlane0Y = [0,0,0]
-        mandiblePlane0Z = [0,0,0]
-        mandiblePlane0.GetAxes(mandiblePlane0X,mandiblePlane0Y,mandiblePlane0Z)
-        mandiblePlane1X = [0,0,0]
-        mandiblePlane1Y = [0,0,0]
-        mandiblePlane1Z = [0,0,0]
-        mandiblePlane1.GetAxes(mandiblePlane1X,mandiblePlane1Y,mandiblePlane1Z)
-        mandiblePlane0Origin = [0,0,0]
-        mandiblePlane0.GetOrigin(mandiblePlane0Origin)
-        mandiblePlane1Origin = [0,0,0]
-        mandiblePlane1.GetOrigin(mandiblePlane1Origin)
-        fibulaPlaneA = fibulaPlanesList[2*i]
-        fibulaPlaneB = fibulaPlanesList[2*i+1]
-        fibulaPlaneA.SetAxes(mandiblePlane0X,mandiblePlane0Y,mandiblePlane0Z)
-        fibulaPlaneA.SetOrigin(mandiblePlane0Origin)
-        fibulaPlaneB.SetAxes(mandiblePlane1X,mandiblePlane1Y,mandiblePlane1Z)
-        fibulaPlaneB.SetOrigin(mandiblePlane1Origin)
-
-        #Create origin1-origin2 vector
-        or0 = np.zeros(3)
-        or1 = np.zeros(3)
-        mandiblePlane0.GetOrigin(or0)
-        mandiblePlane1.GetOrigin(or1)
-        mandibleAxisZ = (or1-or0)/np.linalg.norm(or1-or0)
-        
-        #Get Y component of mandiblePlane0
-        mandiblePlane0matrix = vtk.vtkMatrix4x4()
-        mandiblePlane0.GetPlaneToWorldMatrix(mandiblePlane0matrix)
-        mandiblePlane0Y = np.array([mandiblePlane0matrix.GetElement(0,1),mandiblePlane0matrix.GetElement(1,1),mandiblePlane0matrix.GetElement(2,1)])
-        
-        mandibleAxisX = [0,0,0]
-        vtk.vtkMath.Cross(mandiblePlane0Y, mandibleAxisZ, mandibleAxisX)
-        mandibleAxisX = mandibleAxisX/np.linalg.norm(mandibleAxisX)
-        mandibleAxisY = [0,0,0]
-        vtk.vtkMath.Cross(mandibleAxisZ, mandibleAxisX, mandibleAxisY)
-        mandibleAxisY = mandibleAxisY/np.linalg.norm(mandibleAxisY)
-
-        mandibleAxisToWorldRotationMatrix = self.getAxes1ToWorldRotationMatrix(mandibleAxisX, mandibleAxisY, mandibleAxisZ)
-        #Create fibula axis:
-        fibulaX, fibulaY, fibulaZ, fibulaOrigin = self.createFibulaAxisFromFibulaLineAndNotLeftChecked(fibulaLine,notLeftFibulaChecked) 
-        fibulaToWorldRotationMatrix = self.getAxes1ToWorldRotationMatrix(fibulaX, fibulaY, fibulaZ)
-
-        mandibleAxisToFibulaRotationMatrix = self.getAxes1ToAxes2RotationMatrix(mandibleAxisToWorldRotationMatrix, fibulaToWorldRotationMatrix)
-
-        fibulaPlaneAPosition = np.array([0,0,0])
-        fibulaPlaneBPosition = np.array([0,0,0])
-        lastFibulaPlanesPositionA.GetNthControlPointPosition(i,fibulaPlaneAPosition)
-        lastFibulaPlanesPositionB.GetNthControlPointPosition(i,fibulaPlaneBPosition)
-        self.fibulaPlanesPositionA.append(fibulaPlaneAPosition)
-        self.fibulaPlanesPositionB.append(fibulaPlaneBPosition)
-
-        if not useMoreExactVersionOfPositioningAlgorithmChecked:
-          self.mandibleAxisToFibulaRotationMatrixesList.append(mandibleAxisToFibulaRotationMatrix)
-        else:
-          #Create fibula axis:
-          fibulaX, fibulaY, fibulaZ, fibulaOrigin = self.createFibulaAxisFromFibulaLineAndNotLeftChecked_2(fibulaPlaneAPosition,fibulaPlaneBPosition,notLeftFibulaChecked)
-          
-          fibulaToWorldRotationMatrix = self.getAxes1ToWorldRotationMatrix(fibulaX, fibulaY, fibulaZ)
-          mandibleAxisToFibulaRotationMatrix = self.getAxes1ToAxes2RotationMatrix(mandibleAxisToWorldRotationMatrix, fibulaToWorldRotationMatrix)
-          self.mandibleAxisToFibulaRotationMatrixesList.append(mandibleAxisToFibulaRotationMatrix)
-
-        mandiblePlane0ToFibulaPlaneATransformNode = slicer.vtkMRMLLinearTransformNode()
-        mandiblePlane0ToFibulaPlaneATransformNode.SetName("Mandible2Fibula Transform%d_A" % i)
-        slicer.mrmlScene.AddNode(mandiblePlane0ToFibulaPlaneATransformNode)
-        mandiblePlane1ToFibulaPlaneBTransformNode = slicer.vtkMRMLLinearTransformNode()
-        mandiblePlane1ToFibulaPlaneBTransformNode.SetName("Mandible2Fibula Transform%d_B" % i)
-        slicer.mrmlScene.AddNode(mandiblePlane1ToFibulaPlaneBTransformNode)
-
-        mandiblePlane0ToFibulaPlaneATransform = vtk.vtkTransform()
-        mandiblePlane0ToFibulaPlaneATransform.PostMultiply()
-        mandiblePlane0ToFibulaPlaneATransform.Translate(-mandiblePlane0Origin[0], -mandiblePlane0Origin[1], -mandiblePlane0Origin[2])
-        mandiblePlane0ToFibulaPlaneATransform.Concatenate(mandibleAxisToFibulaRotationMatrix)
-        mandiblePlane0ToFibulaPlaneATransform.Translate(fibulaPlaneAPosition)
-
-        mandiblePlane0ToFibulaPlaneATransformNode.SetMatrixTransformToParent(mandiblePlane0ToFibulaPlaneATransform.GetMatrix())
-        mandiblePlane0ToFibulaPlaneATransformNode.UpdateScene(slicer.mrmlScene)
-
-
-        mandiblePlane1ToFibulaPlaneBTransform = vtk.vtkTransform()
-        mandiblePlane1ToFibulaPlaneBTransform.PostMultiply()
-        mandiblePlane1ToFibulaPlaneBTransform.Translate(-mandiblePlane1Origin[0], -mandiblePlane1Origin[1], -mandiblePlane1Origin[2])
-        mandiblePlane1ToFibulaPlaneBTransform.Concatenate(mandibleAxisToFibulaRotationMatrix)
-        mandiblePlane1ToFibulaPlaneBTransform.Translate(fibulaPlaneBPosition)
-
-        mandiblePlane1ToFibulaPlaneBTransformNode.SetMatrixTransformToParent(mandiblePlane1ToFibulaPlaneBTransform.GetMatrix())
-
-        mandiblePlane1ToFibulaPlaneBTransformNode.UpdateScene(slicer.mrmlScene)
-
-        fibulaPlaneA.SetAndObserveTransformNodeID(mandiblePlane0ToFibulaPlaneATransformNode.GetID())
-        fibulaPlaneB.SetAndObserveTransformNodeID(mandiblePlane1ToFibulaPlaneBTransformNode.GetID())
-        fibulaPlaneA.HardenTransform()
-        fibulaPlaneB.HardenTransform()
-
-        mandiblePlane0ToFibulaPlaneATransformNodeItemID = shNode.GetItemByDataNode(mandiblePlane0ToFibulaPlaneATransformNode)
-        shNode.SetItemParent(mandiblePlane0ToFibulaPlaneATransformNodeItemID, mandible2FibulaTransformsFolder)
-        mandiblePlane1ToFibulaPlaneBTransformNodeItemID = shNode.GetItemByDataNode(mandiblePlane1ToFibulaPlaneBTransformNode)
-        shNode.SetItemParent(mandiblePlane1ToFibulaPlaneBTransformNodeItemID, mandible2FibulaTransformsFolder)
+      self.plan.setFibulaPlanesPositions(
+        slicer.util.arrayFromMarkupsControlPoints(lastFibulaPlanesPositionA),
+        slicer.util.arrayFromMarkupsControlPoints(lastFibulaPlanesPositionB),
+        useMoreExactVersionOfPositioningAlgorithmChecked
+      )
+
+    #Transform fibula planes to their final position-orientation
+    self.plan.writeFibulaPlanesToNodes(fibulaPlanesList)
+
+  def addToPolyDataCache(self, cache, polyData, cachedObject, maximumNumberOfPolyData=4):
+    """Keep cachedObject for polyData, the objects of the least recently added polydata are dropped."""
+    polyDataKey = getPolyDataKey(polyData)
+    cache.pop(polyDataKey, None)
+    cache[polyDataKey] = cachedObject
+    while len(cache) > maximumNumberOfPolyData:
+      del cache[next(iter(cache))]
+
+  def getFibulaCrossSectionStack(self,fibulaPolyData,lineStartPos=None,lineEndPos=None):
+    #Sections are computed once per fibula model (and level of detail) and fibula line, the one of the plan by default
+    if lineStartPos is None or lineEndPos is None:
+      lineStartPos, lineEndPos = self.plan.fibulaLineStart, self.plan.fibulaLineEnd
+    fibulaCrossSectionStack = self.fibulaCrossSectionStacks.get(getPolyDataKey(fibulaPolyData))
+    if (fibulaCrossSectionStack is None or
+        not fibulaCrossSectionStack.isValidFor(fibulaPolyData, lineStartPos, lineEndPos, self.plan.notLeftFibula)):
+      fibulaCrossSectionStack = FibulaCrossSectionStack(fibulaPolyData, lineStartPos, lineEndPos, self.plan.notLeftFibula)
+    self.addToPolyDataCache(self.fibulaCrossSectionStacks, fibulaPolyData, fibulaCrossSectionStack)
+    return fibulaCrossSectionStack
+
+  def getFibulaSegmentsCutter(self,fibulaPolyData):
+    #Triangles are sorted along the fibula once per fibula model (and level of detail)
+    fibulaSegmentsCutter = self.fibulaSegmentsCutters.get(getPolyDataKey(fibulaPolyData))
+    if fibulaSegmentsCutter is None or not fibulaSegmentsCutter.isValidFor(fibulaPolyData):
+      fibulaSegmentsCutter = FibulaSegmentsCutter(fibulaPolyData)
+    self.addToPolyDataCache(self.fibulaSegmentsCutters, fibulaPolyData, fibulaSegmentsCutter)
+    return fibulaSegmentsCutter
+
+  def getMandibleCurveIndex(self,mandibleCurve):
+    #The curve points and frames are computed again only when the curve changes
+    if self.mandibleCurveIndex is None or not self.mandibleCurveIndex.isValidFor(mandibleCurve):
+      self.mandibleCurveIndex = MandibleCurveIndex(mandibleCurve)
+    return self.mandibleCurveIndex
 
   def createCurveNodeFromListOfPointsAndName(self,listOfPoints, name):
     curveNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsCurveNode")
@@ -1509,7 +1665,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     slicer.modules.markups.logic().AddNewDisplayNodeForMarkupsNode(curveNode)
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     curveNodeItemID = shNode.GetItemByDataNode(curveNode)
-    shNode.SetItemParent(curveNodeItemID, self.getParentFolderItemID())
+    self.setItemParent(curveNodeItemID, self.getParentFolderItemID())
     curveNode.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
     curveNode.SetLocked(True)
 
@@ -1526,7 +1682,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     return curveNode
   
   def createLastMandiblePlanesPositionCurve(self):
-    planeList = createListFromFolderID(self.getMandiblePlanesFolderItemID())
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
 
     curvePointsList = []
     for mandiblePlaneIndex in range(len(planeList)):
@@ -1541,7 +1697,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
   
   def createFibulaPlanesFromMandiblePlanesAndFibulaAxis(self,mandiblePlanesList,fibulaPlanesList):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
+    fibulaPlanesFolder = self.getFolderItemID("Fibula planes")
     for i in range(len(mandiblePlanesList)-1):
       mandiblePlane0 = mandiblePlanesList[i]
       mandiblePlane1 = mandiblePlanesList[i+1]
@@ -1566,7 +1722,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       displayNode.AddViewNodeID(fibulaViewNode.GetID())
 
       fibulaPlaneAItemID = shNode.GetItemByDataNode(fibulaPlaneA)
-      shNode.SetItemParent(fibulaPlaneAItemID, fibulaPlanesFolder)
+      self.setItemParent(fibulaPlaneAItemID, fibulaPlanesFolder)
 
       fibulaPlaneA.SetAxes(mandiblePlane0X,mandiblePlane0Y,mandiblePlane0Z)
       fibulaPlaneA.SetOrigin(mandiblePlane0Origin)
@@ -1581,7 +1737,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       displayNode.AddViewNodeID(fibulaViewNode.GetID())
 
       fibulaPlaneBItemID = shNode.GetItemByDataNode(fibulaPlaneB)
-      shNode.SetItemParent(fibulaPlaneBItemID, fibulaPlanesFolder)
+      self.setItemParent(fibulaPlaneBItemID, fibulaPlanesFolder)
 
       fibulaPlaneB.SetAxes(mandiblePlane1X,mandiblePlane1Y,mandiblePlane1Z)
       fibulaPlaneB.SetOrigin(mandiblePlane1Origin)
@@ -1640,48 +1796,40 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
           displayNode2 = fibulaPlanesList[2*i].GetDisplayNode()
           displayNode2.SetSelectedColor(color)
 
+  @runInTimingSpan
   def createAndUpdateDynamicModelerNodes(self):
     parameterNode = self.getParameterNode()
-    useNonDecimatedBoneModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedBoneModelsForPreview") == "True"
     mandibularCurve = parameterNode.GetNodeReference("mandibleCurve")
-    nonDecimatedFibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
-    decimatedFibulaModelNode = parameterNode.GetNodeReference("decimatedFibulaModelNode")
-    nonDecimatedMandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
-    decimatedMandibleModelNode = parameterNode.GetNodeReference("decimatedMandibleModelNode")
     fixCutGoesThroughTheMandibleTwiceCheckBoxChanged = parameterNode.GetParameter('fixCutGoesThroughTheMandibleTwiceCheckBoxChanged') == "True"
     fixCutGoesThroughTheMandibleTwiceChecked = parameterNode.GetParameter('fixCutGoesThroughTheMandibleTwice') == "True"
     planeToFixCutGoesThroughTheMandibleTwice = parameterNode.GetNodeReference("planeToFixCutGoesThroughTheMandibleTwice")
-    planeList = createListFromFolderID(self.getMandiblePlanesFolderItemID())
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
      
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-    fibulaPlanesList = createListFromFolderID(fibulaPlanesFolder)
+    fibulaPlanesFolder = self.getFolderItemID("Fibula planes")
+    fibulaPlanesList = self.getFolderChildrenDataNodes(fibulaPlanesFolder)
     
-    if useNonDecimatedBoneModelsForPreviewChecked:
-      nonDecimatedFibulaModelDisplayNode = nonDecimatedFibulaModelNode.GetDisplayNode()
-      nonDecimatedFibulaModelDisplayNode.SetVisibility(True)
-      decimatedFibulaModelDisplayNode = decimatedFibulaModelNode.GetDisplayNode()
-      decimatedFibulaModelDisplayNode.SetVisibility(False)
-
-      fibulaModelNode = nonDecimatedFibulaModelNode
-      mandibleModelNode = nonDecimatedMandibleModelNode
-    else:
-      nonDecimatedFibulaModelDisplayNode = nonDecimatedFibulaModelNode.GetDisplayNode()
-      nonDecimatedFibulaModelDisplayNode.SetVisibility(False)
-      decimatedFibulaModelDisplayNode = decimatedFibulaModelNode.GetDisplayNode()
-      decimatedFibulaModelDisplayNode.SetVisibility(True)
-
-      fibulaModelNode = decimatedFibulaModelNode
-      mandibleModelNode = decimatedMandibleModelNode
+    #Changing the level of detail changes the input models, all the bones are cut again then
+    fibulaModelNode = self.getPreviewBoneModelNode("fibula")
+    mandibleModelNode = self.getPreviewBoneModelNode("mandible")
+    self.setPreviewBoneModelVisibility("fibula", True)
 
-    planeCutsFolder = shNode.GetItemByName("Plane Cuts")
+    planeCutsFolder = self.getFolderItemID("Plane Cuts")
     if planeCutsFolder == 0 or fixCutGoesThroughTheMandibleTwiceCheckBoxChanged:
-      shNode.RemoveItem(planeCutsFolder)
-      cutBonesFolder = shNode.GetItemByName("Cut Bones")
-      shNode.RemoveItem(cutBonesFolder)
+      self.removeItem(planeCutsFolder)
+      cutBonesFolder = self.getFolderItemID("Cut Bones")
+      self.removeItem(cutBonesFolder)
       planeCutsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Plane Cuts")
       cutBonesFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Cut Bones")
 
+      #Determinate plane creation direction
+      planeOriginStart = np.array([0,0,0])
+      planeOriginEnd = np.array([0,0,0])
+      planeList[0].GetNthControlPointPosition(0,planeOriginStart)
+      planeList[len(planeList)-1].GetNthControlPointPosition(0,planeOriginEnd)
+      closestCurvePointIndexStart, closestCurvePointIndexEnd = self.getMandibleCurveIndex(mandibularCurve).getClosestPointsAlongCurve(
+        [planeOriginStart, planeOriginEnd])[0]
+
       for i in range(0,len(fibulaPlanesList),2):
         modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
         modelNode.SetName("Fibula Segment {0}A-{1}B".format(i//2,i//2))
@@ -1702,16 +1850,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         color = [colorwithalpha[0],colorwithalpha[1],colorwithalpha[2]]
         modelDisplayNode.SetColor(color)
 
-        #Determinate plane creation direction and set up dynamic modeler
-        planeOriginStart = np.array([0,0,0])
-        planeOriginEnd = np.array([0,0,0])
-        planeList[0].GetNthControlPointPosition(0,planeOriginStart)
-        planeList[len(planeList)-1].GetNthControlPointPosition(0,planeOriginEnd)
-        closestCurvePointStart = [0,0,0]
-        closestCurvePointEnd = [0,0,0]
-        closestCurvePointIndexStart = mandibularCurve.GetClosestPointPositionAlongCurveWorld(planeOriginStart,closestCurvePointStart)
-        closestCurvePointIndexEnd = mandibularCurve.GetClosestPointPositionAlongCurveWorld(planeOriginEnd,closestCurvePointEnd)
-
+        #Set up dynamic modeler
         dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
         dynamicModelerNode.SetToolName("Plane cut")
         dynamicModelerNode.SetNodeReferenceID("PlaneCut.InputModel", fibulaModelNode.GetID())
@@ -1726,9 +1865,9 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         #slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
         
         dynamicModelerNodeItemID = shNode.GetItemByDataNode(dynamicModelerNode)
-        shNode.SetItemParent(dynamicModelerNodeItemID, planeCutsFolder)
+        self.setItemParent(dynamicModelerNodeItemID, planeCutsFolder)
         modelNodeItemID = shNode.GetItemByDataNode(modelNode)
-        shNode.SetItemParent(modelNodeItemID, cutBonesFolder)
+        self.setItemParent(modelNodeItemID, cutBonesFolder)
       
       
       modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
@@ -1774,7 +1913,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         slicer.modules.markups.logic().AddNewDisplayNodeForMarkupsNode(planeToFixCutGoesThroughTheMandibleTwice)
         shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
         planeToFixCutGoesThroughTheMandibleTwiceItemID = shNode.GetItemByDataNode(planeToFixCutGoesThroughTheMandibleTwice)
-        shNode.SetItemParent(planeToFixCutGoesThroughTheMandibleTwiceItemID, self.getParentFolderItemID())
+        self.setItemParent(planeToFixCutGoesThroughTheMandibleTwiceItemID, self.getParentFolderItemID())
         parameterNode.SetNodeReferenceID("planeToFixCutGoesThroughTheMandibleTwice",planeToFixCutGoesThroughTheMandibleTwice.GetID())
 
         displayNode = planeToFixCutGoesThroughTheMandibleTwice.GetDisplayNode()
@@ -1799,73 +1938,85 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       dynamicModelerNode.SetAttribute("OperationType", "Difference")
 
       dynamicModelerNodeItemID = shNode.GetItemByDataNode(dynamicModelerNode)
-      shNode.SetItemParent(dynamicModelerNodeItemID, planeCutsFolder)
+      self.setItemParent(dynamicModelerNodeItemID, planeCutsFolder)
       modelNodeItemID = shNode.GetItemByDataNode(modelNode)
-      shNode.SetItemParent(modelNodeItemID, cutBonesFolder)
+      self.setItemParent(modelNodeItemID, cutBonesFolder)
 
       if fixCutGoesThroughTheMandibleTwiceCheckBoxChanged:
         parameterNode.SetParameter('fixCutGoesThroughTheMandibleTwiceCheckBoxChanged','False')
+
+      return True
     
     else:
-      dynamicModelerNodesList = createListFromFolderID(planeCutsFolder)
+      inputModelsChanged = False
+      dynamicModelerNodesList = self.getFolderChildrenDataNodes(planeCutsFolder)
       for i in range(len(dynamicModelerNodesList)):
         if i != (len(dynamicModelerNodesList) -1):
-          dynamicModelerNodesList[i].SetNodeReferenceID("PlaneCut.InputModel", fibulaModelNode.GetID())
+          inputModelNode = fibulaModelNode
         else:
-          dynamicModelerNodesList[i].SetNodeReferenceID("PlaneCut.InputModel", mandibleModelNode.GetID())
+          inputModelNode = mandibleModelNode
+        if dynamicModelerNodesList[i].GetNodeReferenceID("PlaneCut.InputModel") != inputModelNode.GetID():
+          dynamicModelerNodesList[i].SetNodeReferenceID("PlaneCut.InputModel", inputModelNode.GetID())
+          inputModelsChanged = True
+
+      return inputModelsChanged
 
+  @runInTimingSpan
   def generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandible(self):
     parameterNode = self.getParameterNode()
-    useNonDecimatedBoneModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedBoneModelsForPreview") == "True"
-    nonDecimatedMandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
-    decimatedMandibleModelNode = parameterNode.GetNodeReference("decimatedMandibleModelNode")
-    planeList = createListFromFolderID(self.getMandiblePlanesFolderItemID())
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
     
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-
-    if useNonDecimatedBoneModelsForPreviewChecked:
-      mandibleModelNode = nonDecimatedMandibleModelNode
-    else:
-      mandibleModelNode = decimatedMandibleModelNode
+    fibulaPlanesFolder = self.getFolderItemID("Fibula planes")
 
     #delete all folders because there is only one plane and show mandible model
     if len(planeList) <= 1:
-      shNode.RemoveItem(fibulaPlanesFolder)
-      planeCutsFolder = shNode.GetItemByName("Plane Cuts")
-      shNode.RemoveItem(planeCutsFolder)
-      cutBonesFolder = shNode.GetItemByName("Cut Bones")
-      shNode.RemoveItem(cutBonesFolder)
-      transformedFibulaPiecesFolder = shNode.GetItemByName("Transformed Fibula Pieces")
-      shNode.RemoveItem(transformedFibulaPiecesFolder)
-      mandibleDisplayNode = mandibleModelNode.GetDisplayNode()
-      mandibleDisplayNode.SetVisibility(True)
+      self.removeItem(fibulaPlanesFolder)
+      planeCutsFolder = self.getFolderItemID("Plane Cuts")
+      self.removeItem(planeCutsFolder)
+      cutBonesFolder = self.getFolderItemID("Cut Bones")
+      self.removeItem(cutBonesFolder)
+      transformedFibulaPiecesFolder = self.getFolderItemID("Transformed Fibula Pieces")
+      self.removeItem(transformedFibulaPiecesFolder)
+      self.setPreviewBoneModelVisibility("mandible", True)
       return
 
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-    fibulaPlanesList = createListFromFolderID(fibulaPlanesFolder)
+    fibulaPlanesFolder = self.getFolderItemID("Fibula planes")
+    fibulaPlanesList = self.getFolderChildrenDataNodes(fibulaPlanesFolder)
 
     #delete all the folders that are not updated
-    if (len(fibulaPlanesList) != (2*len(planeList) - 2)) or not fibulaPlanesFolder:
-      shNode.RemoveItem(fibulaPlanesFolder)
-      planeCutsFolder = shNode.GetItemByName("Plane Cuts")
-      shNode.RemoveItem(planeCutsFolder)
-      cutBonesFolder = shNode.GetItemByName("Cut Bones")
-      shNode.RemoveItem(cutBonesFolder)
-      transformedFibulaPiecesFolder = shNode.GetItemByName("Transformed Fibula Pieces")
-      shNode.RemoveItem(transformedFibulaPiecesFolder)
+    fibulaPlanesRecreated = (len(fibulaPlanesList) != (2*len(planeList) - 2)) or not fibulaPlanesFolder
+    if fibulaPlanesRecreated:
+      self.removeItem(fibulaPlanesFolder)
+      planeCutsFolder = self.getFolderItemID("Plane Cuts")
+      self.removeItem(planeCutsFolder)
+      cutBonesFolder = self.getFolderItemID("Cut Bones")
+      self.removeItem(cutBonesFolder)
+      #Transformed fibula pieces are pooled, tranformBonePiecesToMandible adjusts them to the new number of segments
       fibulaPlanesFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Fibula planes")
-      fibulaPlanesList = createListFromFolderID(fibulaPlanesFolder)
+      fibulaPlanesList = self.getFolderChildrenDataNodes(fibulaPlanesFolder)
       #Create fibula planes and set their size
       self.createFibulaPlanesFromMandiblePlanesAndFibulaAxis(planeList,fibulaPlanesList)
 
-    self.transformFibulaPlanes()
+    #Plane i only affects segments i-1 and i, compare against the last plan to only cut again what changed
+    previousPlan = self.plan.copy()
 
-    self.createAndUpdateDynamicModelerNodes()
+    self.transformFibulaPlanes(previousPlan)
+
+    cutNodesRecreated = self.createAndUpdateDynamicModelerNodes()
+
+    if fibulaPlanesRecreated or cutNodesRecreated:
+      segmentsToUpdate = None
+      updateResectedMandible = True
+    else:
+      segmentsToUpdate = self.plan.getSegmentsUpdate(previousPlan)
+      modifiedMandiblePlanes = self.plan.getModifiedMandiblePlanes(previousPlan)
+      updateResectedMandible = (0 in modifiedMandiblePlanes) or ((len(planeList)-1) in modifiedMandiblePlanes)
+      logging.info('Segments cut again: {0}'.format(segmentsToUpdate))
   
-    self.updateFibulaPieces()
+    self.updateFibulaPieces(segmentsToUpdate, updateResectedMandible)
 
-    self.tranformBonePiecesToMandible()
+    self.tranformBonePiecesToMandible(segmentsToUpdate)
 
     self.setRedSliceForDisplayNodes()
 
@@ -1888,12 +2039,12 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     centerOfScalarVolume = np.array([(bounds[0]+bounds[1])/2,(bounds[2]+bounds[3])/2,(bounds[4]+bounds[5])/2])
     
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-    cutBonesFolder = shNode.GetItemByName("Cut Bones")
-    transformedFibulaPiecesFolder = shNode.GetItemByName("Transformed Fibula Pieces")
-    fibulaPlanesList = createListFromFolderID(fibulaPlanesFolder)
-    cutBonesList = createListFromFolderID(cutBonesFolder)
-    transformedFibulaPiecesList = createListFromFolderID(transformedFibulaPiecesFolder)
+    fibulaPlanesFolder = self.getFolderItemID("Fibula planes")
+    cutBonesFolder = self.getFolderItemID("Cut Bones")
+    transformedFibulaPiecesFolder = self.getFolderItemID("Transformed Fibula Pieces")
+    fibulaPlanesList = self.getFolderChildrenDataNodes(fibulaPlanesFolder)
+    cutBonesList = self.getFolderChildrenDataNodes(cutBonesFolder)
+    transformedFibulaPiecesList = self.getFolderChildrenDataNodes(transformedFibulaPiecesFolder)
     redSliceNode = slicer.mrmlScene.GetSingletonNode("Red", "vtkMRMLSliceNode")
 
     if np.linalg.norm(fibulaCentroid-centerOfScalarVolume) < np.linalg.norm(mandibleCentroid-centerOfScalarVolume):
@@ -1942,7 +2093,17 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     return axes1ToAxes2RotationMatrix
 
-  def makeModels(self):
+  @runInTimingSpan
+  def makeModels(self, onCompleted=None, onProgress=None, waitForCompletion=False):
+    """Creates the fibula and mandible models from their segmentations. Every model is decimated to each triangle
+    budget of boneModelsTriangleBudgets by CLI runs in the background, all at the same time: onProgress(percent)
+    is called while they run and onCompleted(success) when all are finished and the parameter node references
+    are set. It can be stopped with cancelMakeModels.
+    The models are made in a new folder that replaces the "Segmentation Models" folder only when all the runs
+    succeeded, until then the previous models and their references are kept.
+    """
+    self.cancelMakeModels()
+
     layoutManager = slicer.app.layoutManager()
     layoutManager.setLayout(self.customLayoutId)
 
@@ -1951,64 +2112,73 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     parameterNode = self.getParameterNode()
     fibulaSegmentation = parameterNode.GetNodeReference("fibulaSegmentation")
     mandibularSegmentation = parameterNode.GetNodeReference("mandibularSegmentation")
-    useNonDecimatedBoneModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedBoneModelsForPreview") == "True"
+    triangleBudgets = self.getBoneModelsTriangleBudgets()
 
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    segmentationModelsFolder = shNode.GetItemByName("Segmentation Models")
-    if segmentationModelsFolder:
-      shNode.RemoveItem(segmentationModelsFolder)
-      segmentationModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Segmentation Models")
-    else:
-      segmentationModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Segmentation Models")
+    segmentationModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Segmentation Models (in progress)")
     fibulaModelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
     fibulaModelNode.SetName("fibula")
     mandibleModelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
     mandibleModelNode.SetName("mandible")
-    decimatedFibulaModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','decimatedFibula')
-    decimatedMandibleModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','decimatedMandible')
+    #One decimated model per triangle budget, from the finest to the coarsest
+    decimatedFibulaModelNodes = []
+    decimatedMandibleModelNodes = []
+    for j in range(len(triangleBudgets)):
+      suffix = str(j+1) if j > 0 else ""
+      decimatedFibulaModelNodes.append(slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','decimatedFibula'+suffix))
+      decimatedMandibleModelNodes.append(slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','decimatedMandible'+suffix))
     segmentations = [fibulaSegmentation,mandibularSegmentation]
     models = [fibulaModelNode,mandibleModelNode]
-    decimatedModels = [decimatedFibulaModelNode,decimatedMandibleModelNode]
+    decimatedModels = [decimatedFibulaModelNodes,decimatedMandibleModelNodes]
+    decimationParameters = {"triangleBudgets": triangleBudgets, "method": "FastQuadric"}
+    boneModelsCache = self.getBoneModelsCache()
+    cacheKeys = [None, None]
+    modelsReadFromCache = [False, False]
     for i in range(2):
       slicer.mrmlScene.AddNode(models[i])
       models[i].CreateDefaultDisplayNodes()
-      decimatedModels[i].CreateDefaultDisplayNodes()
+      for decimatedModel in decimatedModels[i]:
+        decimatedModel.CreateDefaultDisplayNodes()
 
       seg = segmentations[i]
-      seg.GetSegmentation().CreateRepresentation(slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName())
       segmentID = seg.GetSegmentation().GetNthSegmentID(0)
       segment = seg.GetSegmentation().GetSegment(segmentID)
       segDisplayNode = seg.GetDisplayNode()
       segDisplayNode.SetSegmentVisibility(segmentID,False)
 
-      logic = slicer.modules.segmentations.logic()
-      logic.ExportSegmentToRepresentationNode(segment, models[i])
+      cachedSurfaces = None
+      if boneModelsCache is not None:
+        cacheKeys[i] = self.getBoneModelsCacheKey(seg, segmentID, decimationParameters)
+        if cacheKeys[i] is not None:
+          cachedSurfaces = boneModelsCache.get(cacheKeys[i], len(triangleBudgets)+1)
+      if cachedSurfaces is not None:
+        #Same segment and parameters as a previous run, the closed surface conversion and the decimation are skipped
+        models[i].SetAndObservePolyData(cachedSurfaces[0])
+        models[i].GetDisplayNode().SetColor(segment.GetColor())
+        models[i].SetAndObserveTransformNodeID(seg.GetTransformNodeID())
+        for j in range(len(triangleBudgets)):
+          decimatedModels[i][j].SetAndObservePolyData(cachedSurfaces[j+1])
+          decimatedModels[i][j].SetAndObserveTransformNodeID(seg.GetTransformNodeID())
+        modelsReadFromCache[i] = True
+      else:
+        seg.GetSegmentation().CreateRepresentation(slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName())
+        logic = slicer.modules.segmentations.logic()
+        logic.ExportSegmentToRepresentationNode(segment, models[i])
 
       modelDisplayNode = models[i].GetDisplayNode()
 
-      decimatedModelDisplayNode = decimatedModels[i].GetDisplayNode()
-      decimatedModelDisplayNode.SetColor(models[i].GetDisplayNode().GetColor())
-
-      if useNonDecimatedBoneModelsForPreviewChecked:
-        modelDisplayNode.SetVisibility(True)
+      #Models are shown when they replace the previous ones
+      modelDisplayNode.SetVisibility(False)
+      for j in range(len(triangleBudgets)):
+        decimatedModelDisplayNode = decimatedModels[i][j].GetDisplayNode()
+        decimatedModelDisplayNode.SetColor(models[i].GetDisplayNode().GetColor())
         decimatedModelDisplayNode.SetVisibility(False)
-      else:
-        modelDisplayNode.SetVisibility(False)
-        decimatedModelDisplayNode.SetVisibility(True)
-
-      param = {
-              "inputModel": models[i],
-              "outputModel": decimatedModels[i],
-              "reductionFactor": 0.95,
-              "method": "FastQuadric"
-              }
-
-      slicer.cli.runSync(slicer.modules.decimation, parameters=param)
 
       modelNodeItemID = shNode.GetItemByDataNode(models[i])
-      shNode.SetItemParent(modelNodeItemID, segmentationModelsFolder)
-      decimatedModelNodeItemID = shNode.GetItemByDataNode(decimatedModels[i])
-      shNode.SetItemParent(decimatedModelNodeItemID, segmentationModelsFolder)
+      self.setItemParent(modelNodeItemID, segmentationModelsFolder)
+      for decimatedModel in decimatedModels[i]:
+        decimatedModelNodeItemID = shNode.GetItemByDataNode(decimatedModel)
+        self.setItemParent(decimatedModelNodeItemID, segmentationModelsFolder)
 
       if i==0:
         singletonTag = "2"
@@ -2018,7 +2188,8 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       cameraNode = slicer.modules.cameras.logic().GetViewActiveCameraNode(viewNode)
 
       modelDisplayNode.AddViewNodeID(viewNode.GetID())
-      decimatedModelDisplayNode.AddViewNodeID(viewNode.GetID())
+      for decimatedModel in decimatedModels[i]:
+        decimatedModel.GetDisplayNode().AddViewNodeID(viewNode.GetID())
 
       centroid = self.getCentroid(models[i])
       distanceMultiplier = 4
@@ -2039,92 +2210,304 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         parameterNode.SetParameter("mandibleCentroidY",str(centroid[1]))
         parameterNode.SetParameter("mandibleCentroidZ",str(centroid[2]))
 
-    parameterNode.SetNodeReferenceID("fibulaModelNode", fibulaModelNode.GetID())
-    parameterNode.SetNodeReferenceID("mandibleModelNode", mandibleModelNode.GetID())
-    parameterNode.SetNodeReferenceID("decimatedFibulaModelNode", decimatedFibulaModelNode.GetID())
-    parameterNode.SetNodeReferenceID("decimatedMandibleModelNode", decimatedMandibleModelNode.GetID())
+    #All decimations run at the same time, the models are only referenced by the parameter node once all are done
+    #Models read from the cache are already decimated
+    cliNodes = []
+    for i in range(2):
+      if modelsReadFromCache[i]:
+        continue
+      numberOfTriangles = max(models[i].GetPolyData().GetNumberOfCells(), 1)
+      for j in range(len(triangleBudgets)):
+        param = {
+                "inputModel": models[i],
+                "outputModel": decimatedModels[i][j],
+                "reductionFactor": min(max(1.0 - triangleBudgets[j]/numberOfTriangles, 0.0), 0.999),
+                "method": decimationParameters["method"]
+                }
+        cliNodes.append(slicer.cli.run(slicer.modules.decimation, None, param, wait_for_completion=waitForCompletion))
+        filterRunCounter.countRun("Decimation")
+
+    state = {
+      "cliNodes": cliNodes,
+      "models": models,
+      "decimatedModels": decimatedModels,
+      "segmentationModelsFolder": segmentationModelsFolder,
+      "cacheKeys": [cacheKeys[i] if not modelsReadFromCache[i] else None for i in range(2)],
+      "onCompleted": onCompleted,
+      "onProgress": onProgress,
+      "startTime": time.time(),
+    }
+    #Each run observes its own CLI nodes so a cancelled run that finishes late does not affect a newer one
+    onCliNodeModified = functools.partial(self.onMakeModelsCliNodeModified, state)
+    for cliNode in cliNodes:
+      self.cliNodeObservers.addObserver(cliNode, vtk.vtkCommand.ModifiedEvent, onCliNodeModified)
+    state["observingCliNodes"] = True
+    self.makeModelsState = state
+    self.onMakeModelsCliNodeModified(state, None, None)
+
+  def onMakeModelsCliNodeModified(self, state, caller, event):
+    if not state.get("observingCliNodes"):
+      return
+    cliNodes = state["cliNodes"]
+    if state["onProgress"]:
+      state["onProgress"](int(sum(cliNode.GetProgress() if cliNode.IsBusy() else 100 for cliNode in cliNodes)/max(len(cliNodes), 1)))
+    if any(cliNode.IsBusy() for cliNode in cliNodes):
+      return
+
+    if self.makeModelsState is state:
+      self.makeModelsState = None
+    success = all(cliNode.GetStatus() == cliNode.Completed for cliNode in cliNodes)
+    state["observingCliNodes"] = False
+    for cliNode in cliNodes:
+      self.cliNodeObservers.removeObservers(cliNode.GetID())
+      if not success:
+        logging.warning('Decimation of bone models ended with status: {0}'.format(cliNode.GetStatusString()))
+      slicer.mrmlScene.RemoveNode(cliNode)
 
-  def updateFibulaPieces(self):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    planeCutsList = createListFromFolderID(shNode.GetItemByName("Plane Cuts"))
-    for i in range(len(planeCutsList)):
-      slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(planeCutsList[i])
+    if success:
+      parameterNode = self.getParameterNode()
+      #The new models replace the previous ones
+      previousSegmentationModelsFolder = self.getFolderItemID("Segmentation Models")
+      if previousSegmentationModelsFolder:
+        self.removeItem(previousSegmentationModelsFolder)
+      shNode.SetItemName(state["segmentationModelsFolder"], "Segmentation Models")
+
+      #The preview starts at full resolution with automatic level of detail
+      showNonDecimatedModel = (parameterNode.GetParameter("useNonDecimatedBoneModelsForPreview") == "True"
+        or parameterNode.GetParameter("useAutomaticLevelOfDetail") == "True")
+      for i in range(2):
+        state["models"][i].GetDisplayNode().SetVisibility(showNonDecimatedModel)
+        for j in range(len(state["decimatedModels"][i])):
+          state["decimatedModels"][i][j].GetDisplayNode().SetVisibility(j == 0 and not showNonDecimatedModel)
+
+      fibulaModelNode, mandibleModelNode = state["models"]
+      decimatedFibulaModelNodes, decimatedMandibleModelNodes = state["decimatedModels"]
+      parameterNode.SetNodeReferenceID("fibulaModelNode", fibulaModelNode.GetID())
+      parameterNode.SetNodeReferenceID("mandibleModelNode", mandibleModelNode.GetID())
+      parameterNode.SetNodeReferenceID("decimatedFibulaModelNode", decimatedFibulaModelNodes[0].GetID())
+      parameterNode.SetNodeReferenceID("decimatedMandibleModelNode", decimatedMandibleModelNodes[0].GetID())
+      for boneName, decimatedModelNodes in [("fibula", decimatedFibulaModelNodes), ("mandible", decimatedMandibleModelNodes)]:
+        parameterNode.RemoveNodeReferenceIDs(boneName+"LevelsOfDetail")
+        for decimatedModelNode in decimatedModelNodes:
+          parameterNode.AddNodeReferenceID(boneName+"LevelsOfDetail", decimatedModelNode.GetID())
+      boneModelsCache = self.getBoneModelsCache()
+      for i in range(2):
+        if boneModelsCache is not None and state["cacheKeys"][i] is not None:
+          boneModelsCache.put(state["cacheKeys"][i],
+            [state["models"][i].GetPolyData()] + [decimatedModel.GetPolyData() for decimatedModel in state["decimatedModels"][i]])
+      logging.info('Bone models created in {0:.2f} seconds'.format(time.time()-state["startTime"]))
+    else:
+      #Models of a cancelled or failed run are not left half done in the scene, the previous ones are kept
+      if shNode.GetItemName(state["segmentationModelsFolder"]) != "":
+        self.removeItem(state["segmentationModelsFolder"])
 
-  def tranformBonePiecesToMandible(self):
+    if state["onCompleted"]:
+      state["onCompleted"](success)
+
+  def getBoneModelsTriangleBudgets(self):
+    """Number of triangles of each decimated bone model, from the finest to the coarsest."""
     parameterNode = self.getParameterNode()
-    fibulaLine = parameterNode.GetNodeReference("fibulaLine")
-    planeList = createListFromFolderID(self.getMandiblePlanesFolderItemID())
+    triangleBudgets = []
+    for value in parameterNode.GetParameter("boneModelsTriangleBudgets").split(","):
+      try:
+        triangleBudgets.append(int(float(value)))
+      except ValueError:
+        pass
+    triangleBudgets = sorted(set(triangleBudget for triangleBudget in triangleBudgets if triangleBudget > 0), reverse=True)
+    if len(triangleBudgets) == 0:
+      triangleBudgets = [100000]
+    return triangleBudgets
+
+  def getBoneModelLevelsOfDetail(self, boneName):
+    """Models of the bone ("fibula" or "mandible") from the full resolution one to the coarsest decimated one."""
+    parameterNode = self.getParameterNode()
+    levelsOfDetail = [parameterNode.GetNodeReference(boneName+"ModelNode")]
+    referenceRole = boneName+"LevelsOfDetail"
+    if parameterNode.GetNumberOfNodeReferences(referenceRole) > 0:
+      levelsOfDetail += [parameterNode.GetNthNodeReference(referenceRole, i) for i in range(parameterNode.GetNumberOfNodeReferences(referenceRole))]
+    else:
+      #Scenes saved before the levels of detail have only one decimated model
+      levelsOfDetail.append(parameterNode.GetNodeReference("decimated"+boneName[0].upper()+boneName[1:]+"ModelNode"))
+    return [modelNode for modelNode in levelsOfDetail if modelNode is not None]
 
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    bonePiecesTransformFolder = shNode.GetItemByName("Bone Pieces Transforms")
-    shNode.RemoveItem(bonePiecesTransformFolder)
-    bonePiecesTransformFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Bone Pieces Transforms")
-    transformedFibulaPiecesFolder = shNode.GetItemByName("Transformed Fibula Pieces")
-    shNode.RemoveItem(transformedFibulaPiecesFolder)
-    transformedFibulaPiecesFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Transformed Fibula Pieces")
+  def getPreviewBoneModelNode(self, boneName):
+    """Model of the bone the preview of the reconstruction is computed from. With automatic level of detail it is the
+    coarsest model while a mandible plane is dragged and the full resolution model otherwise.
+    """
+    parameterNode = self.getParameterNode()
+    levelsOfDetail = self.getBoneModelLevelsOfDetail(boneName)
+    if parameterNode.GetParameter("useAutomaticLevelOfDetail") == "True":
+      return levelsOfDetail[-1] if self.mandiblePlanesInteractionInProgress else levelsOfDetail[0]
+    if parameterNode.GetParameter("useNonDecimatedBoneModelsForPreview") == "True" or len(levelsOfDetail) == 1:
+      return levelsOfDetail[0]
+    return levelsOfDetail[1]
+
+  def setPreviewBoneModelVisibility(self, boneName, visible):
+    previewModelNode = self.getPreviewBoneModelNode(boneName)
+    for modelNode in self.getBoneModelLevelsOfDetail(boneName):
+      modelNode.GetDisplayNode().SetVisibility(visible and modelNode is previewModelNode)
+
+  def updateReconstructionAtFullResolution(self):
+    """Cut the bones again if the last update was computed from a coarser level of detail than the one used
+    at rest, so that the exported results are not degraded by the interaction.
+    """
+    self.mandiblePlanesInteractionInProgress = False
+    planeCutsList = self.getFolderChildrenDataNodes(self.getFolderItemID("Plane Cuts"))
+    if len(planeCutsList) == 0:
+      return
+    if self.planningWorker.isBusy():
+      #The pending background result may be at a coarser level of detail, compute it here instead
+      self.cancelBackgroundPlanning()
+      self.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandible()
+      return
+    previewModelNodesIDs = [self.getPreviewBoneModelNode("fibula").GetID(), self.getPreviewBoneModelNode("mandible").GetID()]
+    if any(planeCutNode.GetNodeReferenceID("PlaneCut.InputModel") not in previewModelNodesIDs for planeCutNode in planeCutsList):
+      self.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandible()
 
-    lineStartPos = np.zeros(3)
-    lineEndPos = np.zeros(3)
-    fibulaLine.GetNthControlPointPositionWorld(0, lineStartPos)
-    fibulaLine.GetNthControlPointPositionWorld(1, lineEndPos)
-    fibulaOrigin = lineStartPos
-    fibulaZ = (lineEndPos-lineStartPos)/np.linalg.norm(lineEndPos-lineStartPos)
+  def getBoneModelsCache(self):
+    """Cache of the bone models in the Slicer cache folder, None if it is disabled."""
+    parameterNode = self.getParameterNode()
+    if parameterNode.GetParameter("useBoneModelsCache") != "True":
+      return None
+    maximumSize = int(float(parameterNode.GetParameter("boneModelsCacheSize") or 2000))*2**20
+    if self.boneModelsCache is None:
+      cacheDirectory = os.path.join(slicer.app.cachePath, "BoneReconstructionPlanner", "BoneModels")
+      try:
+        self.boneModelsCache = PolyDataDiskCache(cacheDirectory, maximumSize)
+      except OSError as e:
+        logging.warning('Bone models cache could not be created in {0}: {1}'.format(cacheDirectory, e))
+        return None
+    self.boneModelsCache.maximumSize = maximumSize
+    return self.boneModelsCache
+
+  def getBoneModelsCacheKey(self, segmentationNode, segmentID, decimationParameters):
+    """Hash of the binary labelmap of the segment, its geometry and the conversion and decimation parameters.
+    None if the source representation of the segmentation is not a binary labelmap.
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    binaryLabelmapName = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+    if hasattr(segmentation, "GetSourceRepresentationName"):
+      sourceRepresentationName = segmentation.GetSourceRepresentationName()
+    else:
+      sourceRepresentationName = segmentation.GetMasterRepresentationName()
+    if sourceRepresentationName != binaryLabelmapName:
+      return None
+    segment = segmentation.GetSegment(segmentID)
+    labelmap = segment.GetRepresentation(binaryLabelmapName)
+    if labelmap is None or labelmap.GetPointData().GetScalars() is None:
+      return None
+    imageToWorldMatrix = vtk.vtkMatrix4x4()
+    labelmap.GetImageToWorldMatrix(imageToWorldMatrix)
+    return PolyDataDiskCache.getKey(
+      vtk.util.numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()),
+      labelmap.GetExtent(),
+      slicer.util.arrayFromVTKMatrix(imageToWorldMatrix),
+      segment.GetLabelValue(),
+      segmentation.SerializeAllConversionParameters(),
+      sorted(decimationParameters.items())
+    )
+
+  def cancelMakeModels(self):
+    if self.makeModelsState is None:
+      return
+    for cliNode in self.makeModelsState["cliNodes"]:
+      if cliNode.IsBusy():
+        cliNode.Cancel()
 
-    cutBonesList = createListFromFolderID(shNode.GetItemByName("Cut Bones"))
-    for i in range(len(cutBonesList)-1):
+  @runInTimingSpan
+  def updateFibulaPieces(self,segmentsToUpdate=None,updateResectedMandible=True):
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    planeCutsList = self.getFolderChildrenDataNodes(self.getFolderItemID("Plane Cuts"))
+    if segmentsToUpdate is None:
+      self.cutFibulaSegments(planeCutsList[:-1])
+      with self.timingSpans.span("RunDynamicModelerTool", args={"tool": planeCutsList[len(planeCutsList)-1].GetName()}):
+        slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(planeCutsList[len(planeCutsList)-1])
+        filterRunCounter.countRun("DynamicModeler")
+      return
 
-      or0 = np.zeros(3)
-      planeList[i].GetOrigin(or0)
-      or1 = np.zeros(3)
-      planeList[i+1].GetOrigin(or1)
-      origin = (or0+or1)/2
+    self.cutFibulaSegments([planeCutsList[i] for i in segmentsToUpdate])
 
-      inverseRotationMatrix = vtk.vtkMatrix4x4()
-      inverseRotationMatrix.DeepCopy(self.mandibleAxisToFibulaRotationMatrixesList[i])
-      inverseRotationMatrix.Invert()
+    if updateResectedMandible:
+      with self.timingSpans.span("RunDynamicModelerTool", args={"tool": planeCutsList[len(planeCutsList)-1].GetName()}):
+        slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(planeCutsList[len(planeCutsList)-1])
+        filterRunCounter.countRun("DynamicModeler")
 
-      fibulaPieceToMandibleAxisTransformNode = slicer.vtkMRMLLinearTransformNode()
-      fibulaPieceToMandibleAxisTransformNode.SetName("Fibula Segment {0} Transform".format(i))
-      slicer.mrmlScene.AddNode(fibulaPieceToMandibleAxisTransformNode)
+  @runInTimingSpan
+  def cutFibulaSegments(self,planeCutsList):
+    parameterNode = self.getParameterNode()
+    useSinglePassFibulaSlicingChecked = parameterNode.GetParameter("useSinglePassFibulaSlicing") == "True"
+    numberOfWorkerThreads = int(parameterNode.GetParameter("numberOfWorkerThreads") or 1)
+    if not useSinglePassFibulaSlicingChecked or len(planeCutsList) == 0:
+      for i in range(len(planeCutsList)):
+        with self.timingSpans.span("RunDynamicModelerTool", args={"tool": planeCutsList[i].GetName()}):
+          slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(planeCutsList[i])
+          filterRunCounter.countRun("DynamicModeler")
+      return
 
-      oldOrigin = (self.fibulaPlanesPositionA[i] + self.fibulaPlanesPositionB[i])/2
+    #All segments are cut in one pass over the fibula triangles using the planes and models of the plane cut nodes.
+    #Segments are cut on worker threads, output models are only modified here on the main thread
+    fibulaModelNode = planeCutsList[0].GetNodeReference("PlaneCut.InputModel")
+    segmentsPlanesOrigins = []
+    segmentsPlanesNormals = []
+    for i in range(len(planeCutsList)):
+      planesOrigins = np.zeros((2,3))
+      planesNormals = np.zeros((2,3))
+      for j in range(2):
+        planeNode = planeCutsList[i].GetNthNodeReference("PlaneCut.InputPlane", j)
+        planeNode.GetOrigin(planesOrigins[j])
+        planeNode.GetNormal(planesNormals[j])
+      segmentsPlanesOrigins.append(planesOrigins)
+      segmentsPlanesNormals.append(planesNormals)
+
+    segmentsPolyData = self.getFibulaSegmentsCutter(fibulaModelNode.GetPolyData()).cutSegmentsBetweenPlanes(
+      segmentsPlanesOrigins, segmentsPlanesNormals, numberOfWorkerThreads)
+    for i in range(len(planeCutsList)):
+      planeCutsList[i].GetNodeReference("PlaneCut.OutputNegativeModel").SetAndObservePolyData(segmentsPolyData[i])
+
+  @runInTimingSpan
+  def tranformBonePiecesToMandible(self,segmentsToUpdate=None):
+    fibulaPieceToMandibleAxisTransforms = self.plan.getFibulaPiecesToMandibleTransforms()
+    cutBonesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Cut Bones"))
+
+    bonePiecesTransformFolder = self.getFolderItemID("Bone Pieces Transforms")
+    transformedFibulaPiecesFolder = self.getFolderItemID("Transformed Fibula Pieces")
+    if segmentsToUpdate is not None and bonePiecesTransformFolder and transformedFibulaPiecesFolder:
+      bonePiecesTransformsList = self.getFolderChildrenDataNodes(bonePiecesTransformFolder)
+      transformedFibulaPiecesList = self.getFolderChildrenDataNodes(transformedFibulaPiecesFolder)
+      if len(bonePiecesTransformsList) == len(transformedFibulaPiecesList) == (len(cutBonesList)-1):
+        for i in range(len(bonePiecesTransformsList)):
+          slicer.util.updateTransformMatrixFromArray(bonePiecesTransformsList[i], fibulaPieceToMandibleAxisTransforms[i])
+        #Pieces that were not cut again keep the same position on the mandible, only the cut again ones change
+        for i in segmentsToUpdate:
+          transformedFibulaPiecesList[i].SetAndObservePolyData(transformPolyData(cutBonesList[i].GetPolyData(), bonePiecesTransformsList[i].GetTransformToParent()))
+        return
 
-      fibulaPieceToMandibleAxisTransform = vtk.vtkTransform()
-      fibulaPieceToMandibleAxisTransform.PostMultiply()
-      fibulaPieceToMandibleAxisTransform.Translate(-oldOrigin[0],-oldOrigin[1],-oldOrigin[2])
-      fibulaPieceToMandibleAxisTransform.Concatenate(inverseRotationMatrix)
-      fibulaPieceToMandibleAxisTransform.Translate(origin)
+    #Transforms and transformed pieces of a previous plan are reused, only their matrices and polydata change
+    bonePiecesTransformsList = self.getPooledFolderNodes("Bone Pieces Transforms", "vtkMRMLLinearTransformNode",
+      ["Fibula Segment {0} Transform".format(i) for i in range(len(cutBonesList)-1)])
+    transformedFibulaPiecesList = self.getPooledFolderNodes("Transformed Fibula Pieces", "vtkMRMLModelNode",
+      ['Transformed ' + cutBonesList[i].GetName() for i in range(len(cutBonesList)-1)])
+    mandibleViewNode = slicer.mrmlScene.GetSingletonNode("1", "vtkMRMLViewNode")
 
-      fibulaPieceToMandibleAxisTransformNode.SetMatrixTransformToParent(fibulaPieceToMandibleAxisTransform.GetMatrix())
-      fibulaPieceToMandibleAxisTransformNode.UpdateScene(slicer.mrmlScene)
+    for i in range(len(cutBonesList)-1):
+      slicer.util.updateTransformMatrixFromArray(bonePiecesTransformsList[i], fibulaPieceToMandibleAxisTransforms[i])
 
-      transformedFibulaPiece = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode',slicer.mrmlScene.GetUniqueNameByString('Transformed ' + cutBonesList[i].GetName()))
-      transformedFibulaPiece.CreateDefaultDisplayNodes()
-      transformedFibulaPiece.CopyContent(cutBonesList[i])
+      transformedFibulaPiece = transformedFibulaPiecesList[i]
+      transformedFibulaPiece.SetAndObservePolyData(transformPolyData(cutBonesList[i].GetPolyData(), bonePiecesTransformsList[i].GetTransformToParent()))
+      if transformedFibulaPiece.GetDisplayNode() is None:
+        transformedFibulaPiece.CreateDefaultDisplayNodes()
       transformedFibulaPieceDisplayNode = transformedFibulaPiece.GetDisplayNode()
       transformedFibulaPieceDisplayNode.SetColor(cutBonesList[i].GetDisplayNode().GetColor())
       transformedFibulaPieceDisplayNode.SetSliceIntersectionVisibility(True)
-
-      mandibleViewNode = slicer.mrmlScene.GetSingletonNode("1", "vtkMRMLViewNode")
       transformedFibulaPieceDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
 
-      transformedFibulaPiece.SetAndObserveTransformNodeID(fibulaPieceToMandibleAxisTransformNode.GetID())
-      transformedFibulaPiece.HardenTransform()
-
-      transformedFibulaPieceItemID = shNode.GetItemByDataNode(transformedFibulaPiece)
-      shNode.SetItemParent(transformedFibulaPieceItemID, transformedFibulaPiecesFolder)
-
-      fibulaPieceToMandibleAxisTransformNodeItemID = shNode.GetItemByDataNode(fibulaPieceToMandibleAxisTransformNode)
-      shNode.SetItemParent(fibulaPieceToMandibleAxisTransformNodeItemID, bonePiecesTransformFolder)
-
+  @runInTimingSpan
   def mandiblePlanesPositioningForMaximumBoneContact(self):
     parameterNode = self.getParameterNode()
     mandibularCurve = parameterNode.GetNodeReference("mandibleCurve")
-    planeList = createListFromFolderID(self.getMandiblePlanesFolderItemID())
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
 
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    mandiblePlaneTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Mandible Planes Transforms")
-    
     for i in range(0,len(planeList)-2):
       or0 = np.zeros(3)
       or1 = np.zeros(3)
@@ -2155,27 +2538,13 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
       mandiblePlane0ToMiddleAxisRotationMatrix = self.getAxes1ToAxes2RotationMatrix(mandibleAxisToWorldRotationMatrix, middleAxisToWorldRotationMatrix)
 
-      transformNode = slicer.vtkMRMLLinearTransformNode()
-      transformNode.SetName("temp%d" % (i+1))
-      slicer.mrmlScene.AddNode(transformNode)
-
       finalTransform = vtk.vtkTransform()
       finalTransform.PostMultiply()
       finalTransform.Translate(-or1[0], -or1[1], -or1[2])
       finalTransform.Concatenate(mandiblePlane0ToMiddleAxisRotationMatrix)
       finalTransform.Translate(or1)
 
-      transformNode.SetMatrixTransformToParent(finalTransform.GetMatrix())
-
-      transformNode.UpdateScene(slicer.mrmlScene)
-
-      planeList[i+1].SetAndObserveTransformNodeID(transformNode.GetID())
-      planeList[i+1].HardenTransform()
-      
-      transformNodeItemID = shNode.GetItemByDataNode(transformNode)
-      shNode.SetItemParent(transformNodeItemID, mandiblePlaneTransformsFolder)
-    
-    shNode.RemoveItem(mandiblePlaneTransformsFolder)
+      planeList[i+1].ApplyTransform(finalTransform)
   
   def getIntersectionBetweenModelAnd1TransformedPlane(self,modelNode,transform,planeNode,intersectionModel):
     plane = vtk.vtkPlane()
@@ -2194,6 +2563,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     cutter.SetInputData(modelNode.GetPolyData())
     cutter.SetCutFunction(plane)
     cutter.Update()
+    filterRunCounter.countRun("vtkCutter")
 
     intersectionModel.SetAndObservePolyData(cutter.GetOutput())
 
@@ -2210,6 +2580,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     cutter.SetInputData(modelNode.GetPolyData())
     cutter.SetCutFunction(plane)
     cutter.Update()
+    filterRunCounter.countRun("vtkCutter")
 
     intersectionModel.SetAndObservePolyData(cutter.GetOutput())
 
@@ -2226,12 +2597,14 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     cutter.SetInputData(modelNode.GetPolyData())
     cutter.SetCutFunction(plane)
     cutter.Update()
+    filterRunCounter.countRun("vtkCutter")
 
     connectivityFilter = vtk.vtkConnectivityFilter()
     connectivityFilter.SetInputData(cutter.GetOutput())
     connectivityFilter.SetClosestPoint(origin)
     connectivityFilter.SetExtractionModeToClosestPointRegion()
     connectivityFilter.Update()
+    filterRunCounter.countRun("vtkConnectivityFilter")
 
     intersectionModel.SetAndObservePolyData(connectivityFilter.GetOutput())
 
@@ -2244,6 +2617,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     cutter.SetInputData(modelNode.GetPolyData())
     cutter.SetCutFunction(plane)
     cutter.Update()
+    filterRunCounter.countRun("vtkCutter")
 
     intersectionModel.SetAndObservePolyData(cutter.GetOutput())
 
@@ -2256,16 +2630,14 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     clipper.SetInputData(modelNode.GetPolyData())
     clipper.SetClipFunction(plane)
     clipper.Update()
+    filterRunCounter.countRun("vtkClipPolyData")
 
     intersectionModel.SetAndObservePolyData(clipper.GetOutput())
 
   def setupMandiblePlaneStraightOverMandibleCurve(self,planeNode,temporalOrigin, mandibleCurve, planeNodeObserver):
-    closestCurvePoint = [0,0,0]
-    closestCurvePointIndex = mandibleCurve.GetClosestPointPositionAlongCurveWorld(temporalOrigin,closestCurvePoint)
-    matrix = vtk.vtkMatrix4x4()
-    mandibleCurve.GetCurvePointToWorldTransformAtPointIndex(closestCurvePointIndex,matrix)
-    mandiblePlaneStraightOrigin = np.array([matrix.GetElement(0,3),matrix.GetElement(1,3),matrix.GetElement(2,3)])
-    mandiblePlaneStraightZ = np.array([matrix.GetElement(0,2),matrix.GetElement(1,2),matrix.GetElement(2,2)])
+    matrix = self.getMandibleCurveIndex(mandibleCurve).getClosestCurvePointsToWorldMatrices(temporalOrigin)[0]
+    mandiblePlaneStraightOrigin = matrix[:3,3]
+    mandiblePlaneStraightZ = matrix[:3,2]
     mandiblePlaneStraightY = [0,0,0]
     posterior = [0,-1,0]
     vtk.vtkMath.Cross(mandiblePlaneStraightZ, posterior, mandiblePlaneStraightY)
@@ -2312,22 +2684,18 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     clipper.InsideOutOn()
     clipper.SetClipFunction(cylinder)
     clipper.Update()
+    filterRunCounter.countRun("vtkClipPolyData")
 
     connectivityFilter = vtk.vtkConnectivityFilter()
     connectivityFilter.SetInputData(clipper.GetOutput())
     connectivityFilter.SetClosestPoint(point)
     connectivityFilter.SetExtractionModeToClosestPointRegion()
     connectivityFilter.Update()
+    filterRunCounter.countRun("vtkConnectivityFilter")
 
-    cylinderIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','cylinderIntersection')
-    cylinderIntersectionModel.CreateDefaultDisplayNodes()
-    cylinderIntersectionModel.SetAndObservePolyData(connectivityFilter.GetOutput())
-
-    averageNormal = self.getAverageNormalFromModel(cylinderIntersectionModel)
+    normalsOfCylinderIntersection = vtk.util.numpy_support.vtk_to_numpy(connectivityFilter.GetOutput().GetPointData().GetArray('Normals'))
 
-    slicer.mrmlScene.RemoveNode(cylinderIntersectionModel)
-
-    return averageNormal
+    return normalsOfCylinderIntersection.mean(axis=0)
 
 
   def getCentroid(self,model):
@@ -2336,17 +2704,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     return np.average(vtk_to_numpy(pd), axis=0)
 
   def getPointOfATwoPointsModelThatMakesLineDirectionSimilarToVector(self,twoPointsModel,vector):
-    pointsData = twoPointsModel.GetPolyData().GetPoints().GetData()
-    from vtk.util.numpy_support import vtk_to_numpy
-
-    points = vtk_to_numpy(pointsData)
-
-    pointsVector = (points[1]-points[0])/np.linalg.norm(points[1]-points[0])
-
-    if vtk.vtkMath.Dot(pointsVector, vector) > 0:
-      return points[1]
-    else:
-      return points[0]
+    return getPointOfTwoPointsThatMakesLineDirectionSimilarToVector(getPointsArrayOfPolyData(twoPointsModel.GetPolyData()),vector)
 
   def createFibulaAxisFromFibulaLineAndNotLeftChecked(self,fibulaLine,notLeftFibulaChecked):
     lineStartPos = np.zeros(3)
@@ -2397,6 +2755,24 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     line.GetNthControlPointPositionWorld(1, lineEndPos)
     return np.linalg.norm(lineEndPos-lineStartPos)
   
+  @runInTimingSpan
+  def getFibulaSegmentsGapsTable(self, securityMargin):
+    """Minimum distance between each pair of consecutive fibula segments, negative if they overlap."""
+    parameterNode = self.getParameterNode()
+    numberOfWorkerThreads = int(parameterNode.GetParameter("numberOfWorkerThreads") or 1)
+    cutBonesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Cut Bones"))
+    #Last cut bone is the resected mandible
+    fibulaSegmentsPolyData = [cutBone.GetPolyData() for cutBone in cutBonesList[:-1]]
+
+    gaps = self.fibulaSegmentsGapAnalyzer.getGapsBetweenConsecutiveSurfaces(fibulaSegmentsPolyData, numberOfWorkerThreads)
+    self.lastFibulaSegmentsGapsTable = [{"segments": (i, i+1), "gap": float(gaps[i]), "belowSecurityMargin": bool(gaps[i] < securityMargin)}
+      for i in range(len(gaps))]
+    logging.info('Fibula segments gaps (mm): {0}'.format(", ".join("{0}-{1}: {2:.2f}".format(row["segments"][0], row["segments"][1], row["gap"])
+      for row in self.lastFibulaSegmentsGapsTable)))
+    return self.lastFibulaSegmentsGapsTable
+
+  @runInTimingSpan
+  @runInSceneBatchUpdate
   def createMiterBoxesFromFibulaPlanes(self):
     parameterNode = self.getParameterNode()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
@@ -2413,6 +2789,9 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     useMoreExactVersionOfPositioningAlgorithmChecked = parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithm") == "True"
     fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
 
+    #The security margin is checked on the fibula pieces, they must not come from a coarser level of detail
+    self.updateReconstructionAtFullResolution()
+
     scalarVolume = parameterNode.GetNodeReference("currentScalarVolume")
     fibulaCentroidX = parameterNode.GetParameter("fibulaCentroidX")
     fibulaCentroidY = parameterNode.GetParameter("fibulaCentroidY")
@@ -2430,85 +2809,25 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     centerOfScalarVolume = np.array([(bounds[0]+bounds[1])/2,(bounds[2]+bounds[3])/2,(bounds[4]+bounds[5])/2])
 
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaPlanesFolder = shNode.GetItemByName("Fibula planes")
-    fibulaPlanesList = createListFromFolderID(fibulaPlanesFolder)
-    miterBoxesModelsFolder = shNode.GetItemByName("miterBoxes Models")
-    shNode.RemoveItem(miterBoxesModelsFolder)
-    biggerMiterBoxesModelsFolder = shNode.GetItemByName("biggerMiterBoxes Models")
-    shNode.RemoveItem(biggerMiterBoxesModelsFolder)
+    fibulaPlanesFolder = self.getFolderItemID("Fibula planes")
+    fibulaPlanesList = self.getFolderChildrenDataNodes(fibulaPlanesFolder)
+    miterBoxesModelsFolder = self.getFolderItemID("miterBoxes Models")
+    self.removeItem(miterBoxesModelsFolder)
+    biggerMiterBoxesModelsFolder = self.getFolderItemID("biggerMiterBoxes Models")
+    self.removeItem(biggerMiterBoxesModelsFolder)
 
     if checkSecurityMarginOnMiterBoxCreationChecked:
-      cutBonesList = createListFromFolderID(shNode.GetItemByName("Cut Bones"))
-      duplicateFibulaBonePiecesModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Duplicate Fibula Bone Pieces")
-      duplicateFibulaBonePiecesTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Duplicate Fibula Bone Pieces Transforms")
-      
-      for i in range(0,len(cutBonesList)-1):
-        duplicateFibulaPiece = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Duplicate ' + cutBonesList[i].GetName())
-        duplicateFibulaPiece.CreateDefaultDisplayNodes()
-        duplicateFibulaPiece.CopyContent(cutBonesList[i])
-
-        duplicateFibulaPieceItemID = shNode.GetItemByDataNode(duplicateFibulaPiece)
-        shNode.SetItemParent(duplicateFibulaPieceItemID, duplicateFibulaBonePiecesModelsFolder)
-
-      duplicateFibulaBonePiecesList = createListFromFolderID(duplicateFibulaBonePiecesModelsFolder)
-
-      for i in range(1,len(duplicateFibulaBonePiecesList)):
-        lineStartPos = np.array([0,0,0])
-        lineEndPos = np.array([0,0,0])
-        fibulaPlanesList[i*2].GetOrigin(lineStartPos)
-        fibulaPlanesList[i*2 +1].GetOrigin(lineEndPos)
-        #Create fibula axis:
-        fibulaZ = (lineEndPos - lineStartPos)/np.linalg.norm(lineEndPos - lineStartPos)
-
-        duplicateFibulaPieceTransformNode = slicer.vtkMRMLLinearTransformNode()
-        duplicateFibulaPieceTransformNode.SetName("Duplicate Fibula Piece Transform {0}".format(i))
-        slicer.mrmlScene.AddNode(duplicateFibulaPieceTransformNode)
-
-        duplicateFibulaPieceTransform = vtk.vtkTransform()
-        duplicateFibulaPieceTransform.PostMultiply()
-        duplicateFibulaPieceTransform.Translate(-i*(securityMarginOfFibulaPieces + 1e-2)*fibulaZ)
-
-        duplicateFibulaPieceTransformNode.SetMatrixTransformToParent(duplicateFibulaPieceTransform.GetMatrix())
-
-        duplicateFibulaBonePiecesList[i].SetAndObserveTransformNodeID(duplicateFibulaPieceTransformNode.GetID())
-        duplicateFibulaBonePiecesList[i].HardenTransform()
-
-        duplicateFibulaPieceTransformNodeItemID = shNode.GetItemByDataNode(duplicateFibulaPieceTransformNode)
-        shNode.SetItemParent(duplicateFibulaPieceTransformNodeItemID, duplicateFibulaBonePiecesTransformsFolder)
-
-      collisionDetected = False
-      
-      import vtkSlicerRtCommonPython
-      for i in range(0,len(duplicateFibulaBonePiecesList) -1):
-        collisionDetection = vtkSlicerRtCommonPython.vtkCollisionDetectionFilter()
-        #collisionDetection = vtk.vtkCollisionDetectionFilter()
-        collisionDetection.SetInputData(0, duplicateFibulaBonePiecesList[i].GetPolyData())
-        collisionDetection.SetInputData(1, duplicateFibulaBonePiecesList[i+1].GetPolyData())
-        matrix1 = vtk.vtkMatrix4x4()
-        collisionDetection.SetMatrix(0, matrix1)
-        collisionDetection.SetMatrix(1, matrix1)
-        collisionDetection.SetBoxTolerance(0.0)
-        collisionDetection.SetCellTolerance(0.0)
-        collisionDetection.SetNumberOfCellsPerNode(2)
-        collisionDetection.Update()
-        
-        if collisionDetection.GetNumberOfContacts() > 0:
-          collisionDetected = True
-          break
-      
-      shNode.RemoveItem(duplicateFibulaBonePiecesTransformsFolder)
-      shNode.RemoveItem(duplicateFibulaBonePiecesModelsFolder)
-      if collisionDetected:
-        slicer.util.errorDisplay(f"Planned fibula segments could overlap each other (the distance in between them do not satisfy the security margin of {securityMarginOfFibulaPieces}mm). " +
+      fibulaSegmentsGapsTable = self.getFibulaSegmentsGapsTable(securityMarginOfFibulaPieces)
+      segmentsGapsBelowSecurityMargin = [row for row in fibulaSegmentsGapsTable if row["belowSecurityMargin"]]
+      if segmentsGapsBelowSecurityMargin:
+        gapsText = ", ".join("segments {0}-{1}: {2:.2f}mm".format(row["segments"][0], row["segments"][1], row["gap"]) for row in segmentsGapsBelowSecurityMargin)
+        slicer.util.errorDisplay(f"Planned fibula segments could overlap each other (the distance in between them do not satisfy the security margin of {securityMarginOfFibulaPieces}mm: {gapsText}). " +
             "You can fix this by increasing 'intersection distance multiplier' or 'between space' and pressing the update button")
         return
 
 
     miterBoxesModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"miterBoxes Models")
     biggerMiterBoxesModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"biggerMiterBoxes Models")
-    miterBoxesTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"miterBoxes Transforms")
-    intersectionsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Intersections")
-    pointsIntersectionsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Points Intersections")
 
     if not useMoreExactVersionOfPositioningAlgorithmChecked:
       #Create fibula axis:
@@ -2517,6 +2836,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     fibulaViewNode = slicer.mrmlScene.GetSingletonNode("2", "vtkMRMLViewNode")
 
     for i in range(len(fibulaPlanesList)):
+      miterBoxStartTime = time.perf_counter()
       if useMoreExactVersionOfPositioningAlgorithmChecked:
         lineStartPos = np.array([0,0,0])
         lineEndPos = np.array([0,0,0])
@@ -2541,7 +2861,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       miterBoxDisplayNode.AddViewNodeID(fibulaViewNode.GetID())
 
       miterBoxModelItemID = shNode.GetItemByDataNode(miterBoxModel)
-      shNode.SetItemParent(miterBoxModelItemID, miterBoxesModelsFolder)
+      self.setItemParent(miterBoxModelItemID, miterBoxesModelsFolder)
 
       biggerMiterBoxWidth = miterBoxSlotWidth+2*clearanceFitPrintingTolerance+2*miterBoxSlotWall
       biggerMiterBoxLength = miterBoxSlotLength+2*miterBoxSlotWall
@@ -2556,7 +2876,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         biggerMiterBoxDisplayNode.AddViewNodeID(redSliceNode.GetID())
 
       biggerMiterBoxModelItemID = shNode.GetItemByDataNode(biggerMiterBoxModel)
-      shNode.SetItemParent(biggerMiterBoxModelItemID, biggerMiterBoxesModelsFolder)
+      self.setItemParent(biggerMiterBoxModelItemID, biggerMiterBoxesModelsFolder)
 
       fibulaPlaneMatrix = vtk.vtkMatrix4x4()
       fibulaPlanesList[i].GetPlaneToWorldMatrix(fibulaPlaneMatrix)
@@ -2573,24 +2893,10 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       vtk.vtkMath.Cross(miterBoxDirection, fibulaZ, normalToMiterBoxDirectionAndFibulaZ)
       normalToMiterBoxDirectionAndFibulaZ = normalToMiterBoxDirectionAndFibulaZ/np.linalg.norm(normalToMiterBoxDirectionAndFibulaZ)
 
-      if i%2 == 0:
-        intersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d_A' % (i//2))
-      else:
-        intersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d_B' % (i//2))
-      intersectionModel.CreateDefaultDisplayNodes()
-      self.getIntersectionBetweenModelAnd1Plane(fibulaModelNode,fibulaPlanesList[i],intersectionModel)
-      intersectionModelCentroid = self.getCentroid(intersectionModel)
-      if i%2 == 0:
-        pointsIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Points Intersection%d_A' % (i//2))
-      else:
-        pointsIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Points Intersection%d_B' % (i//2))
-      pointsIntersectionModel.CreateDefaultDisplayNodes()
-      self.getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin_2(intersectionModel,normalToMiterBoxDirectionAndFibulaZ,intersectionModelCentroid,pointsIntersectionModel)
-      pointOfIntersection = self.getPointOfATwoPointsModelThatMakesLineDirectionSimilarToVector(pointsIntersectionModel,miterBoxDirection)
-      intersectionModelItemID = shNode.GetItemByDataNode(intersectionModel)
-      shNode.SetItemParent(intersectionModelItemID, intersectionsFolder)
-      pointsIntersectionModelItemID = shNode.GetItemByDataNode(pointsIntersectionModel)
-      shNode.SetItemParent(pointsIntersectionModelItemID, pointsIntersectionsFolder)
+      intersectionPolyData = getPlaneSectionOfPolyData(fibulaModelNode.GetPolyData(),fibulaPlaneOrigin,fibulaPlaneZ)
+      intersectionCentroid = getPointsArrayOfPolyData(intersectionPolyData).mean(axis=0)
+      pointsIntersectionPolyData = getPlaneSectionOfPolyData(intersectionPolyData,intersectionCentroid,normalToMiterBoxDirectionAndFibulaZ)
+      pointOfIntersection = getPointOfTwoPointsThatMakesLineDirectionSimilarToVector(getPointsArrayOfPolyData(pointsIntersectionPolyData),miterBoxDirection)
 
       miterBoxAxisX = [0,0,0]
       miterBoxAxisY =  [0,0,0]
@@ -2617,10 +2923,6 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       cosOfRotatedMiterBoxAxisYAndMiterBoxAxisY = vtk.vtkMath.Dot(rotatedMiterBoxAxisY, miterBoxAxisY)
       deltaMiterBoxAxisY = biggerMiterBoxWidth/2*sinOfMiterBoxAxisZAndFibulaZ/cosOfRotatedMiterBoxAxisYAndMiterBoxAxisY
 
-      transformNode = slicer.vtkMRMLLinearTransformNode()
-      transformNode.SetName("temp%d" % i)
-      slicer.mrmlScene.AddNode(transformNode)
-
       finalTransform = vtk.vtkTransform()
       finalTransform.PostMultiply()
       finalTransform.Concatenate(WorldToMiterBoxAxisRotationMatrix)
@@ -2633,21 +2935,10 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         miterBoxAxisYTranslation = biggerMiterBoxHeight/2+deltaMiterBoxAxisY+biggerMiterBoxDistanceToFibula/cosOfRotatedMiterBoxAxisYAndMiterBoxAxisY
         miterBoxAxisZTranslation = miterBoxSlotWidth/2
       finalTransform.Translate(pointOfIntersection + miterBoxAxisX*miterBoxAxisXTranslation + miterBoxAxisY*miterBoxAxisYTranslation + miterBoxAxisZ*miterBoxAxisZTranslation)
-      transformNode.SetMatrixTransformToParent(finalTransform.GetMatrix())
 
-      transformNode.UpdateScene(slicer.mrmlScene)
-
-      miterBoxModel.SetAndObserveTransformNodeID(transformNode.GetID())
-      miterBoxModel.HardenTransform()
-      biggerMiterBoxModel.SetAndObserveTransformNodeID(transformNode.GetID())
-      biggerMiterBoxModel.HardenTransform()
-      
-      transformNodeItemID = shNode.GetItemByDataNode(transformNode)
-      shNode.SetItemParent(transformNodeItemID, miterBoxesTransformsFolder)
-    
-    shNode.RemoveItem(miterBoxesTransformsFolder)
-    shNode.RemoveItem(intersectionsFolder)
-    shNode.RemoveItem(pointsIntersectionsFolder)
+      miterBoxModel.ApplyTransform(finalTransform)
+      biggerMiterBoxModel.ApplyTransform(finalTransform)
+      self.timingSpans.addSpan("createMiterBox", miterBoxStartTime, args={"fibulaPlane": i})
 
   
   def createBox(self, X, Y, Z, name):
@@ -2668,7 +2959,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
   def createFibulaCylindersFiducialList(self):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaCylindersFiducialsListsFolder = shNode.GetItemByName("Fibula Cylinders Fiducials Lists")
+    fibulaCylindersFiducialsListsFolder = self.getFolderItemID("Fibula Cylinders Fiducials Lists")
     if not fibulaCylindersFiducialsListsFolder:
       fibulaCylindersFiducialsListsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Fibula Cylinders Fiducials Lists")
     
@@ -2678,7 +2969,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     slicer.modules.markups.logic().AddNewDisplayNodeForMarkupsNode(fibulaFiducialListNode)
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     fibulaFiducialListNodeItemID = shNode.GetItemByDataNode(fibulaFiducialListNode)
-    shNode.SetItemParent(fibulaFiducialListNodeItemID, fibulaCylindersFiducialsListsFolder)
+    self.setItemParent(fibulaFiducialListNodeItemID, fibulaCylindersFiducialsListsFolder)
     fibulaFiducialListNode.SetName(slicer.mrmlScene.GetUniqueNameByString("fibulaCylindersFiducialsList"))
 
     #setup placement
@@ -2686,13 +2977,13 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     interactionNode = slicer.mrmlScene.GetNodeByID("vtkMRMLInteractionNodeSingleton")
     interactionNode.SwitchToPersistentPlaceMode()
 
+  @runInTimingSpan
+  @runInSceneBatchUpdate
   def createCylindersFromFiducialListAndFibulaSurgicalGuideBase(self):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaCylindersModelsFolder = shNode.GetItemByName("Fibula Cylinders Models")
-    shNode.RemoveItem(fibulaCylindersModelsFolder)
+    fibulaCylindersModelsFolder = self.getFolderItemID("Fibula Cylinders Models")
+    self.removeItem(fibulaCylindersModelsFolder)
     fibulaCylindersModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Fibula Cylinders Models")
-    cylindersTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Cylinders Transforms")
-    
     parameterNode = self.getParameterNode()
     fibulaFiducialList = parameterNode.GetNodeReference("fibulaFiducialList")
     fibulaSurgicalGuideBaseModel = parameterNode.GetNodeReference("fibulaSurgicalGuideBaseModel")
@@ -2717,7 +3008,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
       cylinderModel = self.createCylinder(fibulaScrewHoleCylinderRadius, "cylinder%d" % i)
       cylinderModelItemID = shNode.GetItemByDataNode(cylinderModel)
-      shNode.SetItemParent(cylinderModelItemID, fibulaCylindersModelsFolder)
+      self.setItemParent(cylinderModelItemID, fibulaCylindersModelsFolder)
       
       cylinderAxisX = [1,0,0]
       cylinderAxisY = [0,1,0]
@@ -2728,34 +3019,20 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
       cylinderAxisToTransformedCylinderAxisRotationMatrix = self.getAxes1ToAxes2RotationMatrix(cylinderAxisToWorldRotationMatrix, transformedCylinderAxisToWorldRotationMatrix)
 
-      transformNode = slicer.vtkMRMLLinearTransformNode()
-      transformNode.SetName("temp%d" % i)
-      slicer.mrmlScene.AddNode(transformNode)
-
       finalTransform = vtk.vtkTransform()
       finalTransform.PostMultiply()
       finalTransform.Concatenate(cylinderAxisToTransformedCylinderAxisRotationMatrix)
       finalTransform.Translate(pos)
 
-      transformNode.SetMatrixTransformToParent(finalTransform.GetMatrix())
-
-      transformNode.UpdateScene(slicer.mrmlScene)
-
-      cylinderModel.SetAndObserveTransformNodeID(transformNode.GetID())
-      cylinderModel.HardenTransform()
-      
-      transformNodeItemID = shNode.GetItemByDataNode(transformNode)
-      shNode.SetItemParent(transformNodeItemID, cylindersTransformsFolder)
-    
-    shNode.RemoveItem(cylindersTransformsFolder)
+      cylinderModel.ApplyTransform(finalTransform)
   
+  @runInTimingSpan
+  @runInSceneBatchUpdate
   def createCylindersFromFiducialListAndMandibleSurgicalGuideBase(self):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    mandibleCylindersModelsFolder = shNode.GetItemByName("Mandible Cylinders Models")
-    shNode.RemoveItem(mandibleCylindersModelsFolder)
+    mandibleCylindersModelsFolder = self.getFolderItemID("Mandible Cylinders Models")
+    self.removeItem(mandibleCylindersModelsFolder)
     mandibleCylindersModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Mandible Cylinders Models")
-    cylindersTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Cylinders Transforms")
-    
     parameterNode = self.getParameterNode()
     mandibleFiducialList = parameterNode.GetNodeReference("mandibleFiducialList")
     mandibleSurgicalGuideBaseModel = parameterNode.GetNodeReference("mandibleSurgicalGuideBaseModel")
@@ -2780,7 +3057,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
       cylinderModel = self.createCylinder(mandibleScrewHoleCylinderRadius, "cylinder%d" % i)
       cylinderModelItemID = shNode.GetItemByDataNode(cylinderModel)
-      shNode.SetItemParent(cylinderModelItemID, mandibleCylindersModelsFolder)
+      self.setItemParent(cylinderModelItemID, mandibleCylindersModelsFolder)
       
       cylinderAxisX = [1,0,0]
       cylinderAxisY = [0,1,0]
@@ -2791,26 +3068,12 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
       cylinderAxisToTransformedCylinderAxisRotationMatrix = self.getAxes1ToAxes2RotationMatrix(cylinderAxisToWorldRotationMatrix, transformedCylinderAxisToWorldRotationMatrix)
 
-      transformNode = slicer.vtkMRMLLinearTransformNode()
-      transformNode.SetName("temp%d" % i)
-      slicer.mrmlScene.AddNode(transformNode)
-
       finalTransform = vtk.vtkTransform()
       finalTransform.PostMultiply()
       finalTransform.Concatenate(cylinderAxisToTransformedCylinderAxisRotationMatrix)
       finalTransform.Translate(pos)
 
-      transformNode.SetMatrixTransformToParent(finalTransform.GetMatrix())
-
-      transformNode.UpdateScene(slicer.mrmlScene)
-
-      cylinderModel.SetAndObserveTransformNodeID(transformNode.GetID())
-      cylinderModel.HardenTransform()
-      
-      transformNodeItemID = shNode.GetItemByDataNode(transformNode)
-      shNode.SetItemParent(transformNodeItemID, cylindersTransformsFolder)
-    
-    shNode.RemoveItem(cylindersTransformsFolder)
+      cylinderModel.ApplyTransform(finalTransform)
 
   def createCylinder(self,R,name):
     cylinder = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
@@ -2829,45 +3092,93 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     cylinder.SetAndObservePolyData(tubeFilter.GetOutput())
     return cylinder
 
+  @runInTimingSpan
+  @runInSceneBatchUpdate
   def makeBooleanOperationsToFibulaSurgicalGuideBase(self):
     parameterNode = self.getParameterNode()
     fibulaSurgicalGuideBaseModel = parameterNode.GetNodeReference("fibulaSurgicalGuideBaseModel")
 
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    fibulaCylindersModelsFolder = shNode.GetItemByName("Fibula Cylinders Models")
-    cylindersModelsList = createListFromFolderID(fibulaCylindersModelsFolder)
-    miterBoxesModelsFolder = shNode.GetItemByName("miterBoxes Models")
-    miterBoxesModelsList = createListFromFolderID(miterBoxesModelsFolder)
-    biggerMiterBoxesModelsFolder = shNode.GetItemByName("biggerMiterBoxes Models")
-    biggerMiterBoxesModelsList = createListFromFolderID(biggerMiterBoxesModelsFolder)
-
-    combineModelsLogic = slicer.modules.combinemodels.widgetRepresentation().self().logic
+    fibulaCylindersModelsFolder = self.getFolderItemID("Fibula Cylinders Models")
+    cylindersModelsList = self.getFolderChildrenDataNodes(fibulaCylindersModelsFolder)
+    miterBoxesModelsFolder = self.getFolderItemID("miterBoxes Models")
+    miterBoxesModelsList = self.getFolderChildrenDataNodes(miterBoxesModelsFolder)
+    biggerMiterBoxesModelsFolder = self.getFolderItemID("biggerMiterBoxes Models")
+    biggerMiterBoxesModelsList = self.getFolderChildrenDataNodes(biggerMiterBoxesModelsFolder)
 
     surgicalGuideModel = slicer.modules.models.logic().AddModel(fibulaSurgicalGuideBaseModel.GetPolyData())
     surgicalGuideModel.SetName(slicer.mrmlScene.GetUniqueNameByString('FibulaSurgicalGuidePrototype'))
     surgicalGuideModelItemID = shNode.GetItemByDataNode(surgicalGuideModel)
-    shNode.SetItemParent(surgicalGuideModelItemID, self.getParentFolderItemID())
+    self.setItemParent(surgicalGuideModelItemID, self.getParentFolderItemID())
 
     displayNode = surgicalGuideModel.GetDisplayNode()
     fibulaViewNode = slicer.mrmlScene.GetSingletonNode("2", "vtkMRMLViewNode")
     displayNode.AddViewNodeID(fibulaViewNode.GetID())
 
-    for i in range(len(biggerMiterBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, biggerMiterBoxesModelsList[i], surgicalGuideModel, 'union')
-
-    for i in range(len(cylindersModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, cylindersModelsList[i], surgicalGuideModel, 'difference')
-
-    for i in range(len(miterBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, miterBoxesModelsList[i], surgicalGuideModel, 'difference')
+    self.combineToolsWithSurgicalGuide(surgicalGuideModel, biggerMiterBoxesModelsList, cylindersModelsList + miterBoxesModelsList)
 
     if surgicalGuideModel.GetPolyData().GetNumberOfPoints() == 0:
       slicer.mrmlScene.RemoveNode(surgicalGuideModel)
       slicer.util.errorDisplay("ERROR: Boolean operations to make fibula surgical guide failed")
 
+  @runInTimingSpan
+  def combineToolsWithSurgicalGuide(self, surgicalGuideModel, additiveModelsList, subtractiveModelsList):
+    parameterNode = self.getParameterNode()
+    useBatchedBooleanOperationsChecked = parameterNode.GetParameter("useBatchedBooleanOperations") == "True"
+    useVoxelBooleanOperationsChecked = parameterNode.GetParameter("useVoxelBooleanOperations") == "True"
+    combineModelsLogic = slicer.modules.combinemodels.widgetRepresentation().self().logic
+
+    if useVoxelBooleanOperationsChecked:
+      surgicalGuideModel.SetAndObservePolyData(self.getVoxelBooleanOperationsResult(surgicalGuideModel.GetPolyData(),
+        [model.GetPolyData() for model in additiveModelsList], [model.GetPolyData() for model in subtractiveModelsList]))
+      return
+
+    if not useBatchedBooleanOperationsChecked:
+      for additiveModel in additiveModelsList:
+        with self.timingSpans.span("union", args={"tool": additiveModel.GetName()}):
+          combineModelsLogic.process(surgicalGuideModel, additiveModel, surgicalGuideModel, 'union')
+          filterRunCounter.countRun("CombineModels")
+      for subtractiveModel in subtractiveModelsList:
+        with self.timingSpans.span("difference", args={"tool": subtractiveModel.GetName()}):
+          combineModelsLogic.process(surgicalGuideModel, subtractiveModel, surgicalGuideModel, 'difference')
+          filterRunCounter.countRun("CombineModels")
+      return
+
+    #Tools that do not overlap each other are appended into one mesh so the guide goes through one boolean
+    #operation per group instead of one per tool. Overlapping tools go to other groups because an appended
+    #self-intersecting mesh would make the boolean operation fail
+    toolsModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', slicer.mrmlScene.GetUniqueNameByString('Surgical Guide Tools'))
+    try:
+      for modelsList, operation in [(additiveModelsList, 'union'), (subtractiveModelsList, 'difference')]:
+        polyDataList = [model.GetPolyData() for model in modelsList]
+        for group in getGroupsOfNonOverlappingPolyData(polyDataList):
+          with self.timingSpans.span(operation, args={"tools": [modelsList[i].GetName() for i in group]}):
+            if len(group) == 1:
+              combineModelsLogic.process(surgicalGuideModel, modelsList[group[0]], surgicalGuideModel, operation)
+              filterRunCounter.countRun("CombineModels")
+              continue
+            toolsModel.SetAndObservePolyData(appendPolyData([polyDataList[i] for i in group]))
+            combineModelsLogic.process(surgicalGuideModel, toolsModel, surgicalGuideModel, operation)
+            filterRunCounter.countRun("CombineModels")
+    finally:
+      slicer.mrmlScene.RemoveNode(toolsModel)
+
+  @runInTimingSpan
+  def getVoxelBooleanOperationsResult(self, basePolyData, additivePolyDataList, subtractivePolyDataList):
+    parameterNode = self.getParameterNode()
+    voxelSize = float(parameterNode.GetParameter("booleanOperationsVoxelSize"))
+    startTime = time.time()
+    resultPolyData, usedVoxelSize, dimensions = getBooleanOperationsOfPolyDataWithSignedDistance(
+      basePolyData, additivePolyDataList, subtractivePolyDataList, voxelSize)
+    self.lastVoxelBooleanOperationsStatistics = {"requestedVoxelSize": voxelSize, "usedVoxelSize": usedVoxelSize, "dimensions": dimensions}
+    if usedVoxelSize > voxelSize:
+      logging.warning('Voxel size of boolean operations increased from {0} to {1:.3f} mm to limit the volume size'.format(voxelSize, usedVoxelSize))
+    logging.info('Voxel boolean operations: {0} volume, {1:.2f} seconds'.format('x'.join(str(d) for d in dimensions), time.time()-startTime))
+    return resultPolyData
+
   def createMandibleCylindersFiducialList(self):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    mandibleCylindersFiducialsListsFolder = shNode.GetItemByName("Mandible Cylinders Fiducials Lists")
+    mandibleCylindersFiducialsListsFolder = self.getFolderItemID("Mandible Cylinders Fiducials Lists")
     if not mandibleCylindersFiducialsListsFolder:
       mandibleCylindersFiducialsListsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Mandible Cylinders Fiducials Lists")
     
@@ -2877,7 +3188,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     slicer.modules.markups.logic().AddNewDisplayNodeForMarkupsNode(mandibleFiducialListNode)
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     mandibleFiducialListNodeItemID = shNode.GetItemByDataNode(mandibleFiducialListNode)
-    shNode.SetItemParent(mandibleFiducialListNodeItemID, mandibleCylindersFiducialsListsFolder)
+    self.setItemParent(mandibleFiducialListNodeItemID, mandibleCylindersFiducialsListsFolder)
     mandibleFiducialListNode.SetName(slicer.mrmlScene.GetUniqueNameByString("mandibleCylindersFiducialsList"))
 
     #setup placement
@@ -2885,6 +3196,8 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     interactionNode = slicer.mrmlScene.GetNodeByID("vtkMRMLInteractionNodeSingleton")
     interactionNode.SwitchToPersistentPlaceMode()
 
+  @runInTimingSpan
+  @runInSceneBatchUpdate
   def createSawBoxesFromFirstAndLastMandiblePlanes(self):
     parameterNode = self.getParameterNode()
     mandibularCurve = parameterNode.GetNodeReference("mandibleCurve")
@@ -2897,26 +3210,25 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     mandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
     
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    mandibularPlanesFolder = shNode.GetItemByName("Mandibular planes")
-    mandibularPlanesList = createListFromFolderID(mandibularPlanesFolder)
-    sawBoxesModelsFolder = shNode.GetItemByName("sawBoxes Models")
-    shNode.RemoveItem(sawBoxesModelsFolder)
-    biggerSawBoxesModelsFolder = shNode.GetItemByName("biggerSawBoxes Models")
-    shNode.RemoveItem(biggerSawBoxesModelsFolder)
-    sawBoxesPlanesFolder = shNode.GetItemByName("sawBoxes Planes")
-    shNode.RemoveItem(sawBoxesPlanesFolder)
-    sawBoxesTransformsFolder = shNode.GetItemByName("sawBoxes Transforms")
-    shNode.RemoveItem(sawBoxesTransformsFolder)
+    mandibularPlanesFolder = self.getFolderItemID("Mandibular planes")
+    mandibularPlanesList = self.getFolderChildrenDataNodes(mandibularPlanesFolder)
+    sawBoxesModelsFolder = self.getFolderItemID("sawBoxes Models")
+    self.removeItem(sawBoxesModelsFolder)
+    biggerSawBoxesModelsFolder = self.getFolderItemID("biggerSawBoxes Models")
+    self.removeItem(biggerSawBoxesModelsFolder)
+    sawBoxesPlanesFolder = self.getFolderItemID("sawBoxes Planes")
+    self.removeItem(sawBoxesPlanesFolder)
+    sawBoxesTransformsFolder = self.getFolderItemID("sawBoxes Transforms")
+    self.removeItem(sawBoxesTransformsFolder)
     sawBoxesModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"sawBoxes Models")
     biggerSawBoxesModelsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"biggerSawBoxes Models")
     sawBoxesPlanesFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"sawBoxes Planes")
     sawBoxesTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"sawBoxes Transforms")
-    intersectionsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Intersections")
-    pointsIntersectionsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Points Intersections")
 
     mandibleViewNode = slicer.mrmlScene.GetSingletonNode("1", "vtkMRMLViewNode")
 
     for i in range(0,len(mandibularPlanesList),len(mandibularPlanesList)-1):
+      sawBoxStartTime = time.perf_counter()
       #sawBoxModel: the numbers are selected arbitrarily to make a box with the correct size then they'll be GUI set
       if i == 0:
         sawBoxName = "sawBox_%d" % i
@@ -2929,7 +3241,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       sawBoxHeight = 70
       sawBoxModel = self.createBox(sawBoxLength,sawBoxHeight,sawBoxWidth,sawBoxName)
       sawBoxModelItemID = shNode.GetItemByDataNode(sawBoxModel)
-      shNode.SetItemParent(sawBoxModelItemID, sawBoxesModelsFolder)
+      self.setItemParent(sawBoxModelItemID, sawBoxesModelsFolder)
 
       sawBoxDisplayNode = sawBoxModel.GetDisplayNode()
       sawBoxDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
@@ -2940,7 +3252,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       biggerSawBoxHeight = sawBoxSlotHeight
       biggerSawBoxModel = self.createBox(biggerSawBoxLength,biggerSawBoxHeight,biggerSawBoxWidth,biggerSawBoxName)
       biggerSawBoxModelItemID = shNode.GetItemByDataNode(biggerSawBoxModel)
-      shNode.SetItemParent(biggerSawBoxModelItemID, biggerSawBoxesModelsFolder)
+      self.setItemParent(biggerSawBoxModelItemID, biggerSawBoxesModelsFolder)
 
       biggerSawBoxDisplayNode = biggerSawBoxModel.GetDisplayNode()
       biggerSawBoxDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
@@ -2949,7 +3261,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       sawBoxPlane = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsPlaneNode", "sawBox Plane%d" % i)
       slicer.modules.markups.logic().AddNewDisplayNodeForMarkupsNode(sawBoxPlane)
       sawBoxPlaneItemID = shNode.GetItemByDataNode(sawBoxPlane)
-      shNode.SetItemParent(sawBoxPlaneItemID, sawBoxesPlanesFolder)
+      self.setItemParent(sawBoxPlaneItemID, sawBoxesPlanesFolder)
 
       sawBoxPlane.SetAxes([1,0,0],[0,1,0],[0,0,1])
       sawBoxPlane.SetOrigin([0,0,0])
@@ -2967,34 +3279,16 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       mandiblePlaneZ = np.array([mandiblePlaneMatrix.GetElement(0,2),mandiblePlaneMatrix.GetElement(1,2),mandiblePlaneMatrix.GetElement(2,2)])
       mandiblePlaneOrigin = np.array([mandiblePlaneMatrix.GetElement(0,3),mandiblePlaneMatrix.GetElement(1,3),mandiblePlaneMatrix.GetElement(2,3)])
 
-      closestCurvePoint = [0,0,0]
-      closestCurvePointIndex = mandibularCurve.GetClosestPointPositionAlongCurveWorld(mandiblePlaneOrigin,closestCurvePoint)
-      matrix = vtk.vtkMatrix4x4()
-      mandibularCurve.GetCurvePointToWorldTransformAtPointIndex(closestCurvePointIndex,matrix)
-      mandibularCurveX = np.array([matrix.GetElement(0,0),matrix.GetElement(1,0),matrix.GetElement(2,0)])
+      mandibularCurveX = self.getMandibleCurveIndex(mandibularCurve).getClosestCurvePointsToWorldMatrices(mandiblePlaneOrigin)[0][:3,0]
       normalToMandiblePlaneZAndMandibularCurveX = [0,0,0]
       vtk.vtkMath.Cross(mandiblePlaneZ, mandibularCurveX, normalToMandiblePlaneZAndMandibularCurveX)
       normalToMandiblePlaneZAndMandibularCurveX = normalToMandiblePlaneZAndMandibularCurveX/np.linalg.norm(normalToMandiblePlaneZAndMandibularCurveX)
       
-      if i == 0:
-        intersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d' % i)
-      else:
-        intersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection%d' % (len(mandibularPlanesList)-1))
-      intersectionModel.CreateDefaultDisplayNodes()
-      self.getNearestIntersectionBetweenModelAnd1Plane(mandibleModelNode,mandibularPlanesList[i],intersectionModel)
-      intersectionModelCentroid = self.getCentroid(intersectionModel)
-      if i == 0:
-        pointsIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Points Intersection%d' % i)
-      else:
-        pointsIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Points Intersection%d' % (len(mandibularPlanesList)-1))
-      pointsIntersectionModel.CreateDefaultDisplayNodes()
-      self.getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin_2(intersectionModel,normalToMandiblePlaneZAndMandibularCurveX,intersectionModelCentroid,pointsIntersectionModel)
+      intersectionPolyData = getNearestPlaneSectionOfPolyData(mandibleModelNode.GetPolyData(),mandiblePlaneOrigin,mandiblePlaneZ)
+      intersectionCentroid = getPointsArrayOfPolyData(intersectionPolyData).mean(axis=0)
+      pointsIntersectionPolyData = getPlaneSectionOfPolyData(intersectionPolyData,intersectionCentroid,normalToMandiblePlaneZAndMandibularCurveX)
       anterior = [0,1,0]
-      pointOfIntersection = self.getPointOfATwoPointsModelThatMakesLineDirectionSimilarToVector(pointsIntersectionModel,anterior)
-      intersectionModelItemID = shNode.GetItemByDataNode(intersectionModel)
-      shNode.SetItemParent(intersectionModelItemID, intersectionsFolder)
-      pointsIntersectionModelItemID = shNode.GetItemByDataNode(pointsIntersectionModel)
-      shNode.SetItemParent(pointsIntersectionModelItemID, pointsIntersectionsFolder)
+      pointOfIntersection = getPointOfTwoPointsThatMakesLineDirectionSimilarToVector(getPointsArrayOfPolyData(pointsIntersectionPolyData),anterior)
 
 
       sawBoxDirection = self.getAverageNormalFromModelPoint(mandibleModelNode,pointOfIntersection)
@@ -3044,23 +3338,23 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       biggerSawBoxModel.SetAndObserveTransformNodeID(transformNode.GetID())
       
       transformNodeItemID = shNode.GetItemByDataNode(transformNode)
-      shNode.SetItemParent(transformNodeItemID, sawBoxesTransformsFolder)
-
-      observer = sawBoxPlane.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent,self.onSawBoxPlaneMoved)
-      self.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList.append([observer,sawBoxPlane.GetID(),transformNode.GetID()])
+      self.setItemParent(transformNodeItemID, sawBoxesTransformsFolder)
 
-    shNode.RemoveItem(intersectionsFolder)
-    shNode.RemoveItem(pointsIntersectionsFolder)
+      self.sawBoxPlanesTransformsIDs[sawBoxPlane.GetID()] = transformNode.GetID()
+      self.sawBoxPlaneObservers.addObserver(sawBoxPlane, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onSawBoxPlaneMoved, coalesce=True)
+      self.timingSpans.addSpan("createSawBox", sawBoxStartTime, args={"mandiblePlane": i})
     
   def onSawBoxPlaneMoved(self,sourceNode,event):
-    for i in range(len(self.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList)):
-      if self.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList[i][1] == sourceNode.GetID():
-        sawBoxPlane = slicer.mrmlScene.GetNodeByID(self.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList[i][1])
-        transformNode = slicer.mrmlScene.GetNodeByID(self.sawBoxPlaneObserversPlaneNodeIDAndTransformIDList[i][2])
-        sawBoxPlaneToWorldMatrix = vtk.vtkMatrix4x4()
-        sawBoxPlane.GetPlaneToWorldMatrix(sawBoxPlaneToWorldMatrix)
-        transformNode.SetMatrixTransformToParent(sawBoxPlaneToWorldMatrix)
+    transformNodeID = self.sawBoxPlanesTransformsIDs.get(sourceNode.GetID())
+    if transformNodeID is None:
+      return
+    transformNode = slicer.mrmlScene.GetNodeByID(transformNodeID)
+    sawBoxPlaneToWorldMatrix = vtk.vtkMatrix4x4()
+    sourceNode.GetPlaneToWorldMatrix(sawBoxPlaneToWorldMatrix)
+    transformNode.SetMatrixTransformToParent(sawBoxPlaneToWorldMatrix)
 
+  @runInTimingSpan
+  @runInSceneBatchUpdate
   def makeBooleanOperationsToMandibleSurgicalGuideBase(self):
     parameterNode = self.getParameterNode()
     mandibleSurgicalGuideBaseModel = parameterNode.GetNodeReference("mandibleSurgicalGuideBaseModel")
@@ -3068,35 +3362,27 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     
 
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    mandibleCylindersModelsFolder = shNode.GetItemByName("Mandible Cylinders Models")
-    cylindersModelsList = createListFromFolderID(mandibleCylindersModelsFolder)
-    sawBoxesModelsFolder = shNode.GetItemByName("sawBoxes Models")
-    sawBoxesModelsList = createListFromFolderID(sawBoxesModelsFolder)
-    biggerSawBoxesModelsFolder = shNode.GetItemByName("biggerSawBoxes Models")
-    biggerSawBoxesModelsList = createListFromFolderID(biggerSawBoxesModelsFolder)
-
-    combineModelsLogic = slicer.modules.combinemodels.widgetRepresentation().self().logic
+    mandibleCylindersModelsFolder = self.getFolderItemID("Mandible Cylinders Models")
+    cylindersModelsList = self.getFolderChildrenDataNodes(mandibleCylindersModelsFolder)
+    sawBoxesModelsFolder = self.getFolderItemID("sawBoxes Models")
+    sawBoxesModelsList = self.getFolderChildrenDataNodes(sawBoxesModelsFolder)
+    biggerSawBoxesModelsFolder = self.getFolderItemID("biggerSawBoxes Models")
+    biggerSawBoxesModelsList = self.getFolderChildrenDataNodes(biggerSawBoxesModelsFolder)
 
     surgicalGuideModel = slicer.modules.models.logic().AddModel(mandibleSurgicalGuideBaseModel.GetPolyData())
     surgicalGuideModel.SetName(slicer.mrmlScene.GetUniqueNameByString('MandibleSurgicalGuidePrototype'))
     surgicalGuideModelItemID = shNode.GetItemByDataNode(surgicalGuideModel)
-    shNode.SetItemParent(surgicalGuideModelItemID, self.getParentFolderItemID())
+    self.setItemParent(surgicalGuideModelItemID, self.getParentFolderItemID())
 
     displayNode = surgicalGuideModel.GetDisplayNode()
     mandibleViewNode = slicer.mrmlScene.GetSingletonNode("1", "vtkMRMLViewNode")
     displayNode.AddViewNodeID(mandibleViewNode.GetID())
 
-    for i in range(len(biggerSawBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, biggerSawBoxesModelsList[i], surgicalGuideModel, 'union')
-    
+    additiveModelsList = list(biggerSawBoxesModelsList)
     if mandibleBridgeModel:
-      combineModelsLogic.process(surgicalGuideModel, mandibleBridgeModel, surgicalGuideModel, 'union')
-
-    for i in range(len(cylindersModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, cylindersModelsList[i], surgicalGuideModel, 'difference')
+      additiveModelsList.append(mandibleBridgeModel)
 
-    for i in range(len(sawBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, sawBoxesModelsList[i], surgicalGuideModel, 'difference')
+    self.combineToolsWithSurgicalGuide(surgicalGuideModel, additiveModelsList, cylindersModelsList + sawBoxesModelsList)
 
     if surgicalGuideModel.GetPolyData().GetNumberOfPoints() == 0:
       slicer.mrmlScene.RemoveNode(surgicalGuideModel)
@@ -3107,55 +3393,94 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     parameterNode = self.getParameterNode()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
     fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
-
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    intersectionsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Intersections")
+    fitFibulaAxisChecked = parameterNode.GetParameter("fitFibulaAxisToCenterFibulaLine") == "True"
 
     lineStartPos = np.zeros(3)
     lineEndPos = np.zeros(3)
     fibulaLine.GetNthControlPointPositionWorld(0, lineStartPos)
     fibulaLine.GetNthControlPointPositionWorld(1, lineEndPos)
 
-    numberOfRepetitionsOfPositioningAlgorithm = 5
-    for i in range(numberOfRepetitionsOfPositioningAlgorithm):
-      fibulaLineNorm = np.linalg.norm(lineEndPos-lineStartPos)
-      fibulaLineDirection = (lineEndPos-lineStartPos)/fibulaLineNorm
-
-      fibulaStartIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','FibulaStartIntersection %d' % i)
-      fibulaEndIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','FibulaEndIntersection %d' % i)
-      fibulaStartIntersectionModel.CreateDefaultDisplayNodes()
-      fibulaEndIntersectionModel.CreateDefaultDisplayNodes()
-
-      fibulaStartIntersectionModelItemID = shNode.GetItemByDataNode(fibulaStartIntersectionModel)
-      shNode.SetItemParent(fibulaStartIntersectionModelItemID, intersectionsFolder)
-      fibulaEndIntersectionModelItemID = shNode.GetItemByDataNode(fibulaEndIntersectionModel)
-      shNode.SetItemParent(fibulaEndIntersectionModelItemID, intersectionsFolder)
+    if fitFibulaAxisChecked:
+      lineStartPos, lineEndPos, sectionsPositions, distancesToFibulaAxis = self.fitFibulaAxis(fibulaModelNode.GetPolyData(), lineStartPos, lineEndPos)
+      logging.info('Fibula axis fitted to {0} cross-sections, centroids distance to the axis: mean {1:.2f} mm, maximum {2:.2f} mm'.format(
+        len(sectionsPositions), distancesToFibulaAxis.mean(), distancesToFibulaAxis.max()))
+      fibulaLine.SetNthControlPointPositionFromArray(0,lineStartPos)
+      fibulaLine.SetNthControlPointPositionFromArray(1,lineEndPos)
+      return
 
-      self.getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin_2(fibulaModelNode,fibulaLineDirection,lineStartPos,fibulaStartIntersectionModel)
-      self.getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin_2(fibulaModelNode,fibulaLineDirection,lineEndPos,fibulaEndIntersectionModel)
-      lineStartPos = self.getCentroid(fibulaStartIntersectionModel)
-      lineEndPos = self.getCentroid(fibulaEndIntersectionModel)
+    def moveLineEndsToSectionsCentroids(fibulaCrossSectionStack, lineStartPos, lineEndPos):
+      numberOfRepetitionsOfPositioningAlgorithm = 5
+      for i in range(numberOfRepetitionsOfPositioningAlgorithm):
+        lineStartPos, lineEndPos = fibulaCrossSectionStack.getCentroidsOfSectionsThroughPoints([lineStartPos, lineEndPos])
+      return lineStartPos, lineEndPos, None
 
+    lineStartPos, lineEndPos, _ = self.refineLineOnFibulaCrossSections(fibulaModelNode.GetPolyData(), lineStartPos, lineEndPos, moveLineEndsToSectionsCentroids)
     fibulaLine.SetNthControlPointPositionFromArray(0,lineStartPos)
     fibulaLine.SetNthControlPointPositionFromArray(1,lineEndPos)
 
-    shNode.RemoveItem(intersectionsFolder)
-
+  def fitFibulaAxis(self, fibulaPolyData, lineStartPos, lineEndPos):
+    """Fit the fibula axis to the centroids of the fibula cross-sections between the line ends.
+    Returns the line ends projected onto the axis, the positions of the sections along the line
+    and the distances of their centroids to the axis (straightness profile).
+    """
+    def projectLineEndsOnFittedAxis(fibulaCrossSectionStack, lineStartPos, lineEndPos):
+      axisPoint, axisDirection, sectionsPositions, distancesToFibulaAxis = fibulaCrossSectionStack.fitLineToSectionsCentroids(
+        0, np.linalg.norm(lineEndPos-lineStartPos))
+      lineStartPos = axisPoint + ((lineStartPos-axisPoint) @ axisDirection)*axisDirection
+      lineEndPos = axisPoint + ((lineEndPos-axisPoint) @ axisDirection)*axisDirection
+      return lineStartPos, lineEndPos, (sectionsPositions, distancesToFibulaAxis)
+
+    lineStartPos, lineEndPos, (sectionsPositions, distancesToFibulaAxis) = self.refineLineOnFibulaCrossSections(
+      fibulaPolyData, lineStartPos, lineEndPos, projectLineEndsOnFittedAxis)
+    return lineStartPos, lineEndPos, sectionsPositions, distancesToFibulaAxis
+
+  def refineLineOnFibulaCrossSections(self, fibulaPolyData, lineStartPos, lineEndPos, refineLine, maximumNumberOfCrossSectionStacks=3):
+    """Move the line ends with refineLine(fibulaCrossSectionStack, lineStartPos, lineEndPos), which returns the new
+    line ends and its own results. Sections are perpendicular to the line the stack was computed for, so the stack
+    is computed again for the new line and the line refined again while it turns more than half a degree.
+    """
+    lineStartPos = np.array(lineStartPos, dtype=float)
+    lineEndPos = np.array(lineEndPos, dtype=float)
+    for j in range(maximumNumberOfCrossSectionStacks):
+      fibulaCrossSectionStack = self.getFibulaCrossSectionStack(fibulaPolyData, lineStartPos, lineEndPos)
+      oldFibulaLineDirection = (lineEndPos-lineStartPos)/np.linalg.norm(lineEndPos-lineStartPos)
+      lineStartPos, lineEndPos, results = refineLine(fibulaCrossSectionStack, lineStartPos, lineEndPos)
+      fibulaLineDirection = (lineEndPos-lineStartPos)/np.linalg.norm(lineEndPos-lineStartPos)
+      if fibulaLineDirection @ oldFibulaLineDirection > np.cos(np.radians(0.5)):
+        break
+    return lineStartPos, lineEndPos, results
+
+  @runInTimingSpan
   def create3DModelOfTheReconstruction(self):
     parameterNode = self.getParameterNode()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
-    planeList = createListFromFolderID(self.getMandiblePlanesFolderItemID())
+    planeList = self.getFolderChildrenDataNodes(self.getMandiblePlanesFolderItemID())
+
+    useVoxelBooleanOperationsChecked = parameterNode.GetParameter("useVoxelBooleanOperations") == "True"
+    numberOfWorkerThreads = int(parameterNode.GetParameter("numberOfWorkerThreads") or 1)
+
+    self.updateReconstructionAtFullResolution()
 
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    scaledFibulaPiecesFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Scaled Fibula Pieces")
-    scaledFibulaPiecesTransformsFolder = shNode.CreateFolderItem(self.getParentFolderItemID(),"Scaled Fibula Pieces Transforms")
-    transformedFibulaPiecesFolder = shNode.GetItemByName("Transformed Fibula Pieces")
-    transformedFibulaPiecesList = createListFromFolderID(transformedFibulaPiecesFolder)
-    cutBonesList = createListFromFolderID(shNode.GetItemByName("Cut Bones"))
+    transformedFibulaPiecesFolder = self.getFolderItemID("Transformed Fibula Pieces")
+    transformedFibulaPiecesList = self.getFolderChildrenDataNodes(transformedFibulaPiecesFolder)
+    cutBonesList = self.getFolderChildrenDataNodes(self.getFolderItemID("Cut Bones"))
 
     if len(transformedFibulaPiecesList) == 0:
       return
 
+    mandibleReconstructionModel = slicer.modules.models.logic().AddModel(cutBonesList[-1].GetPolyData())
+    mandibleReconstructionModel.SetName('Mandible Reconstruction')
+    mandibleReconstructionModelItemID = shNode.GetItemByDataNode(mandibleReconstructionModel)
+    self.setItemParent(mandibleReconstructionModelItemID, self.getParentFolderItemID())
+
+    if useVoxelBooleanOperationsChecked:
+      #Voxel union does not need the pieces to be scaled to overlap
+      mandibleReconstructionModel.SetAndObservePolyData(self.getVoxelBooleanOperationsResult(cutBonesList[-1].GetPolyData(),
+        [transformedFibulaPiece.GetPolyData() for transformedFibulaPiece in transformedFibulaPiecesList], []))
+      return
+
+    scaledFibulaPiecesList = []
     for i in range(len(transformedFibulaPiecesList)):
       or0 = np.zeros(3)
       planeList[i].GetOrigin(or0)
@@ -3163,10 +3488,6 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       planeList[i+1].GetOrigin(or1)
       origin = (or0+or1)/2
 
-      scaleTransformNode = slicer.vtkMRMLLinearTransformNode()
-      scaleTransformNode.SetName("Scale Bone Piece {0} Transform".format(i))
-      slicer.mrmlScene.AddNode(scaleTransformNode)
-
       scaleTransform = vtk.vtkTransform()
       scaleTransform.PostMultiply()
       scaleTransform.Translate(-origin)
@@ -3174,39 +3495,35 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       scaleTransform.Scale(1.0001, 1.0001, 1.0001)
       scaleTransform.Translate(origin)
 
-      scaleTransformNode.SetMatrixTransformToParent(scaleTransform.GetMatrix())
-      scaleTransformNode.UpdateScene(slicer.mrmlScene)
-
-      scaledFibulaPiece = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode',slicer.mrmlScene.GetUniqueNameByString('Scaled ' + cutBonesList[i].GetName()))
-      scaledFibulaPiece.CreateDefaultDisplayNodes()
-      scaledFibulaPiece.CopyContent(transformedFibulaPiecesList[i])
-      scaledFibulaPieceDisplayNode = scaledFibulaPiece.GetDisplayNode()
-      scaledFibulaPieceDisplayNode.SetColor(transformedFibulaPiecesList[i].GetDisplayNode().GetColor())
-      scaledFibulaPieceDisplayNode.SetSliceIntersectionVisibility(True)
-
-      scaledFibulaPiece.SetAndObserveTransformNodeID(scaleTransformNode.GetID())
-      scaledFibulaPiece.HardenTransform()
-
-      scaledFibulaPieceItemID = shNode.GetItemByDataNode(scaledFibulaPiece)
-      shNode.SetItemParent(scaledFibulaPieceItemID, scaledFibulaPiecesFolder)
-
-      scaleTransformNodeItemID = shNode.GetItemByDataNode(scaleTransformNode)
-      shNode.SetItemParent(scaleTransformNodeItemID, scaledFibulaPiecesTransformsFolder)
-
-    shNode.RemoveItem(scaledFibulaPiecesTransformsFolder)
-
-    scaledFibulaPiecesList = createListFromFolderID(scaledFibulaPiecesFolder)
-
-    mandibleReconstructionModel = slicer.modules.models.logic().AddModel(cutBonesList[-1].GetPolyData())
-    mandibleReconstructionModel.SetName('Mandible Reconstruction')
-    mandibleReconstructionModelItemID = shNode.GetItemByDataNode(mandibleReconstructionModel)
-    shNode.SetItemParent(mandibleReconstructionModelItemID, self.getParentFolderItemID())
+      scaledFibulaPiecesList.append(transformPolyData(transformedFibulaPiecesList[i].GetPolyData(), scaleTransform))
 
+    startTime = time.time()
+    self.unionReconstructionPieces(mandibleReconstructionModel, cutBonesList[-1].GetPolyData(), scaledFibulaPiecesList, numberOfWorkerThreads)
+    logging.info('Reconstruction union of {0} pieces: {1:.2f} seconds'.format(len(scaledFibulaPiecesList), time.time()-startTime))
+
+  def unionReconstructionPieces(self, mandibleReconstructionModel, resectedMandiblePolyData, fibulaPiecesPolyDataList, numberOfThreads=1):
+    """Balanced union of the fibula pieces and the resected mandible into the model, done again with Combine Models
+    if it fails."""
+    #Consecutive pieces touch each other and the resected mandible touches the first and last pieces,
+    #so every pairwise union of the tree is between touching meshes
+    try:
+      mandibleReconstructionModel.SetAndObservePolyData(getBalancedUnionOfPolyData(list(fibulaPiecesPolyDataList) + [resectedMandiblePolyData], numberOfThreads))
+    except RuntimeError:
+      #Redo the whole union serially with Combine Models, which raises an error if a piece cannot be combined
+      logging.warning('Balanced union of the reconstruction failed, using Combine Models on each piece instead')
+      self.combineReconstructionPiecesWithCombineModels(mandibleReconstructionModel, resectedMandiblePolyData, fibulaPiecesPolyDataList)
+
+  def combineReconstructionPiecesWithCombineModels(self, mandibleReconstructionModel, resectedMandiblePolyData, fibulaPiecesPolyDataList):
     combineModelsLogic = slicer.modules.combinemodels.widgetRepresentation().self().logic
-    for i in range(len(scaledFibulaPiecesList)):
-      combineModelsLogic.process(mandibleReconstructionModel, scaledFibulaPiecesList[i], mandibleReconstructionModel, 'union')
-
-    shNode.RemoveItem(scaledFibulaPiecesFolder)
+    mandibleReconstructionModel.SetAndObservePolyData(resectedMandiblePolyData)
+    fibulaPieceModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', slicer.mrmlScene.GetUniqueNameByString('Scaled Fibula Piece'))
+    try:
+      for fibulaPiecePolyData in fibulaPiecesPolyDataList:
+        fibulaPieceModel.SetAndObservePolyData(fibulaPiecePolyData)
+        combineModelsLogic.process(mandibleReconstructionModel, fibulaPieceModel, mandibleReconstructionModel, 'union')
+        filterRunCounter.countRun("CombineModels")
+    finally:
+      slicer.mrmlScene.RemoveNode(fibulaPieceModel)
     
 #
 # BoneReconstructionPlannerTest
@@ -3228,6 +3545,19 @@ class BoneReconstructionPlannerTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
+    self.test_PlanSegmentsUpdate()
+    self.test_FibulaCrossSectionStack()
+    self.test_FibulaSegmentsCutter()
+    self.test_PolyDataDiskCache()
+    self.test_RecomputeScheduler()
+    self.test_TimingSpans()
+    self.test_FilterRunCounter()
+    self.test_PlanningWorker()
+    self.test_PlanesSectionsExtents()
+    self.test_RigidTransformMatrices()
+    self.test_FibulaPlanesPositions()
+    self.test_BalancedUnionOfPolyData()
+    self.test_SurfacesGapAnalyzer()
     self.test_BoneReconstructionPlanner1()
 
   def test_BoneReconstructionPlanner1(self):
@@ -3276,6 +3606,630 @@ class BoneReconstructionPlannerTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay('Test passed')
 
+  def test_PlanSegmentsUpdate(self):
+    """Only the segments whose planes moved are cut again."""
+    plan = BoneReconstructionPlan()
+    plan.setMandiblePlanes([[0,0,0], [20,0,0], [40,0,0], [60,0,0]], np.tile(np.eye(3), (4,1,1)))
+    plan.fibulaPlanesPositionA = np.array([[0.,0.,0.], [25.,0.,0.], [50.,0.,0.]])
+    plan.fibulaPlanesPositionB = plan.fibulaPlanesPositionA + [20.,0.,0.]
+    plan.mandibleAxisToFibulaRotationMatrices = np.tile(np.eye(3), (3,1,1))
+    previousPlan = plan.copy()
+    self.assertEqual(plan.getSegmentsUpdate(previousPlan), [])
+    self.assertEqual(plan.getSegmentsUpdate(None), [0, 1, 2])
+
+    #A mandible plane is shared by two segments
+    plan.mandiblePlanesOrigins[1] += [0,1,0]
+    self.assertEqual(plan.getSegmentsUpdate(previousPlan), [0, 1])
+
+    #A segment that only slides along the fibula is cut again too
+    plan = previousPlan.copy()
+    plan.fibulaPlanesPositionA[2] += [1,0,0]
+    plan.fibulaPlanesPositionB[2] += [1,0,0]
+    self.assertEqual(plan.getSegmentsUpdate(previousPlan), [2])
+
+    plan = previousPlan.copy()
+    plan.mandibleAxisToFibulaRotationMatrices[1] = [[0,-1,0], [1,0,0], [0,0,1]]
+    self.assertEqual(plan.getSegmentsUpdate(previousPlan), [1])
+
+    plan.setMandiblePlanes(plan.mandiblePlanesOrigins[:3], plan.mandiblePlanesAxes[:3])
+    self.assertEqual(plan.getSegmentsUpdate(previousPlan), [0, 1])
+
+    self.delayDisplay('Test passed')
+
+  def createCylinderPolyData(self, center, radius=5., height=100., resolution=64):
+    """Closed triangulated cylinder along Z."""
+    cylinderSource = vtk.vtkCylinderSource()
+    cylinderSource.SetRadius(radius)
+    cylinderSource.SetHeight(height)
+    cylinderSource.SetResolution(resolution)
+    cylinderSource.CappingOn()
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputConnection(cylinderSource.GetOutputPort())
+    triangleFilter.Update()
+    cylinderTransform = vtk.vtkTransform()
+    cylinderTransform.Translate(center)
+    cylinderTransform.RotateX(90)
+    return transformPolyData(triangleFilter.GetOutput(), cylinderTransform)
+
+  def createSyntheticPlan(self, mandiblePlanesOffset=0.):
+    """Plan of three segments with mandible planes at known frames and a fibula line along Z from 10 to 280."""
+    mandiblePlanesOrigins = np.array([[0.,0.,0.], [30.,20.,0.], [60.,30.,0.], [90.+mandiblePlanesOffset,25.,0.]])
+    mandiblePlanesAxes = []
+    for i in range(len(mandiblePlanesOrigins)):
+      planeZ = np.array([1.,0.3*(i-1.5),0.])
+      planeZ /= np.linalg.norm(planeZ)
+      planeY = np.array([0.,0.,1.])
+      mandiblePlanesAxes.append([np.cross(planeY, planeZ), planeY, planeZ])
+    plan = BoneReconstructionPlan()
+    plan.setMandiblePlanes(mandiblePlanesOrigins, np.array(mandiblePlanesAxes))
+    plan.setFibulaLine([0.,0.,10.], [0.,0.,280.], False)
+    return plan
+
+  def test_FibulaCrossSectionStack(self):
+    """Sections of a cylinder parallel to the stack line are centered on the cylinder axis and enclose its polygon."""
+    cylinderPolyData = self.createCylinderPolyData([3.,2.,0.])
+    lineStartPos = np.array([0.,0.,-30.])
+    lineEndPos = np.array([0.,0.,30.])
+    fibulaCrossSectionStack = FibulaCrossSectionStack(cylinderPolyData, lineStartPos, lineEndPos)
+    self.assertTrue(fibulaCrossSectionStack.isValidFor(cylinderPolyData, lineStartPos, lineEndPos))
+    self.assertFalse(fibulaCrossSectionStack.isValidFor(cylinderPolyData, lineStartPos, lineEndPos+[1.,0.,0.]))
+    self.assertFalse(fibulaCrossSectionStack.isValidFor(cylinderPolyData, lineStartPos, lineEndPos, notLeftFibula=True))
+
+    centroids = fibulaCrossSectionStack.getCentroidsOfSectionsThroughPoints([[0.,0.,-20.], [0.,0.,10.25]])
+    np.testing.assert_allclose(centroids, [[3.,2.,-20.], [3.,2.,10.25]], atol=1e-6)
+
+    #Sections between the caps are regular polygons of the cylinder resolution, the stack spans the whole mesh
+    polygonArea = 0.5*64*5.**2*np.sin(2*np.pi/64)
+    np.testing.assert_allclose(fibulaCrossSectionStack.sectionsAreas[1:-1], polygonArea, rtol=1e-6)
+    np.testing.assert_allclose(fibulaCrossSectionStack.getAreasAtPositionsAlongLine([-15., 0., 12.3, 75.]), polygonArea, rtol=1e-6)
+
+    #Tilted segment of the same length moved onto the axis
+    segmentStart, segmentEnd, iterations, residual = fibulaCrossSectionStack.centerSegmentOnSections(
+      np.array([0.,0.,-10.]), np.array([2.,1.,10.]), 20.)
+    np.testing.assert_allclose(segmentStart[:2], [3.,2.], atol=0.05)
+    np.testing.assert_allclose(segmentEnd[:2], [3.,2.], atol=0.05)
+    self.assertAlmostEqual(np.linalg.norm(segmentEnd-segmentStart), 20.)
+
+    axisPoint, axisDirection, sectionsPositions, distancesToFibulaAxis = fibulaCrossSectionStack.fitLineToSectionsCentroids(0, 60)
+    np.testing.assert_allclose(axisDirection, [0.,0.,1.], atol=1e-6)
+    np.testing.assert_allclose(axisPoint[:2], [3.,2.], atol=1e-6)
+    self.assertLess(distancesToFibulaAxis.max(), 1e-6)
+
+    #Modified polydata invalidates the stack
+    cylinderPolyData.Modified()
+    self.assertFalse(fibulaCrossSectionStack.isValidFor(cylinderPolyData, lineStartPos, lineEndPos))
+
+    self.delayDisplay('Test passed')
+
+  def test_FibulaSegmentsCutter(self):
+    """Segments cut from the slabs of sorted triangles are the same as clipping the whole model."""
+    #Short triangles so that the slabs leave out most of the model
+    subdivisionFilter = vtk.vtkLinearSubdivisionFilter()
+    subdivisionFilter.SetInputData(self.createCylinderPolyData([3.,2.,0.]))
+    subdivisionFilter.SetNumberOfSubdivisions(3)
+    subdivisionFilter.Update()
+    cylinderPolyData = subdivisionFilter.GetOutput()
+    segmentsPlanesOrigins = [[[0.,0.,-30.], [0.,0.,-10.]], [[0.,0.,-5.], [0.,0.,20.]], [[8.,2.,-10.], [8.,2.,10.]]]
+    #Oblique planes with normals pointing in any direction and not normalized, the last ones at 45 degrees
+    #with their origins on the cylinder surface
+    segmentsPlanesNormals = [[[0.,0.3,1.], [0.,0.,1.]], [[0.2,0.,-1.], [0.,-0.4,1.]], [[2.,0.,2.], [1.,0.,1.]]]
+    fibulaSegmentsCutter = FibulaSegmentsCutter(cylinderPolyData)
+    self.assertTrue(fibulaSegmentsCutter.isValidFor(cylinderPolyData))
+    slabTrianglesIndices = fibulaSegmentsCutter.getSlabTrianglesIndices(segmentsPlanesOrigins[2], [[1.,0.,1.], [-1.,0.,-1.]])
+    self.assertLess(len(slabTrianglesIndices), cylinderPolyData.GetNumberOfCells()/2)
+    for numberOfThreads in [1, 2]:
+      segmentsPolyData = fibulaSegmentsCutter.cutSegmentsBetweenPlanes(segmentsPlanesOrigins, segmentsPlanesNormals, numberOfThreads)
+      self.assertEqual(len(segmentsPolyData), 3)
+      for segmentPolyData, planesOrigins, planesNormals in zip(segmentsPolyData, segmentsPlanesOrigins, segmentsPlanesNormals):
+        planeCollection = vtk.vtkPlaneCollection()
+        for origin, normal, otherOrigin in zip(planesOrigins, planesNormals, planesOrigins[::-1]):
+          normal = np.array(normal)/np.linalg.norm(normal)
+          plane = vtk.vtkPlane()
+          plane.SetOrigin(origin)
+          plane.SetNormal(normal if normal @ (np.array(otherOrigin)-origin) > 0 else -normal)
+          planeCollection.AddItem(plane)
+        clipper = vtk.vtkClipClosedSurface()
+        clipper.SetInputData(cylinderPolyData)
+        clipper.SetClippingPlanes(planeCollection)
+        clipper.GenerateFacesOn()
+        clipper.Update()
+
+        segmentMassProperties = vtk.vtkMassProperties()
+        segmentMassProperties.SetInputData(segmentPolyData)
+        clippedMassProperties = vtk.vtkMassProperties()
+        clippedMassProperties.SetInputData(clipper.GetOutput())
+        self.assertGreater(clippedMassProperties.GetVolume(), 0)
+        self.assertAlmostEqual(segmentMassProperties.GetVolume(), clippedMassProperties.GetVolume(), places=4)
+        self.assertAlmostEqual(segmentMassProperties.GetSurfaceArea(), clippedMassProperties.GetSurfaceArea(), places=4)
+        np.testing.assert_allclose(segmentPolyData.GetBounds(), clipper.GetOutput().GetBounds(), atol=1e-6)
+
+    self.delayDisplay('Test passed')
+
+  def test_PolyDataDiskCache(self):
+    """Entries are read back, incomplete entries are misses and the least recently used entries are evicted."""
+    import shutil, tempfile
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+      polyDataList = [self.createCylinderPolyData([0.,0.,0.]), self.createCylinderPolyData([0.,0.,0.], resolution=16)]
+      cache = PolyDataDiskCache(cacheDirectory, maximumSize=2**30)
+      keys = [PolyDataDiskCache.getKey("surface", i) for i in range(3)]
+      self.assertIsNone(cache.get(keys[0]))
+      cache.put(keys[0], polyDataList)
+      cachedPolyDataList = cache.get(keys[0], len(polyDataList))
+      self.assertEqual(len(cachedPolyDataList), 2)
+      for cachedPolyData, polyData in zip(cachedPolyDataList, polyDataList):
+        self.assertEqual(cachedPolyData.GetNumberOfPoints(), polyData.GetNumberOfPoints())
+        self.assertEqual(cachedPolyData.GetNumberOfCells(), polyData.GetNumberOfCells())
+        np.testing.assert_allclose(getPointsArrayOfPolyData(cachedPolyData), getPointsArrayOfPolyData(polyData))
+      self.assertIsNone(cache.get(keys[0], 3))
+
+      #Room for two entries, the least recently used one is evicted when the third one is added
+      entrySize = cache.getEntries()[0][1]
+      cache.maximumSize = 2*entrySize + entrySize//2
+      cache.put(keys[1], polyDataList)
+      now = time.time()
+      os.utime(cache.getEntryDirectory(keys[0]), (now-20, now-20))
+      os.utime(cache.getEntryDirectory(keys[1]), (now-10, now-10))
+      self.assertIsNotNone(cache.get(keys[0]))
+      cache.put(keys[2], polyDataList)
+      self.assertIsNotNone(cache.get(keys[0]))
+      self.assertIsNone(cache.get(keys[1]))
+      self.assertIsNotNone(cache.get(keys[2]))
+      self.assertEqual(sorted(key for key, size, lastAccessTime in cache.getEntries()), sorted([keys[0], keys[2]]))
+
+      #An entry with a missing file is a miss
+      os.remove(os.path.join(cache.getEntryDirectory(keys[2]), "1_points.npy"))
+      self.assertIsNone(cache.get(keys[2]))
+
+      cache.clear()
+      self.assertEqual(cache.getEntries(), [])
+      self.assertEqual(os.listdir(cacheDirectory), [])
+    finally:
+      shutil.rmtree(cacheDirectory, ignore_errors=True)
+
+    self.delayDisplay('Test passed')
+
+  def test_RecomputeScheduler(self):
+    """Requests are coalesced, asynchronous recomputes are replaced by newer requests until they are for a request older
+    than maximumWaitTime, then they hold new requests until they finish."""
+    callbackResults = []
+    def callback():
+      return callbackResults.pop(0) if callbackResults else None
+
+    scheduler = RecomputeScheduler(callback, minimumInterval=0.02, maximumInterval=1.0)
+    self.assertEqual(scheduler.getDebounceInterval(), scheduler.initialInterval)
+    scheduler.request()
+    scheduler.request()
+    self.assertTrue(scheduler.isPending())
+    self.assertEqual(scheduler.getStatistics()["numberOfDroppedRequests"], 1)
+    #Timeouts are triggered directly instead of waiting for the timer
+    scheduler.timer.stop()
+    scheduler.onTimeout()
+    self.assertFalse(scheduler.isPending())
+    self.assertFalse(scheduler.running)
+    self.assertEqual(scheduler.getStatistics()["numberOfRecomputes"], 1)
+
+    callbackResults.append(True)
+    scheduler.request()
+    scheduler.timer.stop()
+    scheduler.onTimeout()
+    self.assertTrue(scheduler.running)
+    scheduler.request()
+    self.assertTrue(scheduler.timer.isActive())
+    callbackResults.append(True)
+    scheduler.timer.stop()
+    scheduler.onTimeout()
+    self.assertTrue(scheduler.running)
+    self.assertEqual(scheduler.getStatistics()["numberOfReplacedRecomputes"], 1)
+    #Too old to be replaced
+    scheduler.asynchronousRequestTime -= scheduler.maximumWaitTime
+    scheduler.request()
+    self.assertFalse(scheduler.timer.isActive())
+    self.assertTrue(scheduler.isPending())
+    scheduler.finishAsynchronousRecompute(0.5)
+    self.assertFalse(scheduler.running)
+    self.assertTrue(scheduler.timer.isActive())
+    statistics = scheduler.getStatistics()
+    self.assertEqual(statistics["numberOfRecomputes"], 2)
+    self.assertEqual(statistics["recomputeTimes"][-1], 0.5)
+    self.assertGreaterEqual(statistics["debounceInterval"], scheduler.minimumInterval)
+    self.assertLessEqual(statistics["debounceInterval"], scheduler.maximumInterval)
+
+    #A failed asynchronous recompute is not measured
+    callbackResults.append(True)
+    scheduler.timer.stop()
+    scheduler.onTimeout()
+    scheduler.finishAsynchronousRecompute()
+    self.assertFalse(scheduler.running)
+    self.assertEqual(scheduler.getStatistics()["numberOfRecomputes"], 2)
+
+    scheduler.stop()
+    self.assertFalse(scheduler.isPending())
+
+    self.delayDisplay('Test passed')
+
+  def test_TimingSpans(self):
+    """Spans are broken down by category and name, counters are kept apart and exported to the trace."""
+    import tempfile
+    timingSpans = TimingSpans(maximumNumberOfSpans=3, maximumNumberOfCounters=2)
+    startTime = time.perf_counter()
+    timingSpans.addSpan("cutFibulaSegments", startTime, startTime+0.1)
+    timingSpans.addSpan("cutFibulaSegments", startTime, startTime+0.3)
+    timingSpans.addSpan("cutFibulaSegments", startTime, startTime+0.05, category="worker")
+    for i in range(5):
+      timingSpans.addCounters("scene", {"numberOfNodes": i})
+    self.assertEqual(len(timingSpans.getSpans()), 3)
+    self.assertEqual([counters["args"]["numberOfNodes"] for counters in timingSpans.getCounters()], [3, 4])
+
+    latencyBreakdown = timingSpans.getLatencyBreakdown()
+    self.assertEqual([(row["category"], row["name"], row["count"]) for row in latencyBreakdown],
+      [("planning", "cutFibulaSegments", 2), ("worker", "cutFibulaSegments", 1)])
+    self.assertAlmostEqual(latencyBreakdown[0]["mean"], 0.2)
+    self.assertAlmostEqual(latencyBreakdown[0]["maximum"], 0.3)
+    self.assertAlmostEqual(latencyBreakdown[0]["last"], 0.3)
+
+    with timingSpans.span("nested"):
+      pass
+    self.assertEqual(timingSpans.getSpans()[-1]["name"], "nested")
+
+    traceFileName = os.path.join(tempfile.mkdtemp(), "trace.json")
+    timingSpans.exportChromeTrace(traceFileName)
+    with open(traceFileName) as traceFile:
+      traceEvents = json.load(traceFile)["traceEvents"]
+    os.remove(traceFileName)
+    os.rmdir(os.path.dirname(traceFileName))
+    self.assertEqual([traceEvent["ph"] for traceEvent in traceEvents], ["X", "X", "X", "C", "C"])
+
+    numberOfAddedSpans = timingSpans.numberOfAddedSpans
+    timingSpans.clear()
+    self.assertEqual(timingSpans.getSpans(), [])
+    self.assertEqual(timingSpans.getCounters(), [])
+    self.assertNotEqual(timingSpans.numberOfAddedSpans, numberOfAddedSpans)
+
+    self.delayDisplay('Test passed')
+
+  def test_FilterRunCounter(self):
+    """Runs are counted per thread, runs of pool tasks are counted for the thread that submitted them."""
+    counter = FilterRunCounter()
+    counter.countRun("vtkCutter")
+    counter.countRun("vtkClipPolyData", 2)
+    startCounts = counter.getCounts()
+
+    def cutSegment(i):
+      counter.countRun("vtkClipClosedSurface")
+      return i
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      self.assertEqual(list(executor.map(counter.countedForCurrentThread(cutSegment), range(8))), list(range(8)))
+      #Not wrapped, counted for the pool threads
+      list(executor.map(cutSegment, range(3)))
+      #Counts of other threads are not returned, the pool threads are still alive so their identifiers are not reused
+      otherThreadCounts = []
+      thread = threading.Thread(target=lambda: otherThreadCounts.append(counter.getCounts()))
+      thread.start()
+      thread.join()
+      self.assertEqual(otherThreadCounts, [collections.Counter()])
+    self.assertEqual(dict(counter.getCounts()), {"vtkCutter": 1, "vtkClipPolyData": 2, "vtkClipClosedSurface": 8})
+    self.assertEqual(dict(counter.getCounts() - startCounts), {"vtkClipClosedSurface": 8})
+
+    self.delayDisplay('Test passed')
+
+  def test_PlanningWorker(self):
+    """Submitting a job cancels the one in flight and only the result of the newest one is passed on."""
+    fibulaPolyData = self.createCylinderPolyData([0.,0.,150.], radius=8., height=300.)
+    snapshot = {
+      "plan": self.createSyntheticPlan(),
+      "previousPlan": BoneReconstructionPlan(),
+      "recomputeFibulaPlanesPositions": True,
+      "lastFibulaPlanesPositionA": None,
+      "lastFibulaPlanesPositionB": None,
+      "fibulaPolyData": fibulaPolyData,
+      "fibulaCrossSectionStack": None,
+      "previewFibulaPolyData": fibulaPolyData,
+      "fibulaSegmentsCutter": None,
+      "inputModelsChanged": False,
+      "initialSpace": 15.,
+      "intersectionPlaceOfFibulaPlanes": 0.,
+      "intersectionDistanceMultiplier": 1.,
+      "additionalBetweenSpaceOfFibulaPlanes": 2.,
+      "useMoreExactVersionOfPositioningAlgorithm": True,
+      "useVectorizedBetweenSpaceComputation": True,
+      "numberOfWorkerThreads": 2,
+      "timingSpans": TimingSpans(),
+      "startTime": time.time(),
+    }
+    cancelEvent = threading.Event()
+    cancelEvent.set()
+    with self.assertRaises(PlanningJobCancelled):
+      computeReconstructionFromPlanningSnapshot(snapshot, cancelEvent)
+
+    results = []
+    errors = []
+    worker = PlanningWorker(results.append, errors.append)
+    try:
+      #The first job only ends once the second one is submitted, its result must not be passed on
+      jobStarted = threading.Event()
+      releaseJob = threading.Event()
+      firstJobCancelEvents = []
+      def blockingJob(cancelEvent):
+        firstJobCancelEvents.append(cancelEvent)
+        jobStarted.set()
+        releaseJob.wait(10)
+        return "superseded result"
+      worker.submit(blockingJob)
+      self.assertTrue(jobStarted.wait(10))
+      worker.submit(computeReconstructionFromPlanningSnapshot, snapshot)
+      self.assertTrue(firstJobCancelEvents[0].is_set())
+      releaseJob.set()
+      future = worker.future
+      future.result(60)
+      #Polls are triggered directly instead of waiting for the timer
+      worker.poll()
+      self.assertFalse(worker.isBusy())
+      self.assertEqual(errors, [])
+      self.assertEqual(len(results), 1)
+      result = results[0]
+      self.assertIs(result["plan"], snapshot["plan"])
+      self.assertEqual(result["segmentsToUpdate"], [0, 1, 2])
+      self.assertEqual(sorted(result["transformedFibulaPiecesPolyData"]), [0, 1, 2])
+      #Pieces are swapped onto the mandible: each one starts on its mandible plane
+      for i, transformedFibulaPiecePolyData in result["transformedFibulaPiecesPolyData"].items():
+        self.assertGreater(result["cutBonesPolyData"][i].GetNumberOfPoints(), 0)
+        piecePoints = vtk.util.numpy_support.vtk_to_numpy(transformedFibulaPiecePolyData.GetPoints().GetData())
+        planeOrigin = result["plan"].mandiblePlanesOrigins[i]
+        self.assertLess(np.abs((piecePoints - planeOrigin) @ result["plan"].mandiblePlanesAxes[i][2]).min(), 1e-3)
+
+      #Only the segment of the moved mandible plane is cut again from the result of the previous job
+      nextSnapshot = dict(snapshot, plan=self.createSyntheticPlan(mandiblePlanesOffset=2.), previousPlan=result["plan"],
+        fibulaCrossSectionStack=result["fibulaCrossSectionStack"], fibulaSegmentsCutter=result["fibulaSegmentsCutter"])
+      worker.submit(computeReconstructionFromPlanningSnapshot, nextSnapshot)
+      worker.future.result(60)
+      worker.poll()
+      self.assertEqual(len(results), 2)
+      self.assertEqual(results[1]["segmentsToUpdate"], [2])
+      self.assertTrue(results[1]["updateResectedMandible"])
+    finally:
+      releaseJob.set()
+      worker.shutdown()
+
+    self.delayDisplay('Test passed')
+
+  def test_PlanesSectionsExtents(self):
+    """Extents along the line of oblique sections of an ellipsoid are the same as cutting each plane with vtkCutter."""
+    ellipsoid = vtk.vtkParametricEllipsoid()
+    ellipsoid.SetXRadius(6.)
+    ellipsoid.SetYRadius(4.)
+    ellipsoid.SetZRadius(60.)
+    ellipsoidSource = vtk.vtkParametricFunctionSource()
+    ellipsoidSource.SetParametricFunction(ellipsoid)
+    ellipsoidSource.SetUResolution(60)
+    ellipsoidSource.SetVResolution(120)
+    ellipsoidSource.Update()
+    ellipsoidPolyData = ellipsoidSource.GetOutput()
+    lineStartPos = np.array([1.,0.5,-50.])
+    lineEndPos = np.array([2.,-1.,50.])
+    fibulaCrossSectionStack = FibulaCrossSectionStack(ellipsoidPolyData, lineStartPos, lineEndPos)
+
+    #More planes than fit in one key of plane sides, tilted up to 60 degrees from the sections
+    randomGenerator = np.random.default_rng(0)
+    lineDirection = fibulaCrossSectionStack.axes[2]
+    normals = randomGenerator.normal(size=(70,3))
+    normals -= np.outer(normals @ lineDirection, lineDirection)
+    normals /= np.linalg.norm(normals, axis=1)[:,np.newaxis]
+    tilts = randomGenerator.uniform(0., np.pi/3, 70)
+    normals = normals*np.sin(tilts)[:,np.newaxis] + np.outer(np.cos(tilts)*randomGenerator.choice([-1.,1.], 70), lineDirection)
+    for origin in [lineStartPos + 0.3*(lineEndPos-lineStartPos), lineStartPos + 0.8*(lineEndPos-lineStartPos)]:
+      sectionsExtents = fibulaCrossSectionStack.getPlanesSectionsExtentsAlongLine(origin, normals)
+      for normal, sectionExtent in zip(normals, sectionsExtents):
+        sectionZ = getPointsArrayOfPolyData(getPlaneSectionOfPolyData(ellipsoidPolyData, origin, normal)) @ lineDirection
+        self.assertGreater(len(sectionZ), 0)
+        self.assertAlmostEqual(sectionExtent, sectionZ.max()-sectionZ.min(), delta=1e-4)
+
+    #A plane that misses the ellipsoid
+    self.assertEqual(fibulaCrossSectionStack.getPlanesSectionsExtentsAlongLine(lineStartPos + [0.,0.,200.], [[0.,0.,1.]])[0], 0)
+
+    self.delayDisplay('Test passed')
+
+  def test_RigidTransformMatrices(self):
+    """Batched rotations between frames and rigid transforms are the same as composing vtkTransforms."""
+    randomGenerator = np.random.default_rng(1)
+    numberOfFrames = 20
+    #Random orthonormal frames stored as rows, right-handed like the plane frames
+    axes1, axes2 = [np.linalg.qr(randomGenerator.normal(size=(numberOfFrames,3,3)))[0].swapaxes(1,2) for i in range(2)]
+    for axes in [axes1, axes2]:
+      axes[:,2] *= np.sign(np.linalg.det(axes))[:,np.newaxis]
+    sourceOrigins = randomGenerator.uniform(-100., 100., (numberOfFrames,3))
+    targetOrigins = randomGenerator.uniform(-100., 100., (numberOfFrames,3))
+
+    rotations = getRotationMatricesBetweenAxes(axes1, axes2)
+    transforms = getRigidTransformMatrices(rotations, sourceOrigins, targetOrigins)
+    transformedOrigins, transformedAxes = transformPlaneFrames(transforms, sourceOrigins, axes1)
+    for i in range(numberOfFrames):
+      axes1ToWorldMatrix = vtk.vtkMatrix4x4()
+      axes2ToWorldMatrix = vtk.vtkMatrix4x4()
+      for row in range(3):
+        for column in range(3):
+          axes1ToWorldMatrix.SetElement(row, column, axes1[i,row,column])
+          axes2ToWorldMatrix.SetElement(row, column, axes2[i,row,column])
+      axes2ToWorldMatrix.Invert()
+      rotationMatrix = vtk.vtkMatrix4x4()
+      vtk.vtkMatrix4x4.Multiply4x4(axes2ToWorldMatrix, axes1ToWorldMatrix, rotationMatrix)
+
+      transform = vtk.vtkTransform()
+      transform.PostMultiply()
+      transform.Translate(-sourceOrigins[i])
+      transform.Concatenate(rotationMatrix)
+      transform.Translate(targetOrigins[i])
+      transformMatrix = np.array([[transform.GetMatrix().GetElement(row, column) for column in range(4)] for row in range(4)])
+      np.testing.assert_allclose(transforms[i], transformMatrix, atol=1e-9)
+
+      #The source frame is moved onto the target frame
+      np.testing.assert_allclose(transform.TransformPoint(sourceOrigins[i]), targetOrigins[i], atol=1e-9)
+      np.testing.assert_allclose(transformedOrigins[i], targetOrigins[i], atol=1e-9)
+      np.testing.assert_allclose([transform.TransformVector(axis) for axis in axes1[i]], axes2[i], atol=1e-9)
+      np.testing.assert_allclose(transformedAxes[i], axes2[i], atol=1e-9)
+
+    #A single pair of frames gives a single rotation
+    np.testing.assert_allclose(getRotationMatricesBetweenAxes(axes1[0], axes2[0]), rotations[0])
+
+    self.delayDisplay('Test passed')
+
+  def test_FibulaPlanesPositions(self):
+    """Fibula planes of a synthetic plan are computed without a scene: segments keep their mandible lengths and
+    plane orientations and are stacked along the fibula line with the space between them."""
+    fibulaPolyData = self.createCylinderPolyData([0.,0.,150.], radius=8., height=300.)
+    initialSpace = 15.
+    additionalBetweenSpaceOfFibulaPlanes = 2.
+    for useMoreExactVersionOfPositioningAlgorithm in [False, True]:
+      plan = self.createSyntheticPlan()
+      plan.computeFibulaPlanesPositions(fibulaPolyData, initialSpace, 0., 1., additionalBetweenSpaceOfFibulaPlanes,
+        useMoreExactVersionOfPositioningAlgorithm)
+      fibulaPlanesAOrigins, fibulaPlanesAAxes, fibulaPlanesBOrigins, fibulaPlanesBAxes = plan.getFibulaPlanesFrames()
+      mandibleSegmentsAxes, mandibleSegmentsLengths = plan.getMandibleSegmentsAxes()
+      fibulaAxes = plan.getFibulaAxes()
+      np.testing.assert_allclose(fibulaAxes[2], [0.,0.,1.], atol=1e-9)
+
+      #The cylinder is centered on the fibula line
+      np.testing.assert_allclose(fibulaPlanesAOrigins[:,:2], 0., atol=1e-6)
+      np.testing.assert_allclose(fibulaPlanesBOrigins[:,:2], 0., atol=1e-6)
+      self.assertAlmostEqual(fibulaPlanesAOrigins[0,2], 10. + initialSpace)
+      np.testing.assert_allclose(fibulaPlanesBOrigins[:,2] - fibulaPlanesAOrigins[:,2], mandibleSegmentsLengths)
+      np.testing.assert_allclose(fibulaPlanesAOrigins[1:,2] - fibulaPlanesBOrigins[:-1,2], plan.betweenSpace + additionalBetweenSpaceOfFibulaPlanes)
+      self.assertTrue(np.all(plan.betweenSpace > 0))
+
+      #Planes keep their orientation with respect to their segment
+      for i in range(plan.getNumberOfSegments()):
+        np.testing.assert_allclose(fibulaPlanesAAxes[i] @ fibulaAxes.T, plan.mandiblePlanesAxes[i] @ mandibleSegmentsAxes[i].T, atol=1e-9)
+        np.testing.assert_allclose(fibulaPlanesBAxes[i] @ fibulaAxes.T, plan.mandiblePlanesAxes[i+1] @ mandibleSegmentsAxes[i].T, atol=1e-9)
+
+      #The space between segments is the same when the fibula is cut with vtkCutter
+      cutterPlan = self.createSyntheticPlan()
+      cutterPlan.computeFibulaPlanesPositions(fibulaPolyData, initialSpace, 0., 1., additionalBetweenSpaceOfFibulaPlanes,
+        useMoreExactVersionOfPositioningAlgorithm, useVectorizedBetweenSpaceComputation=False)
+      np.testing.assert_allclose(cutterPlan.betweenSpace, plan.betweenSpace, atol=1e-4)
+
+      #Moving the last mandible plane only moves the last fibula planes
+      movedPlan = self.createSyntheticPlan(mandiblePlanesOffset=2.)
+      movedPlan.computeFibulaPlanesPositions(fibulaPolyData, initialSpace, 0., 1., additionalBetweenSpaceOfFibulaPlanes,
+        useMoreExactVersionOfPositioningAlgorithm, previousPlan=plan)
+      movedFibulaPlanesAOrigins, movedFibulaPlanesAAxes, movedFibulaPlanesBOrigins, movedFibulaPlanesBAxes = movedPlan.getFibulaPlanesFrames()
+      np.testing.assert_allclose(movedFibulaPlanesAOrigins[:2], fibulaPlanesAOrigins[:2])
+      np.testing.assert_allclose(movedFibulaPlanesBAxes[:2], fibulaPlanesBAxes[:2])
+      self.assertGreater(np.abs(movedFibulaPlanesBOrigins[2] - fibulaPlanesBOrigins[2]).max(), 0.1)
+
+    self.delayDisplay('Test passed')
+
+  def test_BalancedUnionOfPolyData(self):
+    """Pieces are united pairwise level by level, a failed union raises RuntimeError and the reconstruction is then
+    united with Combine Models."""
+    def createPointPolyData(x):
+      points = vtk.vtkPoints()
+      points.InsertNextPoint(x, 0., 0.)
+      polyData = vtk.vtkPolyData()
+      polyData.SetPoints(points)
+      return polyData
+    def getLabel(polyData):
+      return tuple(int(x) for x in getPointsArrayOfPolyData(polyData)[:,0])
+
+    #Unions are replaced by appending the points so the pairs can be followed
+    unitedPairs = []
+    failingPair = []
+    def appendPolyData(polyDataA, polyDataB, operation):
+      self.assertEqual(operation, 'union')
+      pair = (getLabel(polyDataA), getLabel(polyDataB))
+      unitedPairs.append(pair)
+      if pair in failingPair:
+        return vtk.vtkPolyData()
+      appendFilter = vtk.vtkAppendPolyData()
+      appendFilter.AddInputData(polyDataA)
+      appendFilter.AddInputData(polyDataB)
+      appendFilter.Update()
+      return appendFilter.GetOutput()
+    moduleGlobals = globals()
+    originalBooleanOperation = moduleGlobals["getBooleanOperationOfPolyData"]
+    moduleGlobals["getBooleanOperationOfPolyData"] = appendPolyData
+    try:
+      piecesPolyData = [createPointPolyData(i) for i in range(5)]
+      for numberOfThreads in [1, 2]:
+        del unitedPairs[:]
+        unionPolyData = getBalancedUnionOfPolyData(piecesPolyData, numberOfThreads)
+        self.assertEqual(getLabel(unionPolyData), (0, 1, 2, 3, 4))
+        #The last piece of an odd level is carried to the next one
+        self.assertEqual(sorted(unitedPairs), [((0,), (1,)), ((0, 1), (2, 3)), ((0, 1, 2, 3), (4,)), ((2,), (3,))])
+      self.assertEqual(getLabel(getBalancedUnionOfPolyData(piecesPolyData[:1])), (0,))
+      self.assertEqual(getBalancedUnionOfPolyData([]).GetNumberOfPoints(), 0)
+
+      failingPair.append(((0, 1), (2, 3)))
+      with self.assertRaises(RuntimeError):
+        getBalancedUnionOfPolyData(piecesPolyData)
+
+      logic = BoneReconstructionPlannerLogic()
+      combinedPieces = []
+      logic.combineReconstructionPiecesWithCombineModels = lambda *args: combinedPieces.append(args)
+      mandibleReconstructionModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+      logic.unionReconstructionPieces(mandibleReconstructionModel, piecesPolyData[4], piecesPolyData[:4])
+      self.assertEqual(combinedPieces, [(mandibleReconstructionModel, piecesPolyData[4], piecesPolyData[:4])])
+
+      del failingPair[:]
+      del combinedPieces[:]
+      logic.unionReconstructionPieces(mandibleReconstructionModel, piecesPolyData[4], piecesPolyData[:4], 2)
+      self.assertEqual(combinedPieces, [])
+      self.assertEqual(getLabel(mandibleReconstructionModel.GetPolyData()), (0, 1, 2, 3, 4))
+      slicer.mrmlScene.RemoveNode(mandibleReconstructionModel)
+    finally:
+      moduleGlobals["getBooleanOperationOfPolyData"] = originalBooleanOperation
+
+    self.delayDisplay('Test passed')
+
+  def test_SurfacesGapAnalyzer(self):
+    """Gaps between separated boxes, between boxes whose closest approach is between crossing edges and between
+    overlapping boxes (negative)."""
+    def createBoxPolyData(center, lengths, rotationAxis=None):
+      cubeSource = vtk.vtkCubeSource()
+      cubeSource.SetXLength(lengths[0])
+      cubeSource.SetYLength(lengths[1])
+      cubeSource.SetZLength(lengths[2])
+      triangleFilter = vtk.vtkTriangleFilter()
+      triangleFilter.SetInputConnection(cubeSource.GetOutputPort())
+      triangleFilter.Update()
+      boxTransform = vtk.vtkTransform()
+      boxTransform.Translate(center)
+      if rotationAxis is not None:
+        boxTransform.RotateWXYZ(45, rotationAxis)
+      return transformPolyData(triangleFilter.GetOutput(), boxTransform)
+
+    #Closest points of skew segments are inside both, of parallel segments they are at the ends
+    segmentsA = np.array([[[-1.,0.,0.], [1.,0.,0.]], [[5.,5.,5.], [6.,5.,5.]]])
+    segmentsB = np.array([[[0.,-1.,2.], [0.,1.,2.]], [[0.,3.,0.], [2.,3.,0.]]])
+    self.assertAlmostEqual(getMinimumDistanceBetweenSegments(segmentsA, segmentsB), 2.)
+    self.assertAlmostEqual(getMinimumDistanceBetweenSegments(segmentsA[:1], segmentsB[1:]), 3.)
+    self.assertAlmostEqual(getMinimumDistanceBetweenSegments(np.array([[[3.,0.,0.], [4.,0.,0.]]]), segmentsB[1:]), np.sqrt(1.+9.))
+    self.assertEqual(getMinimumDistanceBetweenSegments(segmentsA[:0], segmentsB), np.inf)
+    randomGenerator = np.random.default_rng(2)
+    randomSegmentsA = randomGenerator.uniform(-10., 10., (50,2,3))
+    randomSegmentsB = randomGenerator.uniform(-10., 10., (40,2,3)) + [15.,0.,0.]
+    self.assertAlmostEqual(getMinimumDistanceBetweenSegments(randomSegmentsA, randomSegmentsB, maximumNumberOfPairs=100),
+      getMinimumDistanceBetweenSegments(randomSegmentsA, randomSegmentsB))
+
+    gapAnalyzer = SurfacesGapAnalyzer()
+    boxPolyData = createBoxPolyData([0.,0.,0.], [10.,10.,10.])
+    separatedBoxPolyData = createBoxPolyData([13.,2.,0.], [10.,6.,6.])
+    overlappingBoxPolyData = createBoxPolyData([-9.,0.,0.], [10.,6.,6.])
+    for numberOfThreads in [1, 2]:
+      gaps = gapAnalyzer.getGapsBetweenConsecutiveSurfaces([overlappingBoxPolyData, boxPolyData, separatedBoxPolyData], numberOfThreads)
+      np.testing.assert_allclose(gaps, [-1., 3.], atol=1e-6)
+
+    #Long square bars turned 45 degrees, one along X and one along Y above it: the closest points are in the middle
+    #of their crossing edges, the points of each bar are far from the other bar
+    barAlongXPolyData = createBoxPolyData([0.,0.,0.], [20.,2.,2.], [1.,0.,0.])
+    barAlongYPolyData = createBoxPolyData([0.,0.,2*np.sqrt(2.)+1.], [2.,20.,2.], [0.,1.,0.])
+    pointsDistances = [gapAnalyzer.getDistancesToSurface(gapAnalyzer.getDistanceFunction(otherPolyData), polyData)
+      for polyData, otherPolyData in [(barAlongXPolyData, barAlongYPolyData), (barAlongYPolyData, barAlongXPolyData)]]
+    self.assertGreater(min(distances.min() for distances in pointsDistances), 2.)
+    self.assertAlmostEqual(gapAnalyzer.getGap(barAlongXPolyData, barAlongYPolyData, *pointsDistances), 1., places=6)
+    self.assertAlmostEqual(gapAnalyzer.getGapsBetweenConsecutiveSurfaces([barAlongXPolyData, barAlongYPolyData])[0], 1., places=6)
+
+    self.delayDisplay('Test passed')
+
 
 def createListFromFolderID(folderID):
   createdList = []
@@ -3284,4 +4238,1954 @@ def createListFromFolderID(folderID):
   shNode.GetItemChildren(folderID,myList)
   for i in range(myList.GetNumberOfIds()):
     createdList.append(shNode.GetItemDataNode(myList.GetId(i)))
-  return createdList
\ No newline at end of file
+  return createdList
+
+
+def getRotationMatricesBetweenAxes(axes1, axes2):
+  """Rotations that map each frame of axes1 onto the corresponding frame of axes2.
+  Frames are stored as rows (X, Y, Z) in arrays of shape (3,3) or (N,3,3). Since the
+  frames are orthonormal the world-to-axes2 rotation is just the transpose of axes2.
+  """
+  return np.matmul(np.swapaxes(axes2,-1,-2), axes1)
+
+def getRigidTransformMatrices(rotations, sourceOrigins, targetOrigins):
+  """Stack of 4x4 matrices equivalent to Translate(-source), Concatenate(rotation), Translate(target)
+  for every row of rotations (N,3,3), sourceOrigins (N,3) and targetOrigins (N,3).
+  """
+  rotations = np.asarray(rotations, dtype=float)
+  numberOfTransforms = len(rotations)
+  transforms = np.zeros((numberOfTransforms,4,4))
+  transforms[:,:3,:3] = rotations
+  transforms[:,:3,3] = np.asarray(targetOrigins) - np.einsum('nij,nj->ni', rotations, np.asarray(sourceOrigins))
+  transforms[:,3,3] = 1
+  return transforms
+
+def transformPlaneFrames(transforms, origins, axes):
+  """Apply (N,4,4) rigid transforms to plane origins (N,3) and plane axes (N,3,3) stored as rows."""
+  rotations = transforms[:,:3,:3]
+  transformedOrigins = np.einsum('nij,nj->ni', rotations, origins) + transforms[:,:3,3]
+  transformedAxes = np.matmul(axes, np.swapaxes(rotations,1,2))
+  return transformedOrigins, transformedAxes
+
+def getMandibleSegmentsAxes(mandiblePlanesOrigins, mandiblePlanesY):
+  """Axes (rows X, Y, Z) of every mandible segment and the segment lengths.
+  Z goes from a plane origin to the next one, X is the first plane Y axis crossed with Z.
+  """
+  segmentsVectors = mandiblePlanesOrigins[1:] - mandiblePlanesOrigins[:-1]
+  segmentsLengths = np.linalg.norm(segmentsVectors, axis=1)
+  mandibleAxisZ = segmentsVectors/segmentsLengths[:,np.newaxis]
+  mandibleAxisX = np.cross(mandiblePlanesY[:-1], mandibleAxisZ)
+  mandibleAxisX = mandibleAxisX/np.linalg.norm(mandibleAxisX, axis=1)[:,np.newaxis]
+  mandibleAxisY = np.cross(mandibleAxisZ, mandibleAxisX)
+  mandibleAxisY = mandibleAxisY/np.linalg.norm(mandibleAxisY, axis=1)[:,np.newaxis]
+  return np.stack((mandibleAxisX, mandibleAxisY, mandibleAxisZ), axis=-2), segmentsLengths
+
+def getFibulaAxesFromLine(lineStartPos, lineEndPos, notLeftFibulaChecked):
+  """Same axes as createFibulaAxisFromFibulaLineAndNotLeftChecked_2 but for one line (3,) or many lines (N,3)."""
+  lineVectors = np.asarray(lineEndPos, dtype=float) - np.asarray(lineStartPos, dtype=float)
+  fibulaZ = lineVectors/np.linalg.norm(lineVectors, axis=-1)[...,np.newaxis]
+  if notLeftFibulaChecked:
+    referenceDirection = np.array([0,1,0])
+  else:
+    referenceDirection = np.array([0,-1,0])
+  fibulaX = np.cross(fibulaZ, referenceDirection)
+  fibulaX = fibulaX/np.linalg.norm(fibulaX, axis=-1)[...,np.newaxis]
+  fibulaY = np.cross(fibulaZ, fibulaX)
+  fibulaY = fibulaY/np.linalg.norm(fibulaY, axis=-1)[...,np.newaxis]
+  return np.stack((fibulaX, fibulaY, fibulaZ), axis=-2)
+
+def getPlaneSectionOfPolyData(polyData, origin, normal):
+  plane = vtk.vtkPlane()
+  plane.SetOrigin(origin)
+  plane.SetNormal(normal)
+
+  cutter = vtk.vtkCutter()
+  cutter.SetInputData(polyData)
+  cutter.SetCutFunction(plane)
+  cutter.Update()
+  filterRunCounter.countRun("vtkCutter")
+
+  return cutter.GetOutput()
+
+def getPointsArrayOfPolyData(polyData):
+  if polyData.GetPoints() is None:
+    return np.zeros((0,3))
+  return vtk.util.numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+
+def getPointsAndTrianglesArraysOfPolyData(polyData):
+  """Points (N,3) and triangles point indices (M,3) arrays of a surface."""
+  if polyData.GetPolys().GetMaxCellSize() > 3 or polyData.GetNumberOfStrips() > 0:
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polyData)
+    triangleFilter.PassLinesOff()
+    triangleFilter.PassVertsOff()
+    triangleFilter.Update()
+    polyData = triangleFilter.GetOutput()
+  points = getPointsArrayOfPolyData(polyData).astype(float)
+  triangles = vtk.util.numpy_support.vtk_to_numpy(polyData.GetPolys().GetConnectivityArray()).reshape(-1,3)
+  return points, triangles
+
+def getNearestPlaneSectionOfPolyData(polyData, origin, normal):
+  connectivityFilter = vtk.vtkConnectivityFilter()
+  connectivityFilter.SetInputData(getPlaneSectionOfPolyData(polyData, origin, normal))
+  connectivityFilter.SetClosestPoint(origin)
+  connectivityFilter.SetExtractionModeToClosestPointRegion()
+  connectivityFilter.Update()
+  filterRunCounter.countRun("vtkConnectivityFilter")
+
+  return connectivityFilter.GetOutput()
+
+def getPointOfTwoPointsThatMakesLineDirectionSimilarToVector(points, vector):
+  pointsVector = (points[1]-points[0])/np.linalg.norm(points[1]-points[0])
+
+  if vtk.vtkMath.Dot(pointsVector, vector) > 0:
+    return points[1]
+  else:
+    return points[0]
+
+def appendPolyData(polyDataList):
+  appendFilter = vtk.vtkAppendPolyData()
+  for polyData in polyDataList:
+    appendFilter.AddInputData(polyData)
+  appendFilter.Update()
+
+  return appendFilter.GetOutput()
+
+def getGroupsOfNonOverlappingPolyData(polyDataList, tolerance=1e-3):
+  """Lists of indices of polydata whose bounds do not overlap, to be combined as one mesh.
+  Bounds are a conservative test: tools close to each other may end up in different groups.
+  """
+  groups = []
+  groupsBounds = []
+  for i, polyData in enumerate(polyDataList):
+    bounds = np.array(polyData.GetBounds()).reshape(3,2)
+    for group, boundsList in zip(groups, groupsBounds):
+      if all(np.any((bounds[:,0] > otherBounds[:,1] + tolerance) | (otherBounds[:,0] > bounds[:,1] + tolerance)) for otherBounds in boundsList):
+        group.append(i)
+        boundsList.append(bounds)
+        break
+    else:
+      groups.append([i])
+      groupsBounds.append([bounds])
+  return groups
+
+def getBooleanOperationOfPolyData(polyDataA, polyDataB, operation):
+  """Same boolean operation as Combine Models but on polydata, so it can run outside of the main thread."""
+  import vtkSlicerCombineModelsModuleLogicPython as vtkbool
+  booleanFilter = vtkbool.vtkPolyDataBooleanFilter()
+  if operation == 'union':
+    booleanFilter.SetOperModeToUnion()
+  elif operation == 'intersection':
+    booleanFilter.SetOperModeToIntersection()
+  elif operation == 'difference':
+    booleanFilter.SetOperModeToDifference()
+  else:
+    raise ValueError('Unknown boolean operation: ' + operation)
+  booleanFilter.SetInputData(0, polyDataA)
+  booleanFilter.SetInputData(1, polyDataB)
+  booleanFilter.Update()
+  filterRunCounter.countRun("vtkPolyDataBooleanFilter")
+
+  return booleanFilter.GetOutput()
+
+def getBalancedUnionOfPolyData(polyDataList, numberOfThreads=1):
+  """Union of the surfaces as a balanced tree of pairwise unions of neighbours in the list: log2(n) levels
+  of unions instead of a chain of n-1 unions on an ever growing mesh. Unions of a level are independent
+  and run concurrently. Raises RuntimeError if a union fails (empty output).
+  """
+  def getUnion(polyDataPair):
+    unionPolyData = getBooleanOperationOfPolyData(polyDataPair[0], polyDataPair[1], 'union')
+    if unionPolyData.GetNumberOfPoints() == 0:
+      raise RuntimeError('Union of reconstruction pieces failed')
+    return unionPolyData
+
+  polyDataList = list(polyDataList)
+  while len(polyDataList) > 1:
+    polyDataPairs = [polyDataList[i:i+2] for i in range(0, len(polyDataList)-1, 2)]
+    if max(1, min(numberOfThreads, len(polyDataPairs))) == 1:
+      unionsPolyData = [getUnion(polyDataPair) for polyDataPair in polyDataPairs]
+    else:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=min(numberOfThreads, len(polyDataPairs))) as executor:
+        unionsPolyData = list(executor.map(filterRunCounter.countedForCurrentThread(getUnion), polyDataPairs))
+    if len(polyDataList) % 2 == 1:
+      unionsPolyData.append(polyDataList[-1])
+    polyDataList = unionsPolyData
+  return polyDataList[0] if polyDataList else vtk.vtkPolyData()
+
+def getMinimumDistanceBetweenSegments(segmentsA, segmentsB, maximumNumberOfPairs=2**20):
+  """Minimum distance between the line segments of segmentsA and the ones of segmentsB, (N,2,3) and (M,2,3) arrays
+  of their ends. Segment pairs are processed in chunks of maximumNumberOfPairs.
+  """
+  if len(segmentsA) == 0 or len(segmentsB) == 0:
+    return np.inf
+  startsB = segmentsB[np.newaxis,:,0]
+  directionsB = segmentsB[np.newaxis,:,1] - startsB
+  e = np.maximum(np.sum(directionsB*directionsB, axis=2), 1e-30)
+  minimumDistance = np.inf
+  chunkSize = max(1, maximumNumberOfPairs//len(segmentsB))
+  for first in range(0, len(segmentsA), chunkSize):
+    startsA = segmentsA[first:first+chunkSize,np.newaxis,0]
+    directionsA = segmentsA[first:first+chunkSize,np.newaxis,1] - startsA
+    r = startsA - startsB
+    a = np.maximum(np.sum(directionsA*directionsA, axis=2), 1e-30)
+    b = np.sum(directionsA*directionsB, axis=2)
+    c = np.sum(directionsA*r, axis=2)
+    f = np.sum(directionsB*r, axis=2)
+    denominator = a*e - b*b
+    #Closest points of the lines, clamped to the segments (parallel segments start from the start of segment A)
+    sA = np.where(denominator > 1e-12*a*e, np.clip((b*f - c*e)/np.where(denominator > 0, denominator, 1), 0, 1), 0)
+    sB = (b*sA + f)/e
+    sA = np.where(sB < 0, np.clip(-c/a, 0, 1), np.where(sB > 1, np.clip((b-c)/a, 0, 1), sA))
+    sB = np.clip(sB, 0, 1)
+    closestPointsDifference = startsA + directionsA*sA[...,np.newaxis] - startsB - directionsB*sB[...,np.newaxis]
+    minimumDistance = min(minimumDistance, np.sqrt(np.sum(closestPointsDifference**2, axis=2).min()))
+  return minimumDistance
+
+def getVoxelizedPolyData(polyData, origin, spacing, dimensions):
+  """Voxels inside the closed surface found with an image stencil (scanline voxelization), as a (k,j,i) uint8 mask."""
+  dimensions = [int(dimension) for dimension in dimensions]
+  stencilFilter = vtk.vtkPolyDataToImageStencil()
+  stencilFilter.SetInputData(polyData)
+  stencilFilter.SetOutputOrigin(*origin)
+  stencilFilter.SetOutputSpacing(*spacing)
+  stencilFilter.SetOutputWholeExtent(0, dimensions[0]-1, 0, dimensions[1]-1, 0, dimensions[2]-1)
+
+  stencilToImage = vtk.vtkImageStencilToImage()
+  stencilToImage.SetInputConnection(stencilFilter.GetOutputPort())
+  stencilToImage.SetInsideValue(1)
+  stencilToImage.SetOutsideValue(0)
+  stencilToImage.SetOutputScalarTypeToUnsignedChar()
+  stencilToImage.Update()
+  filterRunCounter.countRun("vtkPolyDataToImageStencil")
+
+  return vtk.util.numpy_support.vtk_to_numpy(stencilToImage.GetOutput().GetPointData().GetScalars()).reshape(dimensions[::-1])
+
+def getNarrowBandSignedDistanceOfPolyData(polyData, origin, spacing, dimensions, bandWidth=2):
+  """Signed distance to the closed surface (negative inside) on the grid, as a (k,j,i) float32 array.
+  The inside is found with an image stencil, the exact distance is only computed for the voxels within bandWidth voxels
+  of the surface, the others are set to plus or minus (bandWidth+1) voxels which does not change the zero level set
+  of unions and differences. Returns the distances and the clamping distance.
+  """
+  inside = getVoxelizedPolyData(polyData, origin, spacing, dimensions).astype(bool)
+  clampDistance = (bandWidth + 1)*float(np.max(spacing))
+
+  #Voxels with a neighbour on the other side of the surface, grown to the band width
+  nearSurface = np.zeros(inside.shape, dtype=bool)
+  for axis in range(3):
+    lower = [slice(None)]*3
+    upper = [slice(None)]*3
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    crossing = inside[tuple(lower)] != inside[tuple(upper)]
+    nearSurface[tuple(lower)] |= crossing
+    nearSurface[tuple(upper)] |= crossing
+  for i in range(bandWidth - 1):
+    grown = nearSurface.copy()
+    for axis in range(3):
+      lower = [slice(None)]*3
+      upper = [slice(None)]*3
+      lower[axis] = slice(None, -1)
+      upper[axis] = slice(1, None)
+      grown[tuple(lower)] |= nearSurface[tuple(upper)]
+      grown[tuple(upper)] |= nearSurface[tuple(lower)]
+    nearSurface = grown
+
+  signedDistances = np.where(inside, -clampDistance, clampDistance).astype(np.float32)
+  bandIndices = np.nonzero(nearSurface)
+  if len(bandIndices[0]) == 0:
+    return signedDistances, clampDistance
+
+  bandPoints = np.asarray(origin) + np.stack(bandIndices[::-1], axis=1)*np.asarray(spacing)
+  distanceFunction = vtk.vtkImplicitPolyDataDistance()
+  distanceFunction.SetInput(polyData)
+  distancesArray = vtk.vtkDoubleArray()
+  distanceFunction.FunctionValue(vtk.util.numpy_support.numpy_to_vtk(bandPoints, deep=1), distancesArray)
+  filterRunCounter.countRun("vtkImplicitPolyDataDistance")
+
+  #The sign is taken from the stencil which is robust for non-manifold meshes, only the magnitude comes from the surface
+  bandDistances = np.minimum(np.abs(vtk.util.numpy_support.vtk_to_numpy(distancesArray)), clampDistance)
+  signedDistances[bandIndices] = np.where(inside[bandIndices], -bandDistances, bandDistances)
+  return signedDistances, clampDistance
+
+def getBooleanOperationsOfPolyDataWithSignedDistance(basePolyData, additivePolyDataList, subtractivePolyDataList, voxelSize, maximumNumberOfVoxels=2**24):
+  """Union of the base with the additive surfaces minus the subtractive surfaces, computed on narrow band signed
+  distance volumes (union is the minimum, difference the maximum with the negated tool) and contoured at zero with
+  flying edges. The volume covers the base and additive surfaces, the voxel size is increased if needed so it has at
+  most maximumNumberOfVoxels, which bounds time and memory. Tools are only sampled inside their bounds.
+  Returns the surface, the voxel size used and the volume dimensions.
+  """
+  additivePolyDataList = [polyData for polyData in additivePolyDataList if polyData.GetNumberOfPoints() > 0]
+  subtractivePolyDataList = [polyData for polyData in subtractivePolyDataList if polyData.GetNumberOfPoints() > 0]
+  inputsBounds = np.array([polyData.GetBounds() for polyData in [basePolyData] + additivePolyDataList if polyData.GetNumberOfPoints() > 0]).reshape(-1,3,2)
+  if len(inputsBounds) == 0:
+    return vtk.vtkPolyData(), voxelSize, (0,0,0)
+
+  #The margin keeps the narrow band inside the volume so the surfaces are closed at the volume borders
+  bandWidth = 2
+  margin = bandWidth + 1
+  lowerBounds = inputsBounds[:,:,0].min(axis=0)
+  upperBounds = inputsBounds[:,:,1].max(axis=0)
+  getDimensions = lambda size: np.ceil((upperBounds-lowerBounds)/size).astype(int) + 2*margin + 1
+  dimensions = getDimensions(voxelSize)
+  if np.prod(dimensions.astype(float)) > maximumNumberOfVoxels:
+    voxelSize *= (np.prod(dimensions.astype(float))/maximumNumberOfVoxels)**(1/3)
+    dimensions = getDimensions(voxelSize)
+    while np.prod(dimensions.astype(float)) > maximumNumberOfVoxels:
+      voxelSize *= 1.01
+      dimensions = getDimensions(voxelSize)
+  spacing = np.full(3, voxelSize)
+  origin = lowerBounds - margin*spacing
+
+  if basePolyData.GetNumberOfPoints() > 0:
+    signedDistances, clampDistance = getNarrowBandSignedDistanceOfPolyData(basePolyData, origin, spacing, dimensions, bandWidth)
+  else:
+    clampDistance = (bandWidth + 1)*voxelSize
+    signedDistances = np.full(dimensions[::-1], clampDistance, dtype=np.float32)
+
+  for polyDataList, union in [(additivePolyDataList, True), (subtractivePolyDataList, False)]:
+    for polyData in polyDataList:
+      toolBounds = np.array(polyData.GetBounds()).reshape(3,2)
+      firstIndex = np.maximum(np.floor((toolBounds[:,0]-origin)/spacing).astype(int) - margin, 0)
+      lastIndex = np.minimum(np.ceil((toolBounds[:,1]-origin)/spacing).astype(int) + margin, dimensions-1)
+      if np.any(lastIndex < firstIndex):
+        continue
+      #Outside of its bounds the tool distance is the clamping distance, which leaves the result unchanged
+      toolSignedDistances, _ = getNarrowBandSignedDistanceOfPolyData(polyData, origin + firstIndex*spacing, spacing, lastIndex-firstIndex+1, bandWidth)
+      region = signedDistances[firstIndex[2]:lastIndex[2]+1, firstIndex[1]:lastIndex[1]+1, firstIndex[0]:lastIndex[0]+1]
+      if union:
+        np.minimum(region, toolSignedDistances, out=region)
+      else:
+        np.maximum(region, -toolSignedDistances, out=region)
+
+  imageData = vtk.vtkImageData()
+  imageData.SetOrigin(origin)
+  imageData.SetSpacing(spacing)
+  imageData.SetDimensions(*[int(dimension) for dimension in dimensions])
+  #Negated so the contour normals point outwards
+  imageData.GetPointData().SetScalars(vtk.util.numpy_support.numpy_to_vtk(-signedDistances.ravel(), deep=1))
+
+  contourFilter = vtk.vtkFlyingEdges3D()
+  contourFilter.SetInputData(imageData)
+  contourFilter.SetValue(0, 0.)
+  contourFilter.ComputeNormalsOn()
+  contourFilter.ComputeScalarsOff()
+  contourFilter.Update()
+  filterRunCounter.countRun("vtkFlyingEdges3D")
+
+  return contourFilter.GetOutput(), voxelSize, tuple(int(dimension) for dimension in dimensions)
+
+def getPolyDataKey(polyData):
+  """Identifies the polydata and its content, VTK modified times are unique so a new content gives a new key."""
+  return (id(polyData), polyData.GetMTime())
+
+def transformPolyData(polyData, transform):
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputData(polyData)
+  transformFilter.SetTransform(transform)
+  transformFilter.Update()
+
+  return transformFilter.GetOutput()
+
+def computeReconstructionFromPlanningSnapshot(snapshot, cancelEvent):
+  """Fibula planes positions, fibula segments and fibula segments moved to the mandible of a snapshot taken by
+  getPlanningSnapshot. It does not use the scene so it can run on a worker thread, cancelEvent is checked between
+  stages. Only the segments that changed since snapshot["previousPlan"] are cut again.
+  """
+  def checkCancelled():
+    if cancelEvent.is_set():
+      raise PlanningJobCancelled()
+
+  plan = snapshot["plan"]
+  previousPlan = snapshot["previousPlan"]
+  timingSpans = snapshot["timingSpans"]
+  startFilterRunCounts = filterRunCounter.getCounts()
+  jobStartTime = stageStartTime = time.perf_counter()
+  fibulaCrossSectionStack = None
+  if snapshot["recomputeFibulaPlanesPositions"]:
+    if snapshot["useMoreExactVersionOfPositioningAlgorithm"] or snapshot["useVectorizedBetweenSpaceComputation"]:
+      fibulaCrossSectionStack = snapshot["fibulaCrossSectionStack"]
+      if fibulaCrossSectionStack is None or not fibulaCrossSectionStack.isValidFor(snapshot["fibulaPolyData"], plan.fibulaLineStart, plan.fibulaLineEnd, plan.notLeftFibula):
+        fibulaCrossSectionStack = FibulaCrossSectionStack(snapshot["fibulaPolyData"], plan.fibulaLineStart, plan.fibulaLineEnd, plan.notLeftFibula)
+      checkCancelled()
+    plan.computeFibulaPlanesPositions(
+      snapshot["fibulaPolyData"], snapshot["initialSpace"], snapshot["intersectionPlaceOfFibulaPlanes"], snapshot["intersectionDistanceMultiplier"],
+      snapshot["additionalBetweenSpaceOfFibulaPlanes"], snapshot["useMoreExactVersionOfPositioningAlgorithm"], previousPlan,
+      fibulaCrossSectionStack, snapshot["useVectorizedBetweenSpaceComputation"]
+    )
+  else:
+    plan.setFibulaPlanesPositions(snapshot["lastFibulaPlanesPositionA"], snapshot["lastFibulaPlanesPositionB"],
+      snapshot["useMoreExactVersionOfPositioningAlgorithm"])
+  timingSpans.addSpan("transformFibulaPlanes", stageStartTime, category="worker")
+  checkCancelled()
+
+  numberOfSegments = plan.getNumberOfSegments()
+  if snapshot["inputModelsChanged"]:
+    segmentsToUpdate = list(range(numberOfSegments))
+    updateResectedMandible = True
+  else:
+    segmentsToUpdate = plan.getSegmentsUpdate(previousPlan)
+    modifiedMandiblePlanes = plan.getModifiedMandiblePlanes(previousPlan)
+    updateResectedMandible = (0 in modifiedMandiblePlanes) or (numberOfSegments in modifiedMandiblePlanes)
+
+  stageStartTime = time.perf_counter()
+  fibulaSegmentsCutter = snapshot["fibulaSegmentsCutter"]
+  if fibulaSegmentsCutter is None or not fibulaSegmentsCutter.isValidFor(snapshot["previewFibulaPolyData"]):
+    fibulaSegmentsCutter = FibulaSegmentsCutter(snapshot["previewFibulaPolyData"])
+  checkCancelled()
+
+  fibulaPlanesAOrigins, fibulaPlanesAAxes, fibulaPlanesBOrigins, fibulaPlanesBAxes = plan.getFibulaPlanesFrames()
+  segmentsPolyData = fibulaSegmentsCutter.cutSegmentsBetweenPlanes(
+    [[fibulaPlanesAOrigins[i], fibulaPlanesBOrigins[i]] for i in segmentsToUpdate],
+    [[fibulaPlanesAAxes[i][2], fibulaPlanesBAxes[i][2]] for i in segmentsToUpdate],
+    snapshot["numberOfWorkerThreads"])
+  cutBonesPolyData = dict(zip(segmentsToUpdate, segmentsPolyData))
+  timingSpans.addSpan("cutFibulaSegments", stageStartTime, category="worker", args={"segmentsToUpdate": list(segmentsToUpdate)})
+  checkCancelled()
+
+  stageStartTime = time.perf_counter()
+  #Pieces that were not cut again keep the same position on the mandible
+  fibulaPieceToMandibleAxisTransforms = plan.getFibulaPiecesToMandibleTransforms()
+  transformedFibulaPiecesPolyData = {}
+  for i in segmentsToUpdate:
+    fibulaPieceToMandibleAxisMatrix = vtk.vtkMatrix4x4()
+    fibulaPieceToMandibleAxisMatrix.DeepCopy(fibulaPieceToMandibleAxisTransforms[i].ravel())
+    fibulaPieceToMandibleAxisTransform = vtk.vtkTransform()
+    fibulaPieceToMandibleAxisTransform.SetMatrix(fibulaPieceToMandibleAxisMatrix)
+    transformedFibulaPiecesPolyData[i] = transformPolyData(cutBonesPolyData[i], fibulaPieceToMandibleAxisTransform)
+  timingSpans.addSpan("tranformBonePiecesToMandible", stageStartTime, category="worker")
+  timingSpans.addSpan("computeReconstructionFromPlanningSnapshot", jobStartTime, category="worker",
+    args={"filterRuns": dict(filterRunCounter.getCounts() - startFilterRunCounts)})
+
+  return {
+    "plan": plan,
+    "fibulaPolyData": snapshot["fibulaPolyData"],
+    "fibulaCrossSectionStack": fibulaCrossSectionStack,
+    "previewFibulaPolyData": snapshot["previewFibulaPolyData"],
+    "fibulaSegmentsCutter": fibulaSegmentsCutter,
+    "recomputeFibulaPlanesPositions": snapshot["recomputeFibulaPlanesPositions"],
+    "inputModelsChanged": snapshot["inputModelsChanged"],
+    "segmentsToUpdate": list(segmentsToUpdate),
+    "updateResectedMandible": updateResectedMandible,
+    "cutBonesPolyData": cutBonesPolyData,
+    "transformedFibulaPiecesPolyData": transformedFibulaPiecesPolyData,
+    "startTime": snapshot["startTime"],
+  }
+
+
+class FibulaCrossSectionStack:
+  """Dense stack of fibula cross-sections perpendicular to a line, computed in one vectorized pass
+  over the triangles of the fibula model.
+  For every section k at distance sectionsPositions[k] from lineStartPos along the line it stores
+  the centroid (average of the section points, same as cutting the model with a plane),
+  the enclosed area and the extents along the X and Y axes of the line frame.
+  Queries between sections are linearly interpolated.
+  """
+
+  def __init__(self, polyData, lineStartPos, lineEndPos, notLeftFibula=False, sectionsSpacing=0.5):
+    self.lineStartPos = np.array(lineStartPos, dtype=float)
+    self.lineEndPos = np.array(lineEndPos, dtype=float)
+    self.notLeftFibula = notLeftFibula
+    self.axes = getFibulaAxesFromLine(self.lineStartPos, self.lineEndPos, notLeftFibula)
+    self.sectionsSpacing = sectionsSpacing
+    self.polyDataKey = getPolyDataKey(polyData)
+
+    points, triangles = getPointsAndTrianglesArraysOfPolyData(polyData)
+    pointsInLineFrame = (points - self.lineStartPos) @ self.axes.T
+    pointsZ = pointsInLineFrame[:,2]
+    self.pointsInLineFrame = pointsInLineFrame
+    self.triangles = triangles
+    firstSectionPosition = np.floor(pointsZ.min()/sectionsSpacing)*sectionsSpacing
+    numberOfSections = int(np.ceil((pointsZ.max()-firstSectionPosition)/sectionsSpacing)) + 1
+    self.sectionsPositions = firstSectionPosition + sectionsSpacing*np.arange(numberOfSections)
+
+    #Sort the vertices of each triangle along the line: a < b < c
+    trianglesZ = pointsZ[triangles]
+    order = np.argsort(trianglesZ, axis=1)
+    sortedTriangles = np.take_along_axis(triangles, order, axis=1)
+    #Triangles orientation is kept to give a sign to the section contours (odd permutations flip it)
+    orientation = np.where(np.isin(order[:,0]*3+order[:,1], [0*3+1, 1*3+2, 2*3+0]), 1., -1.)
+    za, zb, zc = [pointsZ[sortedTriangles[:,j]] for j in range(3)]
+    self.trianglesZRange = np.stack((za, zc), axis=1)
+
+    #Every (triangle, section) pair where the section goes through the triangle, za <= z < zc
+    firstSection = np.ceil((za-firstSectionPosition)/sectionsSpacing).astype(int)
+    lastSection = np.ceil((zc-firstSectionPosition)/sectionsSpacing).astype(int) - 1
+    crossingsCount = np.maximum(lastSection-firstSection+1, 0)
+    triangleIndices = np.repeat(np.arange(len(triangles)), crossingsCount)
+    sectionIndices = np.repeat(firstSection, crossingsCount) + (np.arange(crossingsCount.sum()) - np.repeat(np.cumsum(crossingsCount)-crossingsCount, crossingsCount))
+    sectionZ = self.sectionsPositions[sectionIndices]
+
+    pa, pb, pc = [pointsInLineFrame[sortedTriangles[triangleIndices,j]] for j in range(3)]
+    za, zb, zc = za[triangleIndices], zb[triangleIndices], zc[triangleIndices]
+    #One end of the contour segment is always on the edge a-c, the other on a-b or b-c
+    point0 = pa + ((sectionZ-za)/(zc-za))[:,np.newaxis]*(pc-pa)
+    onLowerEdge = sectionZ < zb
+    with np.errstate(divide='ignore', invalid='ignore'):
+      fractionLower = np.where(onLowerEdge, (sectionZ-za)/(zb-za), 0)
+      fractionUpper = np.where(onLowerEdge, 0, (sectionZ-zb)/(zc-zb))
+    point1 = np.where(onLowerEdge[:,np.newaxis], pa + fractionLower[:,np.newaxis]*(pb-pa), pb + fractionUpper[:,np.newaxis]*(pc-pb))
+
+    #Each closed contour point is shared by two segments so averaging segment ends is averaging section points
+    counts = np.bincount(sectionIndices, minlength=numberOfSections)*2
+    centroidsInLineFrame = np.zeros((numberOfSections,3))
+    for j in range(2):
+      centroidsInLineFrame[:,j] = (np.bincount(sectionIndices, point0[:,j], numberOfSections) + np.bincount(sectionIndices, point1[:,j], numberOfSections))
+    self.sectionsValid = counts > 0
+    centroidsInLineFrame[self.sectionsValid,:2] /= counts[self.sectionsValid,np.newaxis]
+    centroidsInLineFrame[:,2] = self.sectionsPositions
+    self.sectionsCentroids = self.lineStartPos + centroidsInLineFrame @ self.axes
+
+    #Signed shoelace area, segments are oriented counterclockwise around the line if they go along Z cross the outward normal
+    trianglesNormals = orientation[triangleIndices,np.newaxis]*np.cross(pb-pa, pc-pa)
+    segmentsSign = np.sign((point1[:,0]-point0[:,0])*(-trianglesNormals[:,1]) + (point1[:,1]-point0[:,1])*trianglesNormals[:,0])
+    crossProducts = point0[:,0]*point1[:,1] - point0[:,1]*point1[:,0]
+    self.sectionsAreas = np.abs(np.bincount(sectionIndices, segmentsSign*crossProducts, numberOfSections))/2
+
+    self.sectionsExtents = np.zeros((numberOfSections,4))
+    for j in range(2):
+      sectionsMinimum = np.full(numberOfSections, np.inf)
+      sectionsMaximum = np.full(numberOfSections, -np.inf)
+      for segmentPoints in [point0, point1]:
+        np.minimum.at(sectionsMinimum, sectionIndices, segmentPoints[:,j])
+        np.maximum.at(sectionsMaximum, sectionIndices, segmentPoints[:,j])
+      self.sectionsExtents[:,2*j] = sectionsMinimum
+      self.sectionsExtents[:,2*j+1] = sectionsMaximum
+    self.sectionsExtents[~self.sectionsValid] = 0
+
+  def isValidFor(self, polyData, lineStartPos, lineEndPos, notLeftFibula=False):
+    """True if the stack was computed from the same polydata content (see getPolyDataKey) and line."""
+    return (self.polyDataKey == getPolyDataKey(polyData) and self.notLeftFibula == notLeftFibula
+      and np.allclose(self.lineStartPos, lineStartPos) and np.allclose(self.lineEndPos, lineEndPos))
+
+  def getPositionsAlongLine(self, points):
+    return (np.asarray(points, dtype=float) - self.lineStartPos) @ self.axes[2]
+
+  def getCentroidsAtPositionsAlongLine(self, positions):
+    """Interpolated section centroids at distances (scalar or array) from lineStartPos along the line.
+    Positions outside of the fibula return the centroid of the nearest section.
+    """
+    validPositions = self.sectionsPositions[self.sectionsValid]
+    validCentroids = self.sectionsCentroids[self.sectionsValid]
+    positions = np.asarray(positions, dtype=float)
+    return np.stack([np.interp(positions, validPositions, validCentroids[:,j]) for j in range(3)], axis=-1)
+
+  def getCentroidsOfSectionsThroughPoints(self, points):
+    return self.getCentroidsAtPositionsAlongLine(self.getPositionsAlongLine(points))
+
+  def centerSegmentOnSections(self, lineStartPos, lineEndPos, segmentLength, tolerance=0.01, maximumNumberOfIterations=10,
+      maximumExtrapolationFactor=4.0):
+    """Move the segment ends to the centroids of the sections through them, keeping the segment length,
+    until the ends move less than tolerance (sum of both displacements in mm).
+    The fixed-point iteration is accelerated with the vector Aitken (Irons-Tuck) extrapolation, so a good
+    starting segment (e.g. the previous solution while a plane is dragged) usually converges in one step.
+    The extrapolation goes at most maximumExtrapolationFactor steps ahead and an extrapolated segment whose
+    residual is larger than the one before it is dropped for a plain iteration.
+    Returns the centered segment ends with the smallest residual, the number of iterations and that residual.
+    """
+    def centerSegment(segmentEnds):
+      lineStartPos, lineEndPos = self.getCentroidsOfSectionsThroughPoints(segmentEnds)
+      segmentDirection = (lineEndPos-lineStartPos)/np.linalg.norm(lineEndPos-lineStartPos)
+      return np.array([lineStartPos, lineStartPos + segmentLength*segmentDirection])
+
+    segmentEnds = np.array([lineStartPos, lineEndPos], dtype=float)
+    bestSegmentEnds = None
+    bestResidual = np.inf
+    lastStep = None
+    lastResidual = np.inf
+    lastCenteredSegmentEnds = None
+    extrapolated = False
+    iterations = 0
+    while iterations < maximumNumberOfIterations:
+      centeredSegmentEnds = centerSegment(segmentEnds)
+      iterations += 1
+      step = centeredSegmentEnds - segmentEnds
+      residual = np.linalg.norm(step, axis=1).sum()
+      if residual < bestResidual:
+        bestSegmentEnds = centeredSegmentEnds
+        bestResidual = residual
+      if residual < tolerance:# Unavoidable errors because of fibula bone shape are about 0.6-0.8mm
+        return centeredSegmentEnds[0], centeredSegmentEnds[1], iterations, residual
+      if extrapolated and residual > lastResidual:
+        #The extrapolation went away from the solution, continue from the segment before it without extrapolating
+        segmentEnds = lastCenteredSegmentEnds
+        lastStep = None
+        extrapolated = False
+        continue
+      nextSegmentEnds = centeredSegmentEnds
+      extrapolated = False
+      if lastStep is not None:
+        stepsDifference = step - lastStep
+        stepsDifferenceSquaredNorm = (stepsDifference**2).sum()
+        if stepsDifferenceSquaredNorm > 1e-12:
+          extrapolationFactor = np.clip((step*stepsDifference).sum()/stepsDifferenceSquaredNorm, -maximumExtrapolationFactor, 1.0)
+          nextSegmentEnds = centeredSegmentEnds - extrapolationFactor*step
+          #Keep the segment length after the extrapolation
+          segmentDirection = (nextSegmentEnds[1]-nextSegmentEnds[0])/np.linalg.norm(nextSegmentEnds[1]-nextSegmentEnds[0])
+          nextSegmentEnds[1] = nextSegmentEnds[0] + segmentLength*segmentDirection
+          extrapolated = True
+      lastStep = step
+      lastResidual = residual
+      lastCenteredSegmentEnds = centeredSegmentEnds
+      segmentEnds = nextSegmentEnds
+    return bestSegmentEnds[0], bestSegmentEnds[1], iterations, bestResidual
+
+  def fitLineToSectionsCentroids(self, firstPosition, lastPosition):
+    """Least-squares line through the centroids of the sections between firstPosition and lastPosition along the line.
+    Returns a point of the fitted line, its direction (pointing like the stack line), the positions of
+    the sections used and the distances of their centroids to the fitted line, that show how straight the bone is.
+    """
+    sectionsToFit = self.sectionsValid & (self.sectionsPositions >= firstPosition) & (self.sectionsPositions <= lastPosition)
+    centroids = self.sectionsCentroids[sectionsToFit]
+    if len(centroids) < 2:
+      raise ValueError('Not enough fibula cross-sections between the fibula line ends to fit the fibula axis')
+    centroidsMean = centroids.mean(axis=0)
+    #The direction of maximum variance of the centroids is the least-squares line direction
+    direction = np.linalg.svd(centroids-centroidsMean, full_matrices=False)[2][0]
+    if direction @ self.axes[2] < 0:
+      direction = -direction
+    centroidsOffsets = centroids-centroidsMean
+    distancesToLine = np.linalg.norm(centroidsOffsets - np.outer(centroidsOffsets @ direction, direction), axis=1)
+    return centroidsMean, direction, self.sectionsPositions[sectionsToFit], distancesToLine
+
+  def getAreasAtPositionsAlongLine(self, positions):
+    return np.interp(positions, self.sectionsPositions, self.sectionsAreas)
+
+  def getPlanesSectionsExtentsAlongLine(self, origin, normals):
+    """Length along the line of the sections of the fibula by the planes through origin with the given normals (P,3).
+    All planes are evaluated in one pass over the mesh edges. The section points are the same that vtkCutter
+    gives (edge crossings) so the result agrees with cutting each plane within 1e-4 mm, the precision of
+    the float coordinates vtkCutter outputs. Planes that miss the fibula give 0.
+    """
+    originInLineFrame = (np.asarray(origin, dtype=float) - self.lineStartPos) @ self.axes.T
+    normalsInLineFrame = np.asarray(normals, dtype=float).reshape(-1,3) @ self.axes.T
+    numberOfPlanes = len(normalsInLineFrame)
+
+    #Only triangles near origin along the line can be cut: a plane tilted by angle a from the sections
+    #does not go further than radius*tan(a) along the line inside the fibula
+    trianglesToCut = np.ones(len(self.triangles), dtype=bool)
+    normalsZ = np.abs(normalsInLineFrame[:,2])
+    if np.all(normalsZ > 1e-3):
+      fibulaRadius = np.sqrt(((self.pointsInLineFrame[:,:2] - originInLineFrame[:2])**2).sum(axis=1).max())
+      maximumDistanceAlongLine = fibulaRadius*(np.sqrt(np.clip(1-normalsZ**2, 0, 1))/normalsZ).max()
+      trianglesToCut = ((self.trianglesZRange[:,1] >= originInLineFrame[2]-maximumDistanceAlongLine)
+        & (self.trianglesZRange[:,0] <= originInLineFrame[2]+maximumDistanceAlongLine))
+    triangles = self.triangles[trianglesToCut]
+    #Repeated edges of neighbor triangles do not change the extents so they are not removed
+    edges = np.concatenate([triangles[:,[0,1]], triangles[:,[1,2]], triangles[:,[2,0]]])
+    distances = (self.pointsInLineFrame - originInLineFrame) @ normalsInLineFrame.T
+    #Side of every point with respect to each plane packed in bits so that crossing edges are found with one xor
+    edgesIndicesList = []
+    planesIndicesList = []
+    maximumNumberOfPlanesPerKey = 62
+    for firstPlane in range(0, numberOfPlanes, maximumNumberOfPlanesPerKey):
+      planesBits = np.left_shift(1, np.arange(min(maximumNumberOfPlanesPerKey, numberOfPlanes-firstPlane)), dtype=np.int64)
+      pointsKeys = (distances[:,firstPlane:firstPlane+len(planesBits)] > 0).astype(np.int64) @ planesBits
+      edgesKeys = pointsKeys[edges[:,0]] ^ pointsKeys[edges[:,1]]
+      crossingEdges = np.nonzero(edgesKeys)[0]
+      crossingEdgesIndices, crossingPlanesIndices = np.nonzero((edgesKeys[crossingEdges,np.newaxis] & planesBits) != 0)
+      edgesIndicesList.append(crossingEdges[crossingEdgesIndices])
+      planesIndicesList.append(crossingPlanesIndices + firstPlane)
+    edgesIndices = np.concatenate(edgesIndicesList)
+    planesIndices = np.concatenate(planesIndicesList)
+    distances0 = distances[edges[edgesIndices,0], planesIndices]
+    distances1 = distances[edges[edgesIndices,1], planesIndices]
+    z0 = self.pointsInLineFrame[edges[edgesIndices,0],2]
+    z1 = self.pointsInLineFrame[edges[edgesIndices,1],2]
+    crossingZ = z0 + (z1-z0)*distances0/(distances0-distances1)
+    sectionsMaximum = np.full(numberOfPlanes, -np.inf)
+    sectionsMinimum = np.full(numberOfPlanes, np.inf)
+    np.maximum.at(sectionsMaximum, planesIndices, crossingZ)
+    np.minimum.at(sectionsMinimum, planesIndices, crossingZ)
+    return np.where(np.isfinite(sectionsMaximum), sectionsMaximum-sectionsMinimum, 0)
+
+  def getExtentsAtPositionsAlongLine(self, positions):
+    """Interpolated (xMin, xMax, yMin, yMax) of the sections in the line frame."""
+    return np.stack([np.interp(positions, self.sectionsPositions, self.sectionsExtents[:,j]) for j in range(4)], axis=-1)
+
+
+class FibulaSegmentsCutter:
+  """Cuts fibula segments out of the fibula model in one pass over its triangles.
+  Triangles are sorted once along the main axis of the model, so each segment is clipped
+  and capped using only the triangles of the slab that contains it instead of the whole model.
+  """
+
+  def __init__(self, polyData):
+    self.polyDataKey = getPolyDataKey(polyData)
+
+    points, triangles = getPointsAndTrianglesArraysOfPolyData(polyData)
+    self.center = points.mean(axis=0)
+    self.axis = np.linalg.svd(points - self.center, full_matrices=False)[2][0]
+    pointsPositions = (points - self.center) @ self.axis
+    self.radius = np.linalg.norm((points - self.center) - pointsPositions[:,np.newaxis]*self.axis, axis=1).max()
+
+    #Points are sorted along the axis too so the points of a slab are a contiguous range
+    pointsOrder = np.argsort(pointsPositions, kind='stable')
+    pointsNewIndices = np.empty(len(points), dtype=triangles.dtype)
+    pointsNewIndices[pointsOrder] = np.arange(len(points))
+    self.points = points[pointsOrder]
+    pointsPositions = pointsPositions[pointsOrder]
+    triangles = pointsNewIndices[triangles]
+
+    trianglesPositions = pointsPositions[triangles]
+    trianglesMinimum = trianglesPositions.min(axis=1)
+    order = np.argsort(trianglesMinimum, kind='stable')
+    self.triangles = triangles[order]
+    self.trianglesMinimum = trianglesMinimum[order]
+    self.trianglesMaximum = trianglesPositions.max(axis=1)[order]
+    self.maximumTriangleLength = (self.trianglesMaximum - self.trianglesMinimum).max(initial=0)
+
+  def isValidFor(self, polyData):
+    return self.polyDataKey == getPolyDataKey(polyData)
+
+  def getSlabTrianglesIndices(self, planesOrigins, planesNormals):
+    """Indices of the sorted triangles that may be inside of all the half-spaces the normals point to."""
+    lowerLimit = -np.inf
+    upperLimit = np.inf
+    for origin, normal in zip(planesOrigins, planesNormals):
+      cosine = normal @ self.axis / np.linalg.norm(normal)
+      if abs(cosine) < 1e-3:
+        #Planes parallel to the axis do not limit the slab
+        continue
+      planePosition = (origin - self.center) @ self.axis
+      #Along the axis the plane is tilted at most this much inside the model, the origin may be away from the axis
+      originDistanceToAxis = np.linalg.norm((origin - self.center) - planePosition*self.axis)
+      halfWidth = (self.radius + originDistanceToAxis)*np.sqrt(max(1 - cosine**2, 0))/abs(cosine)
+      if cosine > 0:
+        lowerLimit = max(lowerLimit, planePosition - halfWidth)
+      else:
+        upperLimit = min(upperLimit, planePosition + halfWidth)
+    first = np.searchsorted(self.trianglesMinimum, lowerLimit - self.maximumTriangleLength, side='left')
+    last = np.searchsorted(self.trianglesMinimum, upperLimit, side='right')
+    return first + np.flatnonzero(self.trianglesMaximum[first:last] >= lowerLimit)
+
+  def getTrianglesPolyData(self, trianglesIndices):
+    idType = np.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else np.int32
+    triangles = self.triangles[trianglesIndices]
+    firstPoint = triangles.min(initial=0)
+    lastPoint = triangles.max(initial=-1)
+    points = vtk.vtkPoints()
+    points.SetData(vtk.util.numpy_support.numpy_to_vtk(self.points[firstPoint:lastPoint+1], deep=1))
+    cellArray = vtk.vtkCellArray()
+    cellArray.SetData(vtk.util.numpy_support.numpy_to_vtkIdTypeArray(np.arange(0, 3*len(triangles)+1, 3, dtype=idType), deep=1),
+      vtk.util.numpy_support.numpy_to_vtkIdTypeArray((triangles - firstPoint).ravel().astype(idType), deep=1))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(points)
+    polyData.SetPolys(cellArray)
+    return polyData
+
+  def cutSegment(self, planesOrigins, planesNormals):
+    """Closed surface of the part of the model inside of all the half-spaces the normals point to."""
+    planesOrigins = np.array(planesOrigins, dtype=float)
+    planesNormals = np.array(planesNormals, dtype=float)
+    planesNormals /= np.linalg.norm(planesNormals, axis=1)[:,np.newaxis]
+    planeCollection = vtk.vtkPlaneCollection()
+    for origin, normal in zip(planesOrigins, planesNormals):
+      plane = vtk.vtkPlane()
+      plane.SetOrigin(origin)
+      plane.SetNormal(normal)
+      planeCollection.AddItem(plane)
+
+    clipper = vtk.vtkClipClosedSurface()
+    clipper.SetInputData(self.getTrianglesPolyData(self.getSlabTrianglesIndices(planesOrigins, planesNormals)))
+    clipper.SetClippingPlanes(planeCollection)
+    clipper.GenerateFacesOn()
+    clipper.Update()
+    filterRunCounter.countRun("vtkClipClosedSurface")
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputData(clipper.GetOutput())
+    normals.Update()
+    return normals.GetOutput()
+
+  def cutSegmentsBetweenPlanes(self, segmentsPlanesOrigins, segmentsPlanesNormals, numberOfThreads=1):
+    """For each segment the part of the model between its two planes, whatever the direction of their normals.
+    With more than one thread segments are cut concurrently, each one with its own filters (VTK releases
+    the GIL while they run). Results are returned in the order of the segments.
+    """
+    segmentsPlanes = []
+    for planesOrigins, planesNormals in zip(segmentsPlanesOrigins, segmentsPlanesNormals):
+      planesOrigins = np.array(planesOrigins, dtype=float)
+      planesNormals = np.array(planesNormals, dtype=float)
+      #Normals point towards the other plane
+      towardsOtherPlane = planesOrigins[::-1] - planesOrigins
+      planesNormals *= np.where(np.sum(planesNormals*towardsOtherPlane, axis=1) < 0, -1., 1.)[:,np.newaxis]
+      segmentsPlanes.append((planesOrigins, planesNormals))
+
+    numberOfThreads = max(1, min(numberOfThreads, len(segmentsPlanes)))
+    if numberOfThreads == 1:
+      return [self.cutSegment(planesOrigins, planesNormals) for planesOrigins, planesNormals in segmentsPlanes]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+      return list(executor.map(filterRunCounter.countedForCurrentThread(lambda segmentPlanes: self.cutSegment(*segmentPlanes)), segmentsPlanes))
+
+
+class SurfacesGapAnalyzer:
+  """Minimum distances between closed surfaces (negative if they overlap). Distances from the points of each
+  surface to the other one (with the cell locator of a distance function) bound the gap, then the closest
+  approaches between the edges of the triangles near the other surface are measured too, which the distances
+  from the points miss. Distance functions are kept for the surfaces of the last query.
+  """
+
+  def __init__(self):
+    self.distanceFunctions = {}
+
+  def getDistanceFunction(self, polyData):
+    polyDataKey = getPolyDataKey(polyData)
+    if polyDataKey not in self.distanceFunctions:
+      distanceFunction = vtk.vtkImplicitPolyDataDistance()
+      distanceFunction.SetInput(polyData)
+      self.distanceFunctions[polyDataKey] = distanceFunction
+    return self.distanceFunctions[polyDataKey]
+
+  def getDistancesToSurface(self, distanceFunction, polyData):
+    if polyData.GetNumberOfPoints() == 0:
+      return np.full(1, np.inf)
+    distances = vtk.vtkDoubleArray()
+    distanceFunction.FunctionValue(polyData.GetPoints().GetData(), distances)
+    filterRunCounter.countRun("vtkImplicitPolyDataDistance")
+    return vtk.util.numpy_support.vtk_to_numpy(distances)
+
+  def getGapsBetweenConsecutiveSurfaces(self, polyDataList, numberOfThreads=1):
+    """Gap between surfaces i and i+1 for every i. Distance functions are not thread safe, so each task
+    evaluates one surface distance function on the points of its neighbours and tasks run concurrently.
+    """
+    distanceFunctions = [self.getDistanceFunction(polyData) for polyData in polyDataList]
+    self.distanceFunctions = {getPolyDataKey(polyData): distanceFunction
+      for polyData, distanceFunction in zip(polyDataList, distanceFunctions)}
+
+    def getDistancesToNeighbours(i):
+      return [self.getDistancesToSurface(distanceFunctions[i], polyDataList[j]) if 0 <= j < len(polyDataList) else None
+        for j in [i-1, i+1]]
+
+    numberOfThreads = max(1, min(numberOfThreads, len(polyDataList)))
+    if numberOfThreads == 1:
+      distancesToNeighbours = [getDistancesToNeighbours(i) for i in range(len(polyDataList))]
+    else:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+        distancesToNeighbours = list(executor.map(filterRunCounter.countedForCurrentThread(getDistancesToNeighbours), range(len(polyDataList))))
+
+    #Distances of the points of surface i to surface i+1 and of the points of surface i+1 to surface i
+    return np.array([self.getGap(polyDataList[i], polyDataList[i+1], distancesToNeighbours[i+1][0], distancesToNeighbours[i][1])
+      for i in range(len(polyDataList)-1)])
+
+  def getGap(self, polyDataA, polyDataB, pointsADistances, pointsBDistances):
+    pointsGap = min(pointsADistances.min(), pointsBDistances.min())
+    if not pointsGap > 0 or not np.isfinite(pointsGap):
+      return pointsGap
+    edgesA = self.getEdgesNearOtherSurface(polyDataA, pointsADistances, pointsGap)
+    edgesB = self.getEdgesNearOtherSurface(polyDataB, pointsBDistances, pointsGap)
+    return min(pointsGap, getMinimumDistanceBetweenSegments(edgesA, edgesB))
+
+  def getEdgesNearOtherSurface(self, polyData, pointsDistances, gap):
+    """Edges, as (N,2,3) array of their ends, of the triangles that may be closer than gap to the other surface."""
+    points, triangles = getPointsAndTrianglesArraysOfPolyData(polyData)
+    trianglesEdgesLengths = np.linalg.norm(points[triangles] - points[np.roll(triangles, 1, axis=1)], axis=2)
+    #Every point of a triangle is closer than its longest edge to its vertices
+    nearTriangles = pointsDistances[triangles].min(axis=1) <= gap + trianglesEdgesLengths.max(axis=1)
+    edges = triangles[nearTriangles][:,[0,1,1,2,2,0]].reshape(-1,2)
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    return points[edges]
+
+
+class SubjectHierarchyFolderRegistry:
+  """Item IDs of the subject hierarchy folders of the module and the ordered data nodes of their children.
+  Folders are identified by their name (role) under the module folder (or under the scene for the
+  module folder itself), so items of other modules with the same names are never returned.
+  Lookups are cached and the caches are updated from subject hierarchy events, only the children lists of
+  the parents of the changed items are rebuilt. Call cleanup to remove the observers.
+  """
+
+  def __init__(self, moduleFolderName):
+    self.moduleFolderName = moduleFolderName
+    self.folderItemIDs = {}
+    self.childrenDataNodes = {}
+    self.subjectHierarchyNode = None
+    self.subjectHierarchyNodeObservers = []
+    self.sceneObserver = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
+    #Observers added and removed since creation, see SceneChurnCounter
+    self.numberOfAddedObservers = 1
+    self.numberOfRemovedObservers = 0
+
+  def cleanup(self):
+    if self.sceneObserver is not None:
+      slicer.mrmlScene.RemoveObserver(self.sceneObserver)
+      self.sceneObserver = None
+      self.numberOfRemovedObservers += 1
+    for observer in self.subjectHierarchyNodeObservers:
+      self.subjectHierarchyNode.RemoveObserver(observer)
+    self.numberOfRemovedObservers += len(self.subjectHierarchyNodeObservers)
+    self.subjectHierarchyNodeObservers = []
+    self.subjectHierarchyNode = None
+    self.reset()
+
+  def updateObservedSubjectHierarchyNode(self):
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    if shNode is self.subjectHierarchyNode:
+      return shNode
+    for observer in self.subjectHierarchyNodeObservers:
+      self.subjectHierarchyNode.RemoveObserver(observer)
+    self.numberOfRemovedObservers += len(self.subjectHierarchyNodeObservers)
+    self.subjectHierarchyNode = shNode
+    self.subjectHierarchyNodeObservers = [
+      shNode.AddObserver(shNode.SubjectHierarchyItemAddedEvent, self.onSubjectHierarchyItemAddedOrReparented),
+      shNode.AddObserver(shNode.SubjectHierarchyItemReparentedEvent, self.onSubjectHierarchyItemAddedOrReparented),
+      shNode.AddObserver(shNode.SubjectHierarchyItemAboutToBeRemovedEvent, self.onSubjectHierarchyItemAboutToBeRemoved),
+    ]
+    self.numberOfAddedObservers += len(self.subjectHierarchyNodeObservers)
+    self.reset()
+    return shNode
+
+  def reset(self):
+    self.folderItemIDs = {}
+    self.childrenDataNodes = {}
+
+  def getNumberOfObservers(self):
+    return (self.sceneObserver is not None) + len(self.subjectHierarchyNodeObservers)
+
+  def onSceneEndClose(self, caller, event):
+    self.reset()
+
+  def invalidateChildrenDataNodesOfParents(self, shNode, itemID):
+    #The new parent is known but not the previous one of a reparented item, so the lists that
+    #contain the item data node (None for folders) are invalidated too. They are rebuilt on their next use
+    self.childrenDataNodes.pop(shNode.GetItemParent(itemID), None)
+    dataNode = shNode.GetItemDataNode(itemID)
+    for folderItemID in [folderItemID for folderItemID, dataNodes in self.childrenDataNodes.items() if dataNode in dataNodes]:
+      del self.childrenDataNodes[folderItemID]
+
+  @vtk.calldata_type(vtk.VTK_LONG)
+  def onSubjectHierarchyItemAddedOrReparented(self, caller, event, itemID):
+    self.invalidateChildrenDataNodesOfParents(caller, itemID)
+
+  @vtk.calldata_type(vtk.VTK_LONG)
+  def onSubjectHierarchyItemAboutToBeRemoved(self, caller, event, itemID):
+    self.invalidateChildrenDataNodesOfParents(caller, itemID)
+    self.childrenDataNodes.pop(itemID, None)
+    self.folderItemIDs = {folderName: folderItemID for folderName, folderItemID in self.folderItemIDs.items() if folderItemID != itemID}
+
+  def getFolderItemID(self, folderName):
+    """Item ID of the folder of the module with the given name, 0 if it does not exist."""
+    shNode = self.updateObservedSubjectHierarchyNode()
+    folderItemID = self.folderItemIDs.get(folderName, 0)
+    if folderItemID and shNode.GetItemName(folderItemID) == folderName:
+      return folderItemID
+    if folderName == self.moduleFolderName:
+      parentItemID = shNode.GetSceneItemID()
+    else:
+      parentItemID = self.getFolderItemID(self.moduleFolderName)
+      if not parentItemID:
+        return 0
+    folderItemID = shNode.GetItemChildWithName(parentItemID, folderName)
+    if folderItemID:
+      self.folderItemIDs[folderName] = folderItemID
+    return folderItemID
+
+  def getChildrenDataNodes(self, folderItemID):
+    """Data nodes of the children of the folder in subject hierarchy order, like createListFromFolderID."""
+    self.updateObservedSubjectHierarchyNode()
+    if not folderItemID:
+      return []
+    if folderItemID not in self.childrenDataNodes:
+      self.childrenDataNodes[folderItemID] = createListFromFolderID(folderItemID)
+    return list(self.childrenDataNodes[folderItemID])
+
+
+class SceneEventCounter:
+  """Counts node and subject hierarchy item events of the scene from creation until stop is called.
+  Added and removed display nodes are counted in the added and removed nodes too.
+  """
+
+  def __init__(self):
+    self.counts = {"nodesAdded": 0, "nodesRemoved": 0, "displayNodesAdded": 0, "displayNodesRemoved": 0,
+      "itemsAdded": 0, "itemsRemoved": 0, "itemsReparented": 0, "itemsModified": 0}
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    self.observations = []
+    for observedObject, event, callback in [
+        (slicer.mrmlScene, slicer.mrmlScene.NodeAddedEvent, self.onNodeAdded),
+        (slicer.mrmlScene, slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved),
+        (shNode, shNode.SubjectHierarchyItemAddedEvent, functools.partial(self.onEvent, "itemsAdded")),
+        (shNode, shNode.SubjectHierarchyItemRemovedEvent, functools.partial(self.onEvent, "itemsRemoved")),
+        (shNode, shNode.SubjectHierarchyItemReparentedEvent, functools.partial(self.onEvent, "itemsReparented")),
+        (shNode, shNode.SubjectHierarchyItemModifiedEvent, functools.partial(self.onEvent, "itemsModified"))]:
+      observer = observedObject.AddObserver(event, callback)
+      self.observations.append((observedObject, observer))
+
+  def onEvent(self, countName, caller, event):
+    self.counts[countName] += 1
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, callData):
+    self.counts["nodesAdded"] += 1
+    if callData is not None and callData.IsA("vtkMRMLDisplayNode"):
+      self.counts["displayNodesAdded"] += 1
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, callData):
+    self.counts["nodesRemoved"] += 1
+    if callData is not None and callData.IsA("vtkMRMLDisplayNode"):
+      self.counts["displayNodesRemoved"] += 1
+
+  def stop(self):
+    for observedObject, observer in self.observations:
+      observedObject.RemoveObserver(observer)
+    self.observations = []
+
+
+class FilterRunCounter:
+  """Number of runs of each VTK filter and Slicer tool, per thread. Runs are counted with countRun where
+  the filters run. Functions run on a thread pool are wrapped with countedForCurrentThread so their runs
+  are counted for the thread that submits them.
+  """
+
+  def __init__(self):
+    self.threadsCounts = {}
+    self.lock = threading.Lock()
+    self.countingThread = threading.local()
+
+  def countRun(self, filterName, numberOfRuns=1):
+    threadID = getattr(self.countingThread, "threadID", None) or threading.get_ident()
+    with self.lock:
+      self.threadsCounts.setdefault(threadID, collections.Counter())[filterName] += numberOfRuns
+
+  def countedForCurrentThread(self, function):
+    """Function that runs the given one with its filter runs counted for the current thread."""
+    threadID = threading.get_ident()
+    @functools.wraps(function)
+    def countedFunction(*args, **kwargs):
+      previousThreadID = getattr(self.countingThread, "threadID", None)
+      self.countingThread.threadID = threadID
+      try:
+        return function(*args, **kwargs)
+      finally:
+        self.countingThread.threadID = previousThreadID
+    return countedFunction
+
+  def getCounts(self):
+    """Copy of the counts of the current thread."""
+    with self.lock:
+      return collections.Counter(self.threadsCounts.get(threading.get_ident(), {}))
+
+
+filterRunCounter = FilterRunCounter()
+
+
+class SceneChurnCounter:
+  """Scene churn of an operation from creation until stop is called: events counted meanwhile by a running
+  SceneEventCounter (which can be shared by nested operations), observers added and removed by the observer
+  owners (node observer managers and the folder registry, which count them) and runs of filters of the
+  current thread (see FilterRunCounter). The number of nodes, subject hierarchy items and observers when it
+  stops show leaks that make the scene slower over time.
+  """
+
+  def __init__(self, sceneEventCounter, observerOwners):
+    self.sceneEventCounter = sceneEventCounter
+    self.observerOwners = observerOwners
+    self.startSceneEventCounts = dict(sceneEventCounter.counts)
+    self.startNumberOfAddedObservers = sum(owner.numberOfAddedObservers for owner in observerOwners)
+    self.startNumberOfRemovedObservers = sum(owner.numberOfRemovedObservers for owner in observerOwners)
+    self.startFilterRunCounts = filterRunCounter.getCounts()
+
+  def stop(self):
+    """Churn counts of the operation."""
+    counts = {countName: count - self.startSceneEventCounts[countName] for countName, count in self.sceneEventCounter.counts.items()}
+    counts["observersAdded"] = sum(owner.numberOfAddedObservers for owner in self.observerOwners) - self.startNumberOfAddedObservers
+    counts["observersRemoved"] = sum(owner.numberOfRemovedObservers for owner in self.observerOwners) - self.startNumberOfRemovedObservers
+    counts["filterRuns"] = dict(filterRunCounter.getCounts() - self.startFilterRunCounts)
+    counts["numberOfNodes"] = slicer.mrmlScene.GetNumberOfNodes()
+    counts["numberOfItems"] = slicer.mrmlScene.GetSubjectHierarchyNode().GetNumberOfItems()
+    counts["numberOfObservers"] = sum(owner.getNumberOfObservers() for owner in self.observerOwners)
+    return counts
+
+
+class NodeObserverManager:
+  """Observers of MRML nodes keyed by node ID.
+  Observers can be suspended while the module edits the observed nodes itself (see suspended) and
+  coalesced observers call their callback once per event loop turn and node, with the last event,
+  instead of once per event.
+  """
+
+  def __init__(self):
+    self.observations = {}
+    self.pendingEvents = {}
+    self.flushPendingEventsScheduled = False
+    self.suspendCount = 0
+    #Observers added and removed since creation, see SceneChurnCounter
+    self.numberOfAddedObservers = 0
+    self.numberOfRemovedObservers = 0
+
+  def addObserver(self, node, event, callback, coalesce=False):
+    nodeID = node.GetID()
+    self.removeObserver(nodeID, event)
+    def onEvent(caller, eventName):
+      self.onNodeEvent(nodeID, event, caller, eventName)
+    observer = node.AddObserver(event, onEvent)
+    self.observations.setdefault(nodeID, {})[event] = (node, observer, callback, coalesce)
+    self.numberOfAddedObservers += 1
+
+  def removeObserver(self, nodeID, event):
+    nodeObservations = self.observations.get(nodeID, {})
+    if event in nodeObservations:
+      node, observer, callback, coalesce = nodeObservations.pop(event)
+      node.RemoveObserver(observer)
+      self.pendingEvents.pop((nodeID, event), None)
+      self.numberOfRemovedObservers += 1
+    if not nodeObservations:
+      self.observations.pop(nodeID, None)
+
+  def removeObservers(self, nodeID):
+    for event in list(self.observations.get(nodeID, {})):
+      self.removeObserver(nodeID, event)
+
+  def removeAllObservers(self):
+    for nodeID in list(self.observations):
+      self.removeObservers(nodeID)
+
+  def hasObserver(self, nodeID):
+    return nodeID in self.observations
+
+  def getObservedNodeIDs(self):
+    return list(self.observations)
+
+  def getNumberOfObservers(self):
+    return sum(len(nodeObservations) for nodeObservations in self.observations.values())
+
+  @contextlib.contextmanager
+  def suspended(self):
+    """Events of the observed nodes are ignored inside this context."""
+    self.suspendCount += 1
+    try:
+      yield
+    finally:
+      self.suspendCount -= 1
+
+  def onNodeEvent(self, nodeID, event, caller, eventName):
+    if self.suspendCount > 0:
+      return
+    node, observer, callback, coalesce = self.observations[nodeID][event]
+    if not coalesce:
+      callback(caller, eventName)
+      return
+    self.pendingEvents[(nodeID, event)] = (caller, eventName)
+    if not self.flushPendingEventsScheduled:
+      self.flushPendingEventsScheduled = True
+      qt.QTimer.singleShot(0, self.flushPendingEvents)
+
+  def flushPendingEvents(self):
+    self.flushPendingEventsScheduled = False
+    pendingEvents = self.pendingEvents
+    self.pendingEvents = {}
+    for (nodeID, event), (caller, eventName) in pendingEvents.items():
+      #The observer may have been removed after the event
+      if event in self.observations.get(nodeID, {}):
+        callback = self.observations[nodeID][event][2]
+        callback(caller, eventName)
+
+
+class MandibleCurveIndex:
+  """Curve points, arc lengths and curve point to world frames of the mandibular curve, with a
+  KD-tree of the curve points, so closest point and frame queries do not go through the curve node.
+  It is only valid while the control points and the curve polydata of the curve stay the same (see isValidFor),
+  the curve polydata also changes with the curve type or resolution.
+  """
+
+  def __init__(self, curveNode):
+    self.curveNodeID = curveNode.GetID()
+    self.curvePolyDataKey = getPolyDataKey(curveNode.GetCurveWorld())
+    self.controlPoints = slicer.util.arrayFromMarkupsControlPoints(curveNode, world=True)
+    self.curvePoints = np.array(slicer.util.arrayFromMarkupsCurvePoints(curveNode, world=True), dtype=float).reshape(-1,3)
+    segmentsLengths = np.linalg.norm(np.diff(self.curvePoints, axis=0), axis=1)
+    self.arcLengths = np.concatenate([[0.], np.cumsum(segmentsLengths)])
+
+    self.curvePointsToWorldMatrices = np.zeros((len(self.curvePoints),4,4))
+    matrix = vtk.vtkMatrix4x4()
+    for i in range(len(self.curvePoints)):
+      curveNode.GetCurvePointToWorldTransformAtPointIndex(i, matrix)
+      self.curvePointsToWorldMatrices[i] = slicer.util.arrayFromVTKMatrix(matrix)
+
+    points = vtk.vtkPoints()
+    for point in self.curvePoints:
+      points.InsertNextPoint(point)
+    pointsPolyData = vtk.vtkPolyData()
+    pointsPolyData.SetPoints(points)
+    self.pointLocator = vtk.vtkKdTreePointLocator()
+    self.pointLocator.SetDataSet(pointsPolyData)
+    self.pointLocator.BuildLocator()
+
+  def isValidFor(self, curveNode):
+    if curveNode is None or curveNode.GetID() != self.curveNodeID:
+      return False
+    if getPolyDataKey(curveNode.GetCurveWorld()) != self.curvePolyDataKey:
+      return False
+    controlPoints = slicer.util.arrayFromMarkupsControlPoints(curveNode, world=True)
+    return controlPoints.shape == self.controlPoints.shape and np.array_equal(controlPoints, self.controlPoints)
+
+  def getClosestPointsAlongCurve(self, positions):
+    """Closest points on the curve to positions (M,3), like GetClosestPointPositionAlongCurveWorld.
+    Returns the index of the curve point that starts the closest curve segment, the closest points
+    and their arc lengths along the curve.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1,3)
+    closestCurvePointsIndices = np.array([self.pointLocator.FindClosestPoint(position) for position in positions], dtype=int)
+    if len(self.curvePoints) < 2:
+      return closestCurvePointsIndices, self.curvePoints[closestCurvePointsIndices], self.arcLengths[closestCurvePointsIndices]
+
+    #The closest point is on one of the two curve segments around the closest curve point
+    lastSegmentIndex = len(self.curvePoints)-2
+    segmentsIndices = np.stack((np.clip(closestCurvePointsIndices-1, 0, lastSegmentIndex), np.clip(closestCurvePointsIndices, 0, lastSegmentIndex)), axis=1)
+    segmentsStarts = self.curvePoints[segmentsIndices]
+    segmentsVectors = self.curvePoints[segmentsIndices+1] - segmentsStarts
+    segmentsSquaredLengths = np.maximum((segmentsVectors**2).sum(axis=2), 1e-12)
+    fractions = np.clip(((positions[:,np.newaxis] - segmentsStarts)*segmentsVectors).sum(axis=2)/segmentsSquaredLengths, 0, 1)
+    pointsOnSegments = segmentsStarts + fractions[:,:,np.newaxis]*segmentsVectors
+    closestSegment = np.argmin(((pointsOnSegments - positions[:,np.newaxis])**2).sum(axis=2), axis=1)
+
+    rows = np.arange(len(positions))
+    closestSegmentsIndices = segmentsIndices[rows,closestSegment]
+    closestPoints = pointsOnSegments[rows,closestSegment]
+    closestPointsArcLengths = self.arcLengths[closestSegmentsIndices] + fractions[rows,closestSegment]*np.sqrt(segmentsSquaredLengths[rows,closestSegment])
+    return closestSegmentsIndices, closestPoints, closestPointsArcLengths
+
+  def getCurvePointsToWorldMatrices(self, curvePointsIndices):
+    """(M,4,4) frames of the curve at the given curve point indices, like GetCurvePointToWorldTransformAtPointIndex."""
+    return self.curvePointsToWorldMatrices[np.asarray(curvePointsIndices, dtype=int)]
+
+  def getClosestCurvePointsToWorldMatrices(self, positions):
+    return self.getCurvePointsToWorldMatrices(self.getClosestPointsAlongCurve(positions)[0])
+
+
+class BoneReconstructionPlan:
+  """Geometry of a reconstruction plan stored in NumPy arrays.
+  Mandible planes are stored as origins (N,3) and axes (N,3,3), with the axes as rows (X, Y, Z).
+  Fibula planes A and B of every segment are stored as positions (N-1,3) together with
+  the mandible segment to fibula segment rotations (N-1,3,3).
+  Nodes are only read (readMandiblePlanesFromNodes, readFibulaLineFromNode) and written
+  (writeFibulaPlanesToNodes) in bulk, everything else works on the arrays and a fibula
+  vtkPolyData so the plan can be computed without a scene.
+  """
+
+  def __init__(self):
+    self.mandiblePlanesOrigins = np.zeros((0,3))
+    self.mandiblePlanesAxes = np.zeros((0,3,3))
+    self.fibulaLineStart = np.zeros(3)
+    self.fibulaLineEnd = np.array([0.,0.,1.])
+    self.notLeftFibula = False
+    self.fibulaPlanesPositionA = np.zeros((0,3))
+    self.fibulaPlanesPositionB = np.zeros((0,3))
+    self.mandibleAxisToFibulaRotationMatrices = np.zeros((0,3,3))
+    #Intermediate results kept so that the next computation only redoes what the modified planes affect
+    self.betweenSpace = np.zeros(0)
+    self.fibulaPlanesInitialPositionA = np.zeros((0,3))
+    #Convergence of the more exact positioning algorithm for each segment
+    self.positioningIterations = np.zeros(0, dtype=int)
+    self.positioningResiduals = np.zeros(0)
+    self.positioningKey = None
+
+  def copy(self):
+    planCopy = BoneReconstructionPlan()
+    for name, value in self.__dict__.items():
+      setattr(planCopy, name, np.copy(value) if isinstance(value, np.ndarray) else value)
+    return planCopy
+
+  def getNumberOfSegments(self):
+    return max(len(self.mandiblePlanesOrigins)-1, 0)
+
+  def setMandiblePlanes(self, origins, axes):
+    self.mandiblePlanesOrigins = np.array(origins, dtype=float).reshape(-1,3)
+    self.mandiblePlanesAxes = np.array(axes, dtype=float).reshape(-1,3,3)
+
+  def setFibulaLine(self, lineStartPos, lineEndPos, notLeftFibula):
+    self.fibulaLineStart = np.array(lineStartPos, dtype=float)
+    self.fibulaLineEnd = np.array(lineEndPos, dtype=float)
+    self.notLeftFibula = notLeftFibula
+
+  def readMandiblePlanesFromNodes(self, planeList):
+    planeToWorldMatrix = vtk.vtkMatrix4x4()
+    planesToWorld = np.zeros((len(planeList),4,4))
+    for i in range(len(planeList)):
+      planeList[i].GetPlaneToWorldMatrix(planeToWorldMatrix)
+      planesToWorld[i] = slicer.util.arrayFromVTKMatrix(planeToWorldMatrix)
+    self.setMandiblePlanes(planesToWorld[:,:3,3], np.swapaxes(planesToWorld[:,:3,:3],1,2))
+
+  def readFibulaLineFromNode(self, fibulaLine, notLeftFibula):
+    linePoints = slicer.util.arrayFromMarkupsControlPoints(fibulaLine, world=True)
+    self.setFibulaLine(linePoints[0], linePoints[1], notLeftFibula)
+
+  def mandiblePlanesOriginsAreEqualTo(self, origins, tolerance=1e-5):
+    origins = np.asarray(origins).reshape(-1,3)
+    if origins.shape != self.mandiblePlanesOrigins.shape:
+      return False
+    return bool(np.all(np.linalg.norm(origins-self.mandiblePlanesOrigins, axis=1) <= tolerance))
+
+  def getModifiedMandiblePlanes(self, previousPlan, tolerance=1e-9):
+    """Indices of the mandible planes whose origin or axes are different in previousPlan."""
+    if previousPlan is None or len(previousPlan.mandiblePlanesOrigins) != len(self.mandiblePlanesOrigins):
+      return list(range(len(self.mandiblePlanesOrigins)))
+    originsDifference = np.linalg.norm(self.mandiblePlanesOrigins-previousPlan.mandiblePlanesOrigins, axis=1)
+    axesDifference = np.abs(self.mandiblePlanesAxes-previousPlan.mandiblePlanesAxes).max(axis=(1,2))
+    return [int(planeIndex) for planeIndex in np.nonzero((originsDifference > tolerance) | (axesDifference > tolerance))[0]]
+
+  def getModifiedSegments(self, previousPlan):
+    """Segments that depend on a modified mandible plane: plane i is shared by segments i-1 and i."""
+    numberOfSegments = self.getNumberOfSegments()
+    modifiedSegments = set()
+    for planeIndex in self.getModifiedMandiblePlanes(previousPlan):
+      modifiedSegments.update(segmentIndex for segmentIndex in [planeIndex-1, planeIndex] if 0 <= segmentIndex < numberOfSegments)
+    return modifiedSegments
+
+  def getSegmentsUpdate(self, previousPlan, tolerance=1e-6):
+    """Compare with previousPlan and return the segments that need to be cut again: the ones that depend
+    on a modified mandible plane or whose fibula planes moved or rotated. A segment whose planes only moved
+    along the fibula is cut again too because the fibula section changes along it. All segments need to be
+    cut again if the number of segments changed.
+    """
+    numberOfSegments = self.getNumberOfSegments()
+    if previousPlan is None or previousPlan.getNumberOfSegments() != numberOfSegments:
+      return list(range(numberOfSegments))
+
+    segmentsToUpdate = self.getModifiedSegments(previousPlan)
+    rotationsDifference = np.abs(self.mandibleAxisToFibulaRotationMatrices-previousPlan.mandibleAxisToFibulaRotationMatrices).max(axis=(1,2))
+    translationsA = np.linalg.norm(self.fibulaPlanesPositionA - previousPlan.fibulaPlanesPositionA, axis=1)
+    translationsB = np.linalg.norm(self.fibulaPlanesPositionB - previousPlan.fibulaPlanesPositionB, axis=1)
+    for i in range(numberOfSegments):
+      if rotationsDifference[i] > tolerance or translationsA[i] > tolerance or translationsB[i] > tolerance:
+        segmentsToUpdate.add(i)
+    return sorted(segmentsToUpdate)
+
+  def getMandibleSegmentsAxes(self):
+    return getMandibleSegmentsAxes(self.mandiblePlanesOrigins, self.mandiblePlanesAxes[:,1])
+
+  def getFibulaAxes(self):
+    return getFibulaAxesFromLine(self.fibulaLineStart, self.fibulaLineEnd, self.notLeftFibula)
+
+  def updateRotationMatrices(self, useSegmentsFibulaAxes):
+    mandibleAxes, boneSegmentsDistance = self.getMandibleSegmentsAxes()
+    if useSegmentsFibulaAxes:
+      fibulaAxes = getFibulaAxesFromLine(self.fibulaPlanesPositionA, self.fibulaPlanesPositionB, self.notLeftFibula)
+    else:
+      fibulaAxes = self.getFibulaAxes()
+    self.mandibleAxisToFibulaRotationMatrices = getRotationMatricesBetweenAxes(mandibleAxes, fibulaAxes)
+
+  def setFibulaPlanesPositions(self, positionsA, positionsB, useSegmentsFibulaAxes):
+    self.fibulaPlanesPositionA = np.array(positionsA, dtype=float).reshape(-1,3)
+    self.fibulaPlanesPositionB = np.array(positionsB, dtype=float).reshape(-1,3)
+    self.updateRotationMatrices(useSegmentsFibulaAxes)
+    #Positions not computed by computeFibulaPlanesPositions, its intermediate results are not valid anymore
+    self.positioningKey = None
+
+  def computeFibulaPlanesPositions(self, fibulaPolyData, initialSpace, intersectionPlaceOfFibulaPlanes,
+      intersectionDistanceMultiplier, additionalBetweenSpaceOfFibulaPlanes, useMoreExactVersionOfPositioningAlgorithm, previousPlan=None,
+      fibulaCrossSectionStack=None, useVectorizedBetweenSpaceComputation=True, positioningAlgorithmTolerance=0.01,
+      positioningAlgorithmMaximumNumberOfIterations=10):
+    """Place fibula planes along the fibula. If previousPlan was computed with the same fibula and parameters,
+    its results are reused for the segments whose mandible planes did not change.
+    The more exact version centers every segment on the fibula using the sections of fibulaCrossSectionStack,
+    which is computed from fibulaPolyData and the fibula line if not given. The same stack gives the space
+    between segments if useVectorizedBetweenSpaceComputation, otherwise the fibula is cut with vtkCutter.
+    Centering starts from the previous solution of each segment when available and the number of iterations
+    and the final residual of each segment are kept in positioningIterations and positioningResiduals.
+    """
+    numberOfSegments = self.getNumberOfSegments()
+    positioningKey = (
+      id(fibulaPolyData), fibulaPolyData.GetMTime(), initialSpace, intersectionPlaceOfFibulaPlanes, intersectionDistanceMultiplier,
+      additionalBetweenSpaceOfFibulaPlanes, useMoreExactVersionOfPositioningAlgorithm, useVectorizedBetweenSpaceComputation,
+      positioningAlgorithmTolerance, positioningAlgorithmMaximumNumberOfIterations, tuple(self.fibulaLineStart), tuple(self.fibulaLineEnd), self.notLeftFibula
+    )
+    reusePreviousResults = (previousPlan is not None and previousPlan.positioningKey == positioningKey
+      and previousPlan.getNumberOfSegments() == numberOfSegments)
+    if reusePreviousResults:
+      modifiedSegments = self.getModifiedSegments(previousPlan)
+    else:
+      modifiedSegments = set(range(numberOfSegments))
+    if (useMoreExactVersionOfPositioningAlgorithm or useVectorizedBetweenSpaceComputation) and fibulaCrossSectionStack is None:
+      fibulaCrossSectionStack = FibulaCrossSectionStack(fibulaPolyData, self.fibulaLineStart, self.fibulaLineEnd, self.notLeftFibula)
+
+    mandibleAxes, boneSegmentsDistance = self.getMandibleSegmentsAxes()
+    fibulaAxes = self.getFibulaAxes()
+    fibulaZ = fibulaAxes[2]
+    fibulaOrigin = self.fibulaLineStart
+    fibulaZLineNorm = np.linalg.norm(self.fibulaLineEnd-self.fibulaLineStart)
+    mandibleAxisToFibulaRotationMatrices = getRotationMatricesBetweenAxes(mandibleAxes, fibulaAxes)
+
+    #Mandible planes normals rotated to the fibula, the sections are centered on the same point of the fibula line
+    intersectionOrigin = fibulaOrigin + fibulaZ*fibulaZLineNorm*intersectionPlaceOfFibulaPlanes
+    transformedNormalsA = np.einsum('nij,nj->ni', mandibleAxisToFibulaRotationMatrices, self.mandiblePlanesAxes[:-1,2])
+    transformedNormalsB = np.einsum('nij,nj->ni', mandibleAxisToFibulaRotationMatrices, self.mandiblePlanesAxes[1:,2])
+
+    #calculate how much each FibulaPlaneA should be translated so that it doesn't intersect with fibulaPlaneB
+    #betweenSpace[i-1] only depends on the mandible plane shared by segments i-1 and i
+    betweenSpace = np.zeros(max(numberOfSegments-1, 0))
+    betweenSpaceIndicesToUpdate = []
+    for i in range(1,numberOfSegments):
+      if (i-1) not in modifiedSegments and i not in modifiedSegments:
+        betweenSpace[i-1] = previousPlan.betweenSpace[i-1]
+      else:
+        betweenSpaceIndicesToUpdate.append(i-1)
+    if len(betweenSpaceIndicesToUpdate) > 0:
+      betweenSpaceIndicesToUpdate = np.array(betweenSpaceIndicesToUpdate)
+      sectionsNormals = np.concatenate([transformedNormalsB[betweenSpaceIndicesToUpdate], transformedNormalsA[betweenSpaceIndicesToUpdate+1]])
+      if useVectorizedBetweenSpaceComputation:
+        sectionsExtents = fibulaCrossSectionStack.getPlanesSectionsExtentsAlongLine(intersectionOrigin, sectionsNormals)
+      else:
+        sectionsExtents = np.zeros(len(sectionsNormals))
+        for j in range(len(sectionsNormals)):
+          sectionPoints = getPointsArrayOfPolyData(getPlaneSectionOfPolyData(fibulaPolyData, intersectionOrigin, sectionsNormals[j]))
+          if len(sectionPoints) > 0:
+            sectionZ = sectionPoints @ fibulaZ
+            sectionsExtents[j] = sectionZ.max() - sectionZ.min()
+      numberOfIndices = len(betweenSpaceIndicesToUpdate)
+      betweenSpace[betweenSpaceIndicesToUpdate] = sectionsExtents[:numberOfIndices]/2 + sectionsExtents[numberOfIndices:]/2
+
+    fibulaPlanesPositionA = np.zeros((numberOfSegments,3))
+    fibulaPlanesPositionB = np.zeros((numberOfSegments,3))
+    fibulaPlanesInitialPositionA = np.zeros((numberOfSegments,3))
+    positioningIterations = np.zeros(numberOfSegments, dtype=int)
+    positioningResiduals = np.zeros(numberOfSegments)
+    for i in range(numberOfSegments):
+      if i==0:
+        fibulaPlanesPositionA[i] = fibulaOrigin + fibulaZ*initialSpace
+      else:
+        fibulaPlanesPositionA[i] = fibulaPlanesPositionB[i-1] + fibulaZ*(intersectionDistanceMultiplier*betweenSpace[i-1]+additionalBetweenSpaceOfFibulaPlanes)
+
+      fibulaPlanesPositionB[i] = fibulaPlanesPositionA[i] + boneSegmentsDistance[i]*fibulaZ
+      fibulaPlanesInitialPositionA[i] = fibulaPlanesPositionA[i]
+
+      if (useMoreExactVersionOfPositioningAlgorithm and i not in modifiedSegments
+          and np.linalg.norm(previousPlan.fibulaPlanesInitialPositionA[i]-fibulaPlanesInitialPositionA[i]) < 1e-9):
+        #Same starting point and segment as last time, the iterations would give the same result
+        fibulaPlanesPositionA[i] = previousPlan.fibulaPlanesPositionA[i]
+        fibulaPlanesPositionB[i] = previousPlan.fibulaPlanesPositionB[i]
+        positioningIterations[i] = 0
+        positioningResiduals[i] = previousPlan.positioningResiduals[i]
+      elif useMoreExactVersionOfPositioningAlgorithm:
+        lineStartPos = fibulaPlanesPositionA[i]
+        lineEndPos = fibulaPlanesPositionB[i]
+        if reusePreviousResults:
+          #Warm start: the previous solution moved by as much as the start of the segment on the fibula line did
+          previousSegmentDirection = previousPlan.fibulaPlanesPositionB[i]-previousPlan.fibulaPlanesPositionA[i]
+          lineStartPos = lineStartPos + previousPlan.fibulaPlanesPositionA[i] - previousPlan.fibulaPlanesInitialPositionA[i]
+          lineEndPos = lineStartPos + boneSegmentsDistance[i]*previousSegmentDirection/np.linalg.norm(previousSegmentDirection)
+
+        lineStartPos, lineEndPos, positioningIterations[i], positioningResiduals[i] = fibulaCrossSectionStack.centerSegmentOnSections(
+          lineStartPos, lineEndPos, boneSegmentsDistance[i], positioningAlgorithmTolerance, positioningAlgorithmMaximumNumberOfIterations)
+
+        fibulaPlanesPositionA[i] = lineStartPos
+        fibulaPlanesPositionB[i] = lineEndPos
+
+    self.setFibulaPlanesPositions(fibulaPlanesPositionA, fibulaPlanesPositionB, useMoreExactVersionOfPositioningAlgorithm)
+    self.betweenSpace = betweenSpace
+    self.fibulaPlanesInitialPositionA = fibulaPlanesInitialPositionA
+    self.positioningIterations = positioningIterations
+    self.positioningResiduals = positioningResiduals
+    self.positioningKey = positioningKey
+
+  def getFibulaPlanesFrames(self):
+    """Origins and axes of fibula planes A and B, each as (N-1,3) and (N-1,3,3) arrays."""
+    mandiblePlane0ToFibulaPlaneATransforms = getRigidTransformMatrices(
+      self.mandibleAxisToFibulaRotationMatrices, self.mandiblePlanesOrigins[:-1], self.fibulaPlanesPositionA)
+    mandiblePlane1ToFibulaPlaneBTransforms = getRigidTransformMatrices(
+      self.mandibleAxisToFibulaRotationMatrices, self.mandiblePlanesOrigins[1:], self.fibulaPlanesPositionB)
+    fibulaPlanesAOrigins, fibulaPlanesAAxes = transformPlaneFrames(mandiblePlane0ToFibulaPlaneATransforms, self.mandiblePlanesOrigins[:-1], self.mandiblePlanesAxes[:-1])
+    fibulaPlanesBOrigins, fibulaPlanesBAxes = transformPlaneFrames(mandiblePlane1ToFibulaPlaneBTransforms, self.mandiblePlanesOrigins[1:], self.mandiblePlanesAxes[1:])
+    return fibulaPlanesAOrigins, fibulaPlanesAAxes, fibulaPlanesBOrigins, fibulaPlanesBAxes
+
+  def getFibulaPiecesToMandibleTransforms(self):
+    """(N-1,4,4) transforms that move each fibula segment center onto its mandible segment center."""
+    mandibleSegmentsCenters = (self.mandiblePlanesOrigins[:-1] + self.mandiblePlanesOrigins[1:])/2
+    fibulaSegmentsCenters = (self.fibulaPlanesPositionA + self.fibulaPlanesPositionB)/2
+    #Rotations are orthonormal so the inverse is the transpose
+    fibulaToMandibleRotationMatrices = np.swapaxes(self.mandibleAxisToFibulaRotationMatrices,1,2)
+    return getRigidTransformMatrices(fibulaToMandibleRotationMatrices, fibulaSegmentsCenters, mandibleSegmentsCenters)
+
+  def writeFibulaPlanesToNodes(self, fibulaPlanesList):
+    fibulaPlanesAOrigins, fibulaPlanesAAxes, fibulaPlanesBOrigins, fibulaPlanesBAxes = self.getFibulaPlanesFrames()
+    for i in range(self.getNumberOfSegments()):
+      for fibulaPlane, origin, axes in [
+          (fibulaPlanesList[2*i], fibulaPlanesAOrigins[i], fibulaPlanesAAxes[i]),
+          (fibulaPlanesList[2*i+1], fibulaPlanesBOrigins[i], fibulaPlanesBAxes[i])]:
+        wasModified = fibulaPlane.StartModify()
+        fibulaPlane.SetAxes(axes[0],axes[1],axes[2])
+        fibulaPlane.SetOrigin(origin)
+        fibulaPlane.EndModify(wasModified)
+
+
+class PolyDataDiskCache:
+  """Content-addressed cache of surfaces on disk. Every entry is a folder named by its key with the points,
+  polygons and normals of its surfaces as .npy files and a manifest with the number of surfaces.
+  Entries are written to a temporary folder that is then renamed, so other Slicer instances sharing the
+  cache folder only see complete entries, and an entry that cannot be read completely is a cache miss.
+  The least recently used entries are removed when the size of the cache goes over maximumSize (bytes).
+  Files are read into memory (not memory mapped) so entries can be removed while their surfaces are used.
+  """
+
+  manifestFileName = "manifest.json"
+
+  def __init__(self, cacheDirectory, maximumSize, maximumTemporaryDirectoryAge=3600):
+    self.cacheDirectory = cacheDirectory
+    self.maximumSize = maximumSize
+    self.maximumTemporaryDirectoryAge = maximumTemporaryDirectoryAge
+    os.makedirs(cacheDirectory, exist_ok=True)
+    self.removeLeftoverDirectories()
+
+  @staticmethod
+  def getKey(*items):
+    import hashlib
+    keyHash = hashlib.blake2b(digest_size=20)
+    for item in items:
+      if isinstance(item, np.ndarray):
+        keyHash.update(repr((item.dtype.str, item.shape)).encode())
+        keyHash.update(np.ascontiguousarray(item).data)
+      else:
+        keyHash.update(repr(item).encode())
+    return keyHash.hexdigest()
+
+  def getEntryDirectory(self, key):
+    return os.path.join(self.cacheDirectory, key)
+
+  def get(self, key, numberOfSurfaces=None):
+    """Surfaces stored with key or None if they are not in the cache (or there are not numberOfSurfaces of them)."""
+    entryDirectory = self.getEntryDirectory(key)
+    try:
+      with open(os.path.join(entryDirectory, self.manifestFileName)) as manifestFile:
+        storedNumberOfSurfaces = int(json.load(manifestFile)["numberOfSurfaces"])
+      if storedNumberOfSurfaces < 1 or (numberOfSurfaces is not None and storedNumberOfSurfaces != numberOfSurfaces):
+        return None
+      polyDataList = [self.readPolyData(entryDirectory, i) for i in range(storedNumberOfSurfaces)]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      #Missing, incomplete or being evicted by another instance
+      logging.debug('Cache entry {0} could not be read: {1}'.format(key, e))
+      return None
+    try:
+      os.utime(entryDirectory)
+    except OSError:
+      pass
+    return polyDataList
+
+  def put(self, key, polyDataList):
+    entryDirectory = self.getEntryDirectory(key)
+    if os.path.exists(entryDirectory):
+      return
+    import shutil, tempfile
+    temporaryDirectory = tempfile.mkdtemp(prefix=".tmp-", dir=self.cacheDirectory)
+    try:
+      for i, polyData in enumerate(polyDataList):
+        self.writePolyData(temporaryDirectory, i, polyData)
+      with open(os.path.join(temporaryDirectory, self.manifestFileName), "w") as manifestFile:
+        json.dump({"numberOfSurfaces": len(polyDataList)}, manifestFile)
+      os.replace(temporaryDirectory, entryDirectory)
+    except OSError:
+      #Same content already stored by another instance (or disk full), the cache is only an optimization
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    self.evict()
+
+  def getEntries(self):
+    """(key, size, last access time) of the entries."""
+    entries = []
+    for entry in os.scandir(self.cacheDirectory):
+      if entry.name.startswith(".") or not entry.is_dir():
+        continue
+      try:
+        size = sum(entryFile.stat().st_size for entryFile in os.scandir(entry.path))
+        entries.append((entry.name, size, entry.stat().st_mtime))
+      except OSError:
+        pass
+    return entries
+
+  def evict(self):
+    import shutil, uuid
+    cacheSize = 0
+    for key, size, lastAccessTime in sorted(self.getEntries(), key=lambda entry: entry[2], reverse=True):
+      cacheSize += size
+      if cacheSize <= self.maximumSize:
+        continue
+      #Renamed first so that readers never see an entry with missing files
+      evictedDirectory = os.path.join(self.cacheDirectory, ".evicted-" + uuid.uuid4().hex)
+      try:
+        os.replace(self.getEntryDirectory(key), evictedDirectory)
+      except OSError:
+        continue
+      shutil.rmtree(evictedDirectory, ignore_errors=True)
+    self.removeLeftoverDirectories()
+
+  def removeLeftoverDirectories(self):
+    """Remove evicted entries that could not be removed and temporary folders of writes that did not finish
+    (older than maximumTemporaryDirectoryAge seconds, younger ones may be written by another instance).
+    """
+    import shutil
+    now = time.time()
+    for entry in os.scandir(self.cacheDirectory):
+      try:
+        if not entry.is_dir():
+          continue
+        if entry.name.startswith(".evicted-") or (entry.name.startswith(".tmp-") and now - entry.stat().st_mtime > self.maximumTemporaryDirectoryAge):
+          shutil.rmtree(entry.path, ignore_errors=True)
+      except OSError:
+        pass
+
+  def clear(self):
+    maximumSize = self.maximumSize
+    self.maximumSize = -1
+    self.evict()
+    self.maximumSize = maximumSize
+
+  def writePolyData(self, directory, index, polyData):
+    arrays = {
+      "points": getPointsArrayOfPolyData(polyData),
+      "offsets": vtk.util.numpy_support.vtk_to_numpy(polyData.GetPolys().GetOffsetsArray()).astype(np.int64),
+      "connectivity": vtk.util.numpy_support.vtk_to_numpy(polyData.GetPolys().GetConnectivityArray()).astype(np.int64),
+    }
+    if polyData.GetPointData().GetNormals() is not None:
+      arrays["normals"] = vtk.util.numpy_support.vtk_to_numpy(polyData.GetPointData().GetNormals())
+    for name, array in arrays.items():
+      np.save(os.path.join(directory, "{0}_{1}.npy".format(index, name)), np.ascontiguousarray(array))
+
+  def readPolyData(self, directory, index):
+    def load(name):
+      return np.load(os.path.join(directory, "{0}_{1}.npy".format(index, name)))
+
+    idType = np.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else np.int32
+    polyData = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.SetData(vtk.util.numpy_support.numpy_to_vtk(load("points"), deep=0))
+    polyData.SetPoints(points)
+    cellArray = vtk.vtkCellArray()
+    cellArray.SetData(vtk.util.numpy_support.numpy_to_vtkIdTypeArray(load("offsets").astype(idType, copy=False), deep=0),
+      vtk.util.numpy_support.numpy_to_vtkIdTypeArray(load("connectivity").astype(idType, copy=False), deep=0))
+    polyData.SetPolys(cellArray)
+    normalsFileName = os.path.join(directory, "{0}_normals.npy".format(index))
+    if os.path.exists(normalsFileName):
+      normals = vtk.util.numpy_support.numpy_to_vtk(load("normals"), deep=0)
+      normals.SetName("Normals")
+      polyData.GetPointData().SetNormals(normals)
+    return polyData
+
+
+class RecomputeScheduler:
+  """Calls callback after requests, replacing a single shot timer with a fixed interval.
+  The recompute time is measured and the median of the last ones (cost) sets:
+  - the debounce interval: requests are coalesced for debounceFactor*cost (between minimumInterval and maximumInterval),
+    every new request postpones the recompute so the requests superseded by newer ones are dropped,
+  - the idle time: at least idleFactor*cost is left to the UI between the end of a recompute and the next one.
+  A request is never delayed more than maximumWaitTime (besides the idle time) so results keep up while dragging.
+  A callback that returns True finishes the recompute asynchronously and reports its end with finishAsynchronousRecompute.
+  Until then a new request calls the callback again to replace the running recompute (the callback cancels it), unless
+  the running recompute is for a request older than maximumWaitTime: new requests then wait for it so that continuous
+  requests still get results.
+  Times are in seconds, see getStatistics for the measurements.
+  """
+
+  def __init__(self, callback, initialInterval=0.3, minimumInterval=0.02, maximumInterval=1.0, debounceFactor=0.5,
+      idleFactor=0.5, maximumWaitTime=1.0, numberOfSamples=20, replaceAsynchronousRecomputes=True):
+    self.callback = callback
+    self.initialInterval = initialInterval
+    self.minimumInterval = minimumInterval
+    self.maximumInterval = maximumInterval
+    self.debounceFactor = debounceFactor
+    self.idleFactor = idleFactor
+    self.maximumWaitTime = maximumWaitTime
+    self.replaceAsynchronousRecomputes = replaceAsynchronousRecomputes
+    self.recomputeTimes = []
+    self.latencies = []
+    self.numberOfSamples = numberOfSamples
+    self.numberOfRequests = 0
+    self.numberOfRecomputes = 0
+    self.numberOfDroppedRequests = 0
+    self.numberOfReplacedRecomputes = 0
+    self.firstPendingRequestTime = None
+    self.lastRecomputeEndTime = 0.0
+    self.asynchronousRequestTime = None
+    self.running = False
+    self.runningAsynchronously = False
+    self.requestedWhileRunning = False
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.connect('timeout()', self.onTimeout)
+
+  def getRecomputeCost(self):
+    if len(self.recomputeTimes) == 0:
+      return None
+    return float(np.median(self.recomputeTimes))
+
+  def getDebounceInterval(self):
+    cost = self.getRecomputeCost()
+    if cost is None:
+      return self.initialInterval
+    return min(max(self.debounceFactor*cost, self.minimumInterval), self.maximumInterval)
+
+  def getIdleTime(self):
+    cost = self.getRecomputeCost()
+    if cost is None:
+      return 0.0
+    return min(self.idleFactor*cost, self.maximumInterval)
+
+  def canReplaceRunningRecompute(self):
+    if not (self.runningAsynchronously and self.replaceAsynchronousRecomputes):
+      return False
+    return self.asynchronousRequestTime is None or time.time() - self.asynchronousRequestTime < self.maximumWaitTime
+
+  def request(self):
+    self.numberOfRequests += 1
+    #While a replacing recompute is scheduled new requests are coalesced into it
+    if self.running and not self.timer.isActive() and not self.canReplaceRunningRecompute():
+      #Recompute again when the current one finishes with the newest state
+      if self.requestedWhileRunning:
+        self.numberOfDroppedRequests += 1
+      self.requestedWhileRunning = True
+      return
+    if self.firstPendingRequestTime is None:
+      #The request of a replaced recompute is still waiting for its result
+      self.firstPendingRequestTime = self.asynchronousRequestTime if self.running and self.asynchronousRequestTime is not None else time.time()
+    else:
+      self.numberOfDroppedRequests += 1
+    self.schedule()
+
+  def schedule(self):
+    now = time.time()
+    earliestTime = self.lastRecomputeEndTime + self.getIdleTime()
+    recomputeTime = min(now + self.getDebounceInterval(), self.firstPendingRequestTime + self.maximumWaitTime)
+    recomputeTime = max(recomputeTime, earliestTime)
+    self.timer.start(max(int(round((recomputeTime - now)*1000)), 0))
+
+  def stop(self):
+    self.timer.stop()
+    self.firstPendingRequestTime = None
+    self.requestedWhileRunning = False
+
+  def isPending(self):
+    return self.timer.isActive() or self.requestedWhileRunning
+
+  def onTimeout(self):
+    requestTime = self.firstPendingRequestTime
+    self.firstPendingRequestTime = None
+    if self.runningAsynchronously:
+      #The callback cancels the running recompute and starts the new one
+      self.numberOfReplacedRecomputes += 1
+    self.running = True
+    self.runningAsynchronously = False
+    startTime = time.time()
+    finishesAsynchronously = False
+    try:
+      finishesAsynchronously = self.callback() is True
+    finally:
+      if finishesAsynchronously:
+        self.runningAsynchronously = True
+        self.asynchronousRequestTime = requestTime
+      else:
+        self.recordRecomputeTime(time.time() - startTime, requestTime)
+        self.onRecomputeFinished()
+
+  def finishAsynchronousRecompute(self, recomputeTime=None):
+    """End of the recompute of a callback that returned True, recomputeTime is None if it failed or was cancelled."""
+    if not self.running:
+      return
+    if recomputeTime is not None:
+      self.recordRecomputeTime(recomputeTime)
+    else:
+      self.asynchronousRequestTime = None
+      self.lastRecomputeEndTime = time.time()
+    self.onRecomputeFinished()
+
+  def onRecomputeFinished(self):
+    self.running = False
+    self.runningAsynchronously = False
+    if self.timer.isActive():
+      #A replacing recompute was scheduled, the request it was waiting for is served now
+      self.firstPendingRequestTime = self.lastRecomputeEndTime
+    if self.requestedWhileRunning:
+      self.requestedWhileRunning = False
+      self.firstPendingRequestTime = self.lastRecomputeEndTime
+      self.schedule()
+
+  def recordRecomputeTime(self, recomputeTime, requestTime=None):
+    self.lastRecomputeEndTime = time.time()
+    if requestTime is None:
+      requestTime = self.asynchronousRequestTime
+      self.asynchronousRequestTime = None
+    self.numberOfRecomputes += 1
+    self.recomputeTimes = (self.recomputeTimes + [recomputeTime])[-self.numberOfSamples:]
+    if requestTime is not None:
+      self.latencies = (self.latencies + [self.lastRecomputeEndTime - requestTime])[-self.numberOfSamples:]
+    logging.debug('Recompute time {0:.3f} s, debounce interval {1:.3f} s, idle time {2:.3f} s'.format(
+      recomputeTime, self.getDebounceInterval(), self.getIdleTime()))
+
+  def getStatistics(self):
+    """Last recompute times, latencies from the first request to the end of its recompute and the current intervals."""
+    return {
+      "numberOfRequests": self.numberOfRequests,
+      "numberOfRecomputes": self.numberOfRecomputes,
+      "numberOfDroppedRequests": self.numberOfDroppedRequests,
+      "numberOfReplacedRecomputes": self.numberOfReplacedRecomputes,
+      "recomputeTimes": list(self.recomputeTimes),
+      "latencies": list(self.latencies),
+      "recomputeCost": self.getRecomputeCost(),
+      "debounceInterval": self.getDebounceInterval(),
+      "idleTime": self.getIdleTime(),
+    }
+
+
+class PlanningJobCancelled(Exception):
+  """Raised by a planning job that was cancelled by a newer one."""
+
+
+class PlanningWorker:
+  """Runs planning jobs on one worker thread. Submitting a job cancels the one in flight, which stops at
+  its next check of the cancel event, and only the result of the last submitted job is passed to onResult.
+  Results and errors are passed on the main thread: the job is polled with a timer.
+  """
+
+  def __init__(self, onResult, onError, pollInterval=20):
+    self.onResult = onResult
+    self.onError = onError
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self.future = None
+    self.cancelEvent = None
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(pollInterval)
+    self.pollTimer.connect('timeout()', self.poll)
+
+  def submit(self, function, *args):
+    """Run function(*args, cancelEvent) on the worker thread."""
+    self.cancel()
+    self.cancelEvent = threading.Event()
+    self.future = self.executor.submit(function, *args, self.cancelEvent)
+    self.pollTimer.start()
+
+  def cancel(self):
+    if self.cancelEvent is not None:
+      self.cancelEvent.set()
+    self.cancelEvent = None
+    self.future = None
+    self.pollTimer.stop()
+
+  def isBusy(self):
+    return self.future is not None
+
+  def poll(self):
+    if self.future is None:
+      self.pollTimer.stop()
+      return
+    if not self.future.done():
+      return
+    future = self.future
+    self.future = None
+    self.cancelEvent = None
+    self.pollTimer.stop()
+    try:
+      result = future.result()
+    except PlanningJobCancelled:
+      return
+    except Exception as e:
+      logging.exception('Background planning failed')
+      self.onError(e)
+      return
+    self.onResult(result)
+
+  def shutdown(self):
+    self.cancel()
+    self.executor.shutdown(wait=False)
+
+
+class TimingSpans:
+  """Rolling buffers of the timing spans of the planning pipeline and of counters sampled along them.
+  Spans and counters can be added from any thread and exported as a Chrome trace that can be opened
+  in chrome://tracing or https://ui.perfetto.dev.
+  """
+
+  def __init__(self, maximumNumberOfSpans=10000, maximumNumberOfCounters=10000):
+    self.spans = collections.deque(maxlen=maximumNumberOfSpans)
+    #Kept apart so frequent counter samples do not push spans out of their buffer
+    self.counters = collections.deque(maxlen=maximumNumberOfCounters)
+    self.lock = threading.Lock()
+    #Increased on every added span so users of the spans can tell when they changed
+    self.numberOfAddedSpans = 0
+
+  def addSpan(self, name, startTime, endTime=None, category="planning", args=None):
+    """Add a span, times are time.perf_counter() values."""
+    if endTime is None:
+      endTime = time.perf_counter()
+    span = {
+      "name": name,
+      "category": category,
+      "startTime": startTime,
+      "duration": endTime-startTime,
+      "threadID": threading.get_ident(),
+      "args": dict(args) if args else {},
+    }
+    with self.lock:
+      self.spans.append(span)
+      self.numberOfAddedSpans += 1
+
+  def addCounters(self, name, values, category="planning"):
+    """Add a sample of the counters in values, shown as a graph over time in the trace."""
+    counters = {
+      "name": name,
+      "category": category,
+      "time": time.perf_counter(),
+      "threadID": threading.get_ident(),
+      "args": dict(values),
+    }
+    with self.lock:
+      self.counters.append(counters)
+
+  @contextlib.contextmanager
+  def span(self, name, category="planning", args=None):
+    startTime = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.addSpan(name, startTime, category=category, args=args)
+
+  def getSpans(self):
+    with self.lock:
+      return list(self.spans)
+
+  def getCounters(self):
+    with self.lock:
+      return list(self.counters)
+
+  def clear(self):
+    with self.lock:
+      self.spans.clear()
+      self.counters.clear()
+      self.numberOfAddedSpans += 1
+
+  def getLatencyBreakdown(self):
+    """Count, last, mean and maximum duration in seconds of the spans of each category and name, ordered by total duration."""
+    breakdown = {}
+    for span in self.getSpans():
+      row = breakdown.setdefault((span["category"], span["name"]), {"name": span["name"], "category": span["category"], "count": 0, "total": 0.0, "maximum": 0.0})
+      row["count"] += 1
+      row["total"] += span["duration"]
+      row["maximum"] = max(row["maximum"], span["duration"])
+      row["last"] = span["duration"]
+    for row in breakdown.values():
+      row["mean"] = row["total"]/row["count"]
+    return sorted(breakdown.values(), key=lambda row: row["total"], reverse=True)
+
+  def getChromeTrace(self):
+    processID = os.getpid()
+    traceEvents = []
+    for span in self.getSpans():
+      traceEvents.append({
+        "name": span["name"],
+        "cat": span["category"],
+        "ph": "X",
+        "ts": span["startTime"]*1e6,
+        "dur": span["duration"]*1e6,
+        "pid": processID,
+        "tid": span["threadID"],
+        "args": span["args"],
+      })
+    for counters in self.getCounters():
+      traceEvents.append({
+        "name": counters["name"],
+        "cat": counters["category"],
+        "ph": "C",
+        "ts": counters["time"]*1e6,
+        "pid": processID,
+        "tid": counters["threadID"],
+        "args": counters["args"],
+      })
+    return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+  def exportChromeTrace(self, fileName):
+    with open(fileName, "w") as file:
+      json.dump(self.getChromeTrace(), file)